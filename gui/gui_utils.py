@@ -12,6 +12,18 @@ def detection_Popen(weights, filePath):
     return ret_code
 
 
+def batch_Popen(weights, videos, output, workers=1):
+    command = r'python icsi.py batch --weights={} --videos={} --output={} --workers={}' \
+        .format(weights, videos, output, workers)
+    p = subprocess.Popen(["start", "cmd", "/k", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                     shell=True, cwd=r'D:\MASK-RCNN\samples\icsi')
+    ret_code = p.wait()
+    print("ret_code ", ret_code)
+    if ret_code != 0:
+        print("Something went wrong...")
+    return ret_code
+
+
 def train_Popen(dataset, weights, epochs, steps, imGPU, layers):
     command = r'python icsi.py train --dataset={} --weights={} --epochs={} --steps={} --imGPU={} --layers={}' \
         .format(dataset, weights, epochs, steps, imGPU, layers)
@@ -84,6 +84,11 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Directory to save the anchors of each image shape in, see
+    # model.pyramid_anchors(). The files are memory-mapped and shared by all
+    # the processes that use the same settings. None to keep them in memory.
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can increase this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
@@ -102,6 +107,18 @@ class Config(object):
     # memory load. Recommended when using high-resolution images.
     USE_MINI_MASK = True
     MINI_MASK_SHAPE = (56, 56)  # (height, width) of the mini-mask
+    # Rasterize the polygons of datasets that have them, see
+    # Dataset.load_polygons(), straight into the mini-masks instead of
+    # rasterizing them at the image size and resizing the masks. Faster,
+    # but the boxes can differ by a pixel or so and the masks slightly
+    # from those of extract_bboxes() and minimize_mask().
+    MINI_MASK_FROM_POLYGONS = False
+
+    # Directory of the caches of preprocessed training data written by
+    # gt_cache.write_cache(). If it has a cache for the config and the
+    # dataset, data_generator() reads the images and targets from it
+    # instead of loading and resizing them. None to not use a cache.
+    GT_CACHE_DIR = None
 
     # Input image resizing
     # Generally, use the "square" resizing mode for training and predicting
@@ -132,11 +149,16 @@ class Config(object):
     # However, in 'square' mode, it can be overruled by IMAGE_MAX_DIM.
     IMAGE_MIN_SCALE = 0
     # Number of color channels per image. RGB = 3, grayscale = 1, RGB-D = 4
-    # Changing this requires other changes in the code. See the WIKI for more
-    # details: https://github.com/matterport/Mask_RCNN/wiki
+    # Grayscale images are loaded and molded with a single channel, and the
+    # first convolution of RGB weights is summed over the channels, and its
+    # bias corrected for the single mean, when they are loaded, see
+    # model.adapt_input_channels(). Other channel counts require other
+    # changes in the code.
+    # See the WIKI for more details: https://github.com/matterport/Mask_RCNN/wiki
     IMAGE_CHANNEL_COUNT = 3
 
-    # Image mean (RGB)
+    # Image mean (RGB). With IMAGE_CHANNEL_COUNT = 1, the mean of the three
+    # values is used unless a single value is given.
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
 
     # Number of ROIs per image to feed to classifier/mask heads
@@ -174,6 +196,17 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Backend to resize the detected masks to their boxes: "skimage",
+    # "opencv" or "numpy". See utils.mask_to_box(). "numpy" gives the same
+    # masks as "skimage" and is several times faster.
+    MASK_PASTE_BACKEND = "skimage"
+
+    # Class IDs whose masks are computed in inference, e.g. [1, 2], or None
+    # for all classes. The mask head only pools the boxes of the detections
+    # of these classes and only their masks are pasted. The masks of the
+    # other detections are empty. Training is not affected.
+    MASK_CLASSES = None
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
@@ -223,6 +256,15 @@ class Config(object):
             self.IMAGE_SHAPE = np.array([self.IMAGE_MAX_DIM, self.IMAGE_MAX_DIM,
                 self.IMAGE_CHANNEL_COUNT])
 
+        # RGB mean that RGB weights were trained with, to adapt them to the
+        # mean of grayscale images, see model.adapt_input_channels()
+        self.RGB_MEAN_PIXEL = self.MEAN_PIXEL if len(self.MEAN_PIXEL) == 3 else None
+        # Grayscale mean
+        if self.IMAGE_CHANNEL_COUNT == 1 and len(self.MEAN_PIXEL) == 3:
+            self.MEAN_PIXEL = np.array([np.mean(self.MEAN_PIXEL)])
+        assert len(self.MEAN_PIXEL) == self.IMAGE_CHANNEL_COUNT, \
+            "MEAN_PIXEL must have IMAGE_CHANNEL_COUNT values"
+
         # Image meta data length
         # See compose_image_meta() for details
         self.IMAGE_META_SIZE = 1 + 3 + 3 + 4 + 1 + self.NUM_CLASSES
@@ -0,0 +1,229 @@
+"""
+Mask R-CNN
+Export of a trained inference model to a frozen TensorFlow graph, and a
+predictor that runs the frozen graph with the API of MaskRCNN.
+
+Building the Keras model and loading the weights from HDF5 takes many
+seconds. A frozen graph has the weights as constants, the batch norm
+layers folded into the convolutions and only the ops needed for the
+detections, so it loads in about a second.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import logging
+import numpy as np
+import tensorflow as tf
+
+from mrcnn import model as modellib
+
+
+############################################################
+#  Batch Norm Folding
+############################################################
+
+def batch_norm_conv_name(bn_name):
+    """Returns the name of the convolution layer that feeds the batch norm
+    layer of the given name, following the naming of the layers in
+    resnet_graph(), fpn_classifier_graph() and build_fpn_mask_graph(),
+    or None if the layer doesn't follow a convolution.
+    """
+    if bn_name == "bn_conv1":
+        return "conv1"
+    if bn_name.startswith("bn") and "_branch" in bn_name:
+        return "res" + bn_name[2:]
+    if bn_name.startswith("mrcnn_") and "_bn" in bn_name:
+        return bn_name.replace("_bn", "_conv")
+    return None
+
+
+def fold_batch_norm_weights(kernel, bias, gamma, beta, mean, variance, epsilon):
+    """Folds the parameters of a batch norm layer into the weights of the
+    convolution before it.
+
+    kernel: [height, width, in channels, out channels] convolution kernel
+    bias: [out channels] convolution bias
+    gamma, beta, mean, variance: [out channels] batch norm parameters
+
+    Returns the new kernel and bias. The convolution with them gives the
+    output of the batch norm layer.
+    """
+    scale = gamma / np.sqrt(variance + epsilon)
+    return kernel * scale, (bias - mean) * scale + beta
+
+
+def fold_batch_norms(keras_model):
+    """Folds the frozen batch norm layers of a Mask R-CNN Keras model into
+    the convolutions before them. The batch norm layers are then set to the
+    identity, so the model gives the same outputs, and freeze_graph() can
+    remove them.
+
+    The batch norm layers must be frozen (TRAIN_BN = False), as the model
+    must use the moving mean and variance.
+
+    Returns the number of folded layers.
+    """
+    layers = {layer.name: layer for layer in keras_model.layers}
+    folded = 0
+    for layer in keras_model.layers:
+        # Batch norm layers of the heads are wrapped in TimeDistributed
+        bn = getattr(layer, "layer", layer)
+        if not isinstance(bn, modellib.BatchNorm):
+            continue
+        conv_name = batch_norm_conv_name(layer.name)
+        conv = layers.get(conv_name)
+        if conv is None or not getattr(getattr(conv, "layer", conv), "use_bias", False):
+            logging.warning("Not folding batch norm layer %s", layer.name)
+            continue
+        kernel, bias = conv.get_weights()
+        gamma, beta, mean, variance = layer.get_weights()
+        conv.set_weights(fold_batch_norm_weights(kernel, bias, gamma, beta, mean, variance,
+                                                 bn.epsilon))
+        # Identity: (x - 0) / sqrt(1 - epsilon + epsilon) * 1 + 0
+        layer.set_weights([np.ones_like(gamma), np.zeros_like(beta),
+                           np.zeros_like(mean), np.ones_like(variance) - bn.epsilon])
+        folded += 1
+    return folded
+
+
+############################################################
+#  Export
+############################################################
+
+def metadata_path(graph_path):
+    """Returns the path of the metadata file of a frozen graph."""
+    return os.path.splitext(graph_path)[0] + ".json"
+
+
+def freeze_graph(model, graph_path):
+    """Exports a MaskRCNN inference model to a frozen graph.
+
+    The batch norm layers are folded into the convolutions, the variables
+    are converted to constants and only the ops that compute the detections
+    and the masks are kept. The names of the input and output tensors and
+    the batch size are written next to the graph, see metadata_path().
+    The weights of the model are modified, don't use it afterwards.
+
+    model: MaskRCNN in inference mode with its weights loaded
+    graph_path: Path of the frozen graph file (.pb)
+
+    Returns the metadata dict.
+    """
+    assert model.mode == "inference", "Export a model in inference mode."
+    assert not model.config.TRAIN_BN, "Batch norm layers must be frozen (TRAIN_BN = False)."
+    import keras.backend as K
+
+    folded = fold_batch_norms(model.keras_model)
+    # The inference model outputs [detections, mrcnn_class, mrcnn_bbox,
+    # mrcnn_mask, rois, rpn_class, rpn_bbox]. detect() uses two of them.
+    outputs = model.keras_model.outputs
+    output_names = [outputs[0].op.name, outputs[3].op.name]
+    session = K.get_session()
+    # Keeps only the ops the outputs depend on
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), output_names)
+    try:
+        # Remove the identity batch norm ops, and precompute constants
+        from tensorflow.tools.graph_transforms import TransformGraph
+        input_names = [t.op.name for t in model.keras_model.inputs]
+        graph_def = TransformGraph(graph_def, input_names, output_names, [
+            "fold_constants(ignore_errors=true)", "fold_batch_norms", "fold_old_batch_norms"])
+    except ImportError:
+        logging.warning("Graph transforms not available, keeping the identity batch norm ops")
+
+    directory = os.path.dirname(graph_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with tf.gfile.GFile(graph_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+    learning_phase = [n.name for n in graph_def.node if n.name == "keras_learning_phase"]
+    metadata = {
+        "inputs": [t.name for t in model.keras_model.inputs],
+        "detections": outputs[0].name,
+        "mrcnn_mask": outputs[3].name,
+        "learning_phase": learning_phase[0] + ":0" if learning_phase else None,
+        "batch_size": model.config.BATCH_SIZE,
+        "num_classes": model.config.NUM_CLASSES,
+        "channels": model.config.IMAGE_CHANNEL_COUNT,
+        "mask_classes": model.config.MASK_CLASSES,
+        "folded_batch_norms": folded,
+    }
+    with open(metadata_path(graph_path), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+############################################################
+#  Frozen Graph Predictor
+############################################################
+
+class FrozenMaskRCNN(modellib.MaskRCNN):
+    """Runs a graph exported by freeze_graph() with the detection API of
+    MaskRCNN: detect(), detect_batch() and detect_molded(). The inputs are
+    molded and the outputs unmolded with the given config, as by MaskRCNN.
+
+    There is no Keras model, so it can't be trained and the weights can't
+    be loaded or changed.
+    """
+
+    def __init__(self, graph_path, config):
+        """
+        graph_path: Path of a frozen graph written by freeze_graph()
+        config: A Sub-class of the Config class, with the batch size of
+            the exported graph.
+        """
+        with open(metadata_path(graph_path)) as f:
+            self.metadata = json.load(f)
+        assert config.BATCH_SIZE == self.metadata["batch_size"], \
+            "The graph was exported with batch size {}, the config has {}".format(
+                self.metadata["batch_size"], config.BATCH_SIZE)
+        assert config.NUM_CLASSES == self.metadata["num_classes"], \
+            "The graph was exported with {} classes, the config has {}".format(
+                self.metadata["num_classes"], config.NUM_CLASSES)
+        assert config.IMAGE_CHANNEL_COUNT == self.metadata.get("channels", 3), \
+            "The graph was exported for {} channels, the config has {}".format(
+                self.metadata.get("channels", 3), config.IMAGE_CHANNEL_COUNT)
+        mask_classes = self.metadata.get("mask_classes")
+        assert (list(config.MASK_CLASSES) if config.MASK_CLASSES else None) == mask_classes, \
+            "The graph was exported with MASK_CLASSES {}, the config has {}".format(
+                mask_classes, config.MASK_CLASSES)
+        self.mode = "inference"
+        self.config = config
+        self.graph_path = graph_path
+        self.keras_model = None
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        session_config = tf.ConfigProto()
+        session_config.gpu_options.allow_growth = True
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        self.inputs = [self.graph.get_tensor_by_name(name) for name in self.metadata["inputs"]]
+        self.outputs = [self.graph.get_tensor_by_name(self.metadata["detections"]),
+                        self.graph.get_tensor_by_name(self.metadata["mrcnn_mask"])]
+        self.feed = {}
+        if self.metadata.get("learning_phase"):
+            self.feed[self.graph.get_tensor_by_name(self.metadata["learning_phase"])] = False
+
+    def predict_detections(self, molded_images, image_metas, with_masks=True):
+        feed = dict(self.feed)
+        feed.update(zip(self.inputs, [molded_images, image_metas]))
+        if len(self.inputs) > 2:
+            # Graphs exported before the anchors were generated in the graph
+            anchors = self.get_anchors(molded_images[0].shape)
+            feed[self.inputs[2]] = np.broadcast_to(anchors, (len(molded_images),) + anchors.shape)
+        if not with_masks:
+            # Only the ops the detections depend on are run
+            return self.session.run(self.outputs[0], feed_dict=feed), None
+        detections, mrcnn_mask = self.session.run(self.outputs, feed_dict=feed)
+        return detections, mrcnn_mask
+
+    def close(self):
+        """Releases the TensorFlow session."""
+        self.session.close()
@@ -0,0 +1,269 @@
+"""
+Mask R-CNN
+Cache of the preprocessed training data, read by data_generator().
+
+load_image_gt() decodes the image, rasterizes the masks, resizes both,
+extracts the bounding boxes and shrinks the masks to mini masks, and all
+of it gives the same result every epoch. write_cache() runs it once per
+image and saves the results to shard files, which data_generator() then
+memory-maps and reads without any decoding. Only the augmentation, if any,
+is still applied at each step.
+
+The cache is keyed by a hash of the config settings and the dataset that
+the data depends on, including the modification time and size of each
+image file, so a changed config, annotation or image file reads another
+cache. An image file rewritten with the same size within the resolution
+of the file system's modification times goes unnoticed; write the cache
+again after such changes.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+from mrcnn import utils
+from mrcnn import model as modellib
+
+
+# Increase when the layout of the files changes
+CACHE_VERSION = 2
+
+# Arrays of each shard. The instances of all the images of a shard are
+# concatenated, instances[i]:instances[i + 1] are those of image i.
+SHARD_ARRAYS = ["image", "image_meta", "instances", "class_ids", "bbox", "mask"]
+
+
+############################################################
+#  Cache Key
+############################################################
+
+def file_stats(dataset):
+    """Returns the modification time and size of the image file of each
+    image of the dataset, as [path, mtime, size] lists, or None for images
+    that have no file.
+    """
+    stats = []
+    for info in dataset.image_info:
+        path = info.get("path")
+        if isinstance(path, str) and os.path.isfile(path):
+            stat = os.stat(path)
+            stats.append([path, stat.st_mtime_ns, stat.st_size])
+        else:
+            stats.append(None)
+    return stats
+
+
+def cache_key(config, dataset):
+    """Returns a hash of the config settings and the dataset that the
+    outputs of load_image_gt() depend on, see file_stats().
+    """
+    settings = {
+        "version": CACHE_VERSION,
+        "image_resize_mode": config.IMAGE_RESIZE_MODE,
+        "image_min_dim": config.IMAGE_MIN_DIM,
+        "image_max_dim": config.IMAGE_MAX_DIM,
+        "image_min_scale": config.IMAGE_MIN_SCALE,
+        "image_channel_count": config.IMAGE_CHANNEL_COUNT,
+        "use_mini_mask": config.USE_MINI_MASK,
+        "mini_mask_shape": list(config.MINI_MASK_SHAPE),
+        "mini_mask_from_polygons": config.MINI_MASK_FROM_POLYGONS,
+        "class_info": dataset.class_info,
+        # Paths and annotations, e.g. the polygons of the masks
+        "image_info": dataset.image_info,
+        "files": file_stats(dataset),
+    }
+    # Arrays, e.g. polygons, as lists: str() shortens long arrays
+    text = json.dumps(settings, sort_keys=True,
+                      default=lambda o: o.tolist() if isinstance(o, np.ndarray) else str(o))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_path(cache_dir, config, dataset):
+    """Returns the directory of the cache of the config and dataset."""
+    return os.path.join(cache_dir, cache_key(config, dataset))
+
+
+############################################################
+#  Writing
+############################################################
+
+def write_cache(dataset, config, cache_dir, shard_size=256, full_masks=False, verbose=1):
+    """Runs load_image_gt() on all the images of the dataset, without
+    augmentation, and saves the results to the cache.
+
+    dataset: The Dataset object, prepared
+    config: The training config. The images must all have the same shape
+        after resizing, as with the "square" resize mode.
+    cache_dir: Directory of the caches. The cache is written to a
+        sub-directory named by cache_key().
+    shard_size: Number of images per shard file
+    full_masks: Also store the masks at the size of the image, bit packed,
+        so that augmentation can be applied on top of the cache. Without
+        them, images with augmentation are loaded without the cache.
+
+    Returns the path of the cache.
+    """
+    assert config.IMAGE_RESIZE_MODE != "crop", "Random crops can't be cached"
+    path = cache_path(cache_dir, config, dataset)
+    if os.path.exists(os.path.join(path, "index.json")):
+        if verbose:
+            print("Cache is up to date: {}".format(path))
+        return path
+
+    # Write to a temporary directory and rename it when complete
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+
+    image_ids = list(dataset.image_ids)
+    shards = []
+    for start in range(0, len(image_ids), shard_size):
+        shard_ids = image_ids[start:start + shard_size]
+        arrays = {name: [] for name in SHARD_ARRAYS + ["full_mask"]}
+        count = 0
+        for image_id in shard_ids:
+            # The full size masks are needed for augmentation, which never
+            # rasterizes the masks from polygons
+            image, image_meta, class_ids, bbox, mask = modellib.load_image_gt(
+                dataset, config, image_id,
+                use_mini_mask=config.USE_MINI_MASK and not full_masks)
+            if arrays["image"]:
+                assert image.shape == arrays["image"][0].shape, \
+                    "All the images must have the same shape to be cached"
+            if full_masks:
+                arrays["full_mask"].append(np.packbits(np.moveaxis(mask, -1, 0), axis=-1))
+                if config.USE_MINI_MASK:
+                    # As done by load_image_gt()
+                    mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+            arrays["image"].append(image)
+            arrays["image_meta"].append(image_meta)
+            arrays["instances"].append(count)
+            arrays["class_ids"].append(class_ids.astype(np.int32))
+            arrays["bbox"].append(bbox.astype(np.int32))
+            # Instances first, so the instances of an image are contiguous
+            arrays["mask"].append(np.moveaxis(mask, -1, 0))
+            count += len(class_ids)
+        arrays["instances"].append(count)
+
+        name = "shard_{:05d}".format(len(shards))
+        stacked = {
+            "image": np.stack(arrays["image"]),
+            "image_meta": np.stack(arrays["image_meta"]),
+            "instances": np.array(arrays["instances"], dtype=np.int64),
+            "class_ids": np.concatenate(arrays["class_ids"]),
+            "bbox": np.concatenate(arrays["bbox"]),
+            "mask": np.concatenate(arrays["mask"]).astype(np.bool),
+        }
+        if full_masks:
+            stacked["full_mask"] = np.concatenate(arrays["full_mask"])
+        for key, value in stacked.items():
+            np.save(os.path.join(temp_path, "{}_{}.npy".format(name, key)), value)
+        shards.append({"name": name, "image_ids": [int(i) for i in shard_ids]})
+        if verbose:
+            print("Cached {}/{} images".format(start + len(shard_ids), len(image_ids)))
+
+    index = {
+        "key": os.path.basename(path),
+        "version": CACHE_VERSION,
+        "use_mini_mask": config.USE_MINI_MASK,
+        "full_masks": full_masks,
+        "image_shape": [int(d) for d in stacked["image"].shape[1:]] if image_ids else None,
+        "shards": shards,
+    }
+    with open(os.path.join(temp_path, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+    return path
+
+
+############################################################
+#  Reading
+############################################################
+
+class GTCache(object):
+    """Reads a cache written by write_cache(). The shard files are
+    memory-mapped, so the worker processes of data_generator() share the
+    pages, and nothing is read before it's used.
+    """
+
+    def __init__(self, path):
+        """
+        path: Directory of the cache, see cache_path()
+        """
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        assert self.index["version"] == CACHE_VERSION, "Cache of an older version, write it again"
+        self.path = path
+        self.use_mini_mask = self.index["use_mini_mask"]
+        self.full_masks = self.index["full_masks"]
+        self.image_shape = self.index["image_shape"]
+        # image_id -> (shard, position in the shard)
+        self.locations = {}
+        for shard, info in enumerate(self.index["shards"]):
+            for position, image_id in enumerate(info["image_ids"]):
+                self.locations[image_id] = (shard, position)
+        self._shards = {}
+
+    @classmethod
+    def open(cls, cache_dir, config, dataset):
+        """Returns the GTCache of the config and dataset, or None if there
+        is none in cache_dir.
+        """
+        path = cache_path(cache_dir, config, dataset)
+        if not os.path.exists(os.path.join(path, "index.json")):
+            logging.warning("No training cache in %s, run write_cache() to create it", path)
+            return None
+        return cls(path)
+
+    def __contains__(self, image_id):
+        return int(image_id) in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def shard(self, shard):
+        """Returns the memory-mapped arrays of the shard of the given
+        number, by name.
+        """
+        if shard not in self._shards:
+            name = self.index["shards"][shard]["name"]
+            names = SHARD_ARRAYS + (["full_mask"] if self.full_masks else [])
+            self._shards[shard] = {
+                key: np.load(os.path.join(self.path, "{}_{}.npy".format(name, key)), mmap_mode="r")
+                for key in names}
+        return self._shards[shard]
+
+    def load(self, image_id):
+        """Returns the outputs of load_image_gt() without augmentation:
+        image, image_meta, class_ids, bbox, mask. The arrays are read-only
+        views of the cache.
+        """
+        shard, i = self.locations[int(image_id)]
+        arrays = self.shard(shard)
+        start, end = arrays["instances"][i:i + 2]
+        mask = np.moveaxis(arrays["mask"][start:end], 0, -1)
+        return (arrays["image"][i], arrays["image_meta"][i], arrays["class_ids"][start:end],
+                arrays["bbox"][start:end], mask)
+
+    def load_resized(self, image_id):
+        """Returns the image and the masks of an image after resizing and
+        before augmentation, as load_image_gt() augments them: image,
+        image_meta, class_ids, mask [height, width, instances]. Needs a
+        cache written with full_masks.
+        """
+        assert self.full_masks, "The cache has no full size masks"
+        shard, i = self.locations[int(image_id)]
+        arrays = self.shard(shard)
+        start, end = arrays["instances"][i:i + 2]
+        width = self.image_shape[1]
+        mask = np.unpackbits(arrays["full_mask"][start:end], axis=-1)[..., :width]
+        return (np.array(arrays["image"][i]), arrays["image_meta"][i],
+                np.array(arrays["class_ids"][start:end]), np.moveaxis(mask, 0, -1).astype(np.bool))
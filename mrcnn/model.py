@@ -8,10 +8,12 @@ Written by Waleed Abdulla
 """
 
 import os
+import json
 import random
 import datetime
 import re
 import math
+import hashlib
 import logging
 from collections import OrderedDict
 import multiprocessing
@@ -85,6 +87,57 @@ def compute_backbone_shapes(config, image_shape):
             for stride in config.BACKBONE_STRIDES])
 
 
+# Anchors returned by pyramid_anchors(), by cache key
+_anchor_cache = {}
+
+
+def pyramid_anchors(config, image_shape):
+    """Returns the anchor pyramid of an image shape in pixel coordinates,
+    as generated by utils.generate_pyramid_anchors().
+
+    The anchors are cached by the image shape and the anchor settings of the
+    config. If config.ANCHOR_CACHE_DIR is set, they are also saved to a file
+    there and memory-mapped, so the data generator workers and the inference
+    processes share one read-only copy instead of each generating its own.
+
+    Returns: [anchor_count, (y1, x1, y2, x2)]
+    """
+    backbone_shapes = compute_backbone_shapes(config, image_shape)
+    settings = [[int(d) for d in image_shape[:2]],
+                [float(s) for s in config.RPN_ANCHOR_SCALES],
+                [float(r) for r in config.RPN_ANCHOR_RATIOS],
+                np.asarray(backbone_shapes).tolist(),
+                [int(s) for s in config.BACKBONE_STRIDES],
+                int(config.RPN_ANCHOR_STRIDE)]
+    key = hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()[:16]
+    if key in _anchor_cache:
+        return _anchor_cache[key]
+
+    path = None
+    if config.ANCHOR_CACHE_DIR:
+        path = os.path.join(config.ANCHOR_CACHE_DIR, "anchors_{}.npy".format(key))
+    if path and os.path.exists(path):
+        anchors = np.load(path, mmap_mode="r")
+    else:
+        anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                 config.RPN_ANCHOR_RATIOS,
+                                                 backbone_shapes,
+                                                 config.BACKBONE_STRIDES,
+                                                 config.RPN_ANCHOR_STRIDE)
+        if path:
+            if not os.path.exists(config.ANCHOR_CACHE_DIR):
+                os.makedirs(config.ANCHOR_CACHE_DIR, exist_ok=True)
+            # Write to a temporary file and rename it, so other processes
+            # never read a partly written file
+            temp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(temp_path, "wb") as f:
+                np.save(f, anchors)
+            os.replace(temp_path, path)
+            anchors = np.load(path, mmap_mode="r")
+    _anchor_cache[key] = anchors
+    return anchors
+
+
 ############################################################
 #  Resnet Graph
 ############################################################
@@ -953,6 +1006,28 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     return mrcnn_class_logits, mrcnn_probs, mrcnn_bbox
 
 
+def mask_class_boxes_graph(detections, mask_classes):
+    """Selects the boxes of the detections that need masks.
+
+    detections: [batch, N, (y1, x1, y2, x2, class_id, score)]
+    mask_classes: List of the class IDs that need masks.
+
+    Returns: [batch, K, (y1, x1, y2, x2)] The boxes of the detections of
+    mask_classes in the order of the detections. K is the largest number of
+    such detections of an image in the batch, at least 1. Zero padded.
+    """
+    class_ids = tf.cast(detections[..., 4], tf.int32)
+    needs_mask = tf.reduce_any(tf.equal(tf.expand_dims(class_ids, -1),
+                                        tf.constant(mask_classes, dtype=tf.int32)), axis=-1)
+    # A stable sort moves them to the front and keeps their order
+    order = tf.argsort(tf.cast(tf.logical_not(needs_mask), tf.int32), axis=1, stable=True)
+    count = tf.maximum(tf.reduce_max(tf.reduce_sum(tf.cast(needs_mask, tf.int32), axis=1)), 1)
+    order = order[:, :count]
+    boxes = tf.gather(detections[..., :4], order, batch_dims=1)
+    valid = tf.cast(tf.gather(needs_mask, order, batch_dims=1), tf.float32)
+    return boxes * tf.expand_dims(valid, -1)
+
+
 def build_fpn_mask_graph(rois, feature_maps, image_meta,
                          pool_size, num_classes, train_bn=True):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
@@ -1184,7 +1259,7 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 ############################################################
 
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
-                  use_mini_mask=False):
+                  use_mini_mask=False, cache=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augment: (deprecated. Use augmentation instead). If true, apply random
@@ -1197,9 +1272,11 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    cache: Optional. A gt_cache.GTCache to read the image from, if it's
+        in the cache, instead of loading and resizing it.
 
     Returns:
-    image: [height, width, 3]
+    image: [height, width, IMAGE_CHANNEL_COUNT]
     shape: the original shape of the image before resizing and cropping.
     class_ids: [instance_count] Integer class IDs
     bbox: [instance_count, (y1, x1, y2, x2)]
@@ -1207,25 +1284,50 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
-    original_shape = image.shape
-    image, window, scale, padding, crop = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        min_scale=config.IMAGE_MIN_SCALE,
-        max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    # Read the resized image and mask from the cache. Without augmentation,
+    # the cache has the final outputs.
+    image_meta = None
+    if cache is not None and image_id in cache:
+        if not (augment or augmentation) and use_mini_mask == cache.use_mini_mask:
+            return cache.load(image_id)
+        if cache.full_masks:
+            image, image_meta, class_ids, mask = cache.load_resized(image_id)
+
+    # Polygons of the instances, if the dataset has them, to rasterize at
+    # the mini mask size. Not with imgaug augmentation, which needs masks.
+    polygons = None
+    if image_meta is None:
+        # Load image and mask. Grayscale models load a single channel.
+        if config.IMAGE_CHANNEL_COUNT == 3:
+            image = dataset.load_image(image_id)
+        else:
+            image = dataset.load_image(image_id, channels=config.IMAGE_CHANNEL_COUNT)
+        if use_mini_mask and config.MINI_MASK_FROM_POLYGONS and not augmentation:
+            polygons = dataset.load_polygons(image_id)
+        if polygons is not None:
+            polygons, class_ids = polygons
+        else:
+            mask, class_ids = dataset.load_mask(image_id)
+        original_shape = image.shape
+        image, window, scale, padding, crop = utils.resize_image(
+            image,
+            min_dim=config.IMAGE_MIN_DIM,
+            min_scale=config.IMAGE_MIN_SCALE,
+            max_dim=config.IMAGE_MAX_DIM,
+            mode=config.IMAGE_RESIZE_MODE)
+        if polygons is None:
+            mask = utils.resize_mask(mask, scale, padding, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
+    flip = False
     if augment:
         logging.warning("'augment' is deprecated. Use 'augmentation' instead.")
         if random.randint(0, 1):
+            flip = True
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            if polygons is None:
+                mask = np.fliplr(mask)
 
     # Augmentation
     # This requires the imgaug lib (https://github.com/aleju/imgaug)
@@ -1258,15 +1360,27 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         # Change mask back to bool
         mask = mask.astype(np.bool)
 
-    # Note that some boxes might be all zeros if the corresponding mask got cropped out.
-    # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
-    mask = mask[:, :, _idx]
-    class_ids = class_ids[_idx]
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+    if polygons is not None:
+        # Boxes and mini masks straight from the polygons
+        offset = (padding[0][0] - (crop[0] if crop else 0),
+                  padding[1][0] - (crop[1] if crop else 0))
+        bbox, mask = utils.polygons_to_mini_masks(polygons, scale, offset, image.shape,
+                                                  config.MINI_MASK_SHAPE, flip=flip)
+        # Filter out the instances that are outside of the image
+        _idx = np.any(bbox, axis=1)
+        bbox = bbox[_idx]
+        mask = mask[:, :, _idx]
+        class_ids = np.asarray(class_ids)[_idx]
+    else:
+        # Note that some boxes might be all zeros if the corresponding mask got cropped out.
+        # and here is to filter them out
+        _idx = np.sum(mask, axis=(0, 1)) > 0
+        mask = mask[:, :, _idx]
+        class_ids = class_ids[_idx]
+        # Bounding boxes. Note that some boxes might be all zeros
+        # if the corresponding mask got cropped out.
+        # bbox: [num_instances, (y1, x1, y2, x2)]
+        bbox = utils.extract_bboxes(mask)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1276,12 +1390,13 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     active_class_ids[source_class_ids] = 1
 
     # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
+    if use_mini_mask and polygons is None:
         mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
-    image_meta = compose_image_meta(image_id, original_shape, image.shape,
-                                    window, scale, active_class_ids)
+    if image_meta is None:
+        image_meta = compose_image_meta(image_id, original_shape, image.shape,
+                                        window, scale, active_class_ids)
 
     return image, image_meta, class_ids, bbox, mask
 
@@ -1442,19 +1557,28 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config, anchor_index=None,
+                      random_state=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional. utils.AnchorGridIndex of the anchors. Build it
+        once and pass it when calling this for many images.
+    random_state: Optional. np.random.RandomState to subsample the anchors
+        with, instead of the global one of np.random.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    if anchor_index is None:
+        anchor_index = utils.AnchorGridIndex(anchors)
+    if random_state is None:
+        random_state = np.random
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
     # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
@@ -1470,16 +1594,35 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        # Max overlap of each anchor with the crowd boxes
+        crowd_iou_max = np.zeros([anchors.shape[0]])
+        for box in crowd_boxes:
+            ids, iou = anchor_index.overlaps(box)
+            crowd_iou_max[ids] = np.maximum(crowd_iou_max[ids], iou)
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Max overlap of each anchor with the GT boxes, and the GT box of it.
+    # Only the anchors near each GT box are scored, the others have an IoU
+    # of 0 with it.
+    anchor_iou_max = np.zeros([anchors.shape[0]])
+    anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+    # Anchors with the max overlap of each GT box
+    gt_iou_argmax = []
+    for i, box in enumerate(gt_boxes):
+        ids, iou = anchor_index.overlaps(box)
+        # Strictly greater, so ties go to the first GT box, as with np.argmax()
+        greater = iou > anchor_iou_max[ids]
+        anchor_iou_max[ids[greater]] = iou[greater]
+        anchor_iou_argmax[ids[greater]] = i
+        if len(iou) and iou.max() > 0:
+            gt_iou_argmax.append(ids[iou == iou.max()])
+        else:
+            # The box doesn't intersect any anchor: all the anchors have
+            # the max overlap of 0
+            gt_iou_argmax.append(np.arange(anchors.shape[0]))
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1491,13 +1634,11 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:,0]
-    rpn_match[gt_iou_argmax] = 1
+    for ids in gt_iou_argmax:
+        rpn_match[ids] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
 
@@ -1507,7 +1648,7 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
     if extra > 0:
         # Reset the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = random_state.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
     # Same for negative proposals
     ids = np.where(rpn_match == -1)[0]
@@ -1515,40 +1656,16 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
                         np.sum(rpn_match == 1))
     if extra > 0:
         # Rest the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = random_state.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes (closest GT box, it might have
+    # IoU < 0.7), and normalize.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    deltas = utils.box_refinement(anchors[ids], gt_boxes[anchor_iou_argmax[ids]],
+                                  dtype=np.float64)
+    rpn_bbox[:len(ids)] = deltas / config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
@@ -1627,9 +1744,81 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     return rois
 
 
+def training_samples(image_ids, shuffle=True, seed=None):
+    """Generates the images to train on, epoch after epoch, and the seed of
+    the random state of each.
+
+    image_ids: The image IDs of the dataset
+    shuffle: If True, shuffles the images before every epoch
+    seed: Optional. If given, the shuffling is seeded and each image gets
+        its own seed for a np.random.RandomState. The random draws of an
+        image then don't depend on the order the images are processed in.
+        Otherwise, the global state of np.random is used.
+
+    Returns a Python generator of (image_id, image_seed) tuples. The
+    image_seed is None without a seed.
+    """
+    image_ids = np.copy(image_ids)
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    while True:
+        if shuffle:
+            rng.shuffle(image_ids)
+        for image_id in image_ids:
+            yield image_id, None if seed is None else rng.randint(2 ** 31)
+
+
+def load_train_inputs(dataset, config, image_id, anchors, anchor_index=None, augment=False,
+                      augmentation=None, cache=None, random_state=None):
+    """Loads an image and its ground truth, and builds its RPN targets: the
+    work done by data_generator() for each image.
+
+    anchors: [anchor_count, (y1, x1, y2, x2)] from pyramid_anchors()
+    anchor_index: Optional. utils.AnchorGridIndex of the anchors
+    augment, augmentation: See load_image_gt()
+    cache: Optional. A gt_cache.GTCache, see load_image_gt()
+    random_state: Optional. np.random.RandomState for the sampling of the
+        anchors and instances, see training_samples().
+
+    Returns None if the image has no instances to train on. Otherwise:
+    image: [height, width, channels] The image, not molded
+    image_meta: Image details, see compose_image_meta()
+    gt_class_ids: [instance_count] Integer class IDs, at most MAX_GT_INSTANCES
+    gt_boxes: [instance_count, (y1, x1, y2, x2)]
+    gt_masks: [height, width, instance_count], see load_image_gt()
+    rpn_match: [anchor_count] See build_rpn_targets()
+    rpn_bbox: [RPN_TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
+    """
+    if random_state is None:
+        random_state = np.random
+    image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+        load_image_gt(dataset, config, image_id, augment=augment,
+                      augmentation=augmentation,
+                      use_mini_mask=config.USE_MINI_MASK, cache=cache)
+
+    # Skip images that have no instances. This can happen in cases
+    # where we train on a subset of classes and the image doesn't
+    # have any of the classes we care about.
+    if not np.any(gt_class_ids > 0):
+        return None
+
+    # RPN Targets
+    rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
+                                            gt_class_ids, gt_boxes, config,
+                                            anchor_index, random_state)
+
+    # If more instances than fits in the array, sub-sample from them.
+    if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+        ids = random_state.choice(
+            np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+        gt_class_ids = gt_class_ids[ids]
+        gt_boxes = gt_boxes[ids]
+        gt_masks = gt_masks[:, :, ids]
+    return image, image_meta, gt_class_ids, gt_boxes, gt_masks, rpn_match, rpn_bbox
+
+
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None, seed=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1651,6 +1840,9 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    seed: Optional. Seeds the shuffling and the sampling of the anchors and
+        instances, see training_samples(). input_pipeline() with the same
+        seed gives the same batches, without augmentation.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
@@ -1671,52 +1863,43 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
         and masks.
     """
     b = 0  # batch item index
-    image_index = -1
-    image_ids = np.copy(dataset.image_ids)
+    samples = training_samples(dataset.image_ids, shuffle, seed)
     error_count = 0
     no_augmentation_sources = no_augmentation_sources or []
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors = pyramid_anchors(config, config.IMAGE_SHAPE)
+    # Finds the anchors near the GT boxes in build_rpn_targets()
+    anchor_index = utils.AnchorGridIndex(anchors)
+
+    # Preprocessed images and targets, see mrcnn.gt_cache
+    cache = None
+    if config.GT_CACHE_DIR:
+        from mrcnn.gt_cache import GTCache
+        cache = GTCache.open(config.GT_CACHE_DIR, config, dataset)
 
     # Keras requires a generator to run indefinitely.
     while True:
         try:
-            # Increment index to pick next image. Shuffle if at the start of an epoch.
-            image_index = (image_index + 1) % len(image_ids)
-            if shuffle and image_index == 0:
-                np.random.shuffle(image_ids)
-
-            # Get GT bounding boxes and masks for image.
-            image_id = image_ids[image_index]
+            # Next image, shuffled at the start of an epoch
+            image_id, image_seed = next(samples)
+            random_state = None if image_seed is None else np.random.RandomState(image_seed)
 
+            # Get GT bounding boxes and masks for image, and RPN targets.
             # If the image source is not to be augmented pass None as augmentation
             if dataset.image_info[image_id]['source'] in no_augmentation_sources:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=None,
-                              use_mini_mask=config.USE_MINI_MASK)
+                inputs = load_train_inputs(dataset, config, image_id, anchors, anchor_index,
+                                           augment=augment, augmentation=None,
+                                           cache=cache, random_state=random_state)
             else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                    load_image_gt(dataset, config, image_id, augment=augment,
-                                augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
-
-            # Skip images that have no instances. This can happen in cases
-            # where we train on a subset of classes and the image doesn't
-            # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
+                inputs = load_train_inputs(dataset, config, image_id, anchors, anchor_index,
+                                           augment=augment, augmentation=augmentation,
+                                           cache=cache, random_state=random_state)
+            # No instances
+            if inputs is None:
                 continue
-
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
+            image, image_meta, gt_class_ids, gt_boxes, gt_masks, rpn_match, rpn_bbox = inputs
 
             # Mask R-CNN Targets
             if random_rois:
@@ -1757,14 +1940,6 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                         batch_mrcnn_mask = np.zeros(
                             (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
 
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-
             # Add to batch
             batch_image_meta[b] = image_meta
             batch_rpn_match[b] = rpn_match[:, np.newaxis]
@@ -1813,6 +1988,119 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+def input_pipeline(dataset, config, shuffle=True, augment=False, augmentation=None,
+                   batch_size=1, no_augmentation_sources=None, num_parallel_calls=None,
+                   prefetch=2, seed=None):
+    """A tf.data input pipeline that gives the same batches as
+    data_generator() with the default arguments: an index dataset of the
+    images to train on, a parallel map that loads them and builds their RPN
+    targets with load_train_inputs(), batching and prefetching.
+
+    The images are loaded by TensorFlow threads in the process of the
+    model, so there is no generator shared between processes and nothing
+    is pickled. The map keeps the order of the images.
+
+    num_parallel_calls: Number of images loaded in parallel. Defaults to the
+        number of CPUs.
+    prefetch: Number of batches prepared ahead of the training step
+    seed: Optional. See training_samples(). With a seed, the batches are
+        the same as those of data_generator() with the same seed, as long as
+        there is no augmentation, whatever the number of parallel calls.
+    See data_generator() for the other arguments.
+
+    Returns a tf.data.Dataset of the inputs of data_generator():
+    (images, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes,
+    gt_masks). Run it with pipeline_generator().
+    """
+    no_augmentation_sources = no_augmentation_sources or []
+    num_parallel_calls = num_parallel_calls or multiprocessing.cpu_count()
+    anchors = pyramid_anchors(config, config.IMAGE_SHAPE)
+    anchor_index = utils.AnchorGridIndex(anchors)
+    cache = None
+    if config.GT_CACHE_DIR:
+        from mrcnn.gt_cache import GTCache
+        cache = GTCache.open(config.GT_CACHE_DIR, config, dataset)
+
+    # Shapes and types of the inputs of one image, as in data_generator()
+    mask_shape = config.MINI_MASK_SHAPE if config.USE_MINI_MASK else config.IMAGE_SHAPE[:2]
+    specs = [
+        (config.IMAGE_SHAPE, np.float32),
+        ([config.IMAGE_META_SIZE], np.float64),
+        ([anchors.shape[0], 1], np.int32),
+        ([config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], np.float64),
+        ([config.MAX_GT_INSTANCES], np.int32),
+        ([config.MAX_GT_INSTANCES, 4], np.int32),
+        (list(mask_shape) + [config.MAX_GT_INSTANCES], np.bool),
+    ]
+    error_count = [0]
+
+    def load(image_id, image_seed):
+        """Returns the padded inputs of the image, and whether it has any
+        instances to train on.
+        """
+        random_state = None if image_seed < 0 else np.random.RandomState(image_seed)
+        source = dataset.image_info[image_id]['source']
+        try:
+            inputs = load_train_inputs(
+                dataset, config, image_id, anchors, anchor_index, augment=augment,
+                augmentation=None if source in no_augmentation_sources else augmentation,
+                cache=cache, random_state=random_state)
+        except Exception:
+            # Log it and skip the image
+            logging.exception("Error processing image {}".format(dataset.image_info[image_id]))
+            error_count[0] += 1
+            if error_count[0] > 5:
+                raise
+            inputs = None
+        padded = [np.zeros(shape, dtype=dtype) for shape, dtype in specs]
+        if inputs is None:
+            return padded + [False]
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks, rpn_match, rpn_bbox = inputs
+        padded[0][:] = mold_image(image.astype(np.float32), config)
+        padded[1][:] = image_meta
+        padded[2][:] = rpn_match[:, np.newaxis]
+        padded[3][:] = rpn_bbox
+        padded[4][:gt_class_ids.shape[0]] = gt_class_ids
+        padded[5][:gt_boxes.shape[0]] = gt_boxes
+        padded[6][:, :, :gt_masks.shape[-1]] = gt_masks
+        return padded + [True]
+
+    def load_graph(image_id, image_seed):
+        outputs = tf.py_func(load, [image_id, image_seed],
+                             [tf.as_dtype(dtype) for _, dtype in specs] + [tf.bool],
+                             stateful=True)
+        for output, (shape, _) in zip(outputs, specs):
+            output.set_shape(shape)
+        outputs[-1].set_shape([])
+        return tuple(outputs)
+
+    def samples():
+        # -1 for no seed
+        for image_id, image_seed in training_samples(dataset.image_ids, shuffle, seed):
+            yield image_id, -1 if image_seed is None else image_seed
+
+    pipeline = tf.data.Dataset.from_generator(samples, (tf.int64, tf.int64), ([], []))
+    pipeline = pipeline.map(load_graph, num_parallel_calls=num_parallel_calls)
+    # Skip the images without instances
+    pipeline = pipeline.filter(lambda *inputs: inputs[-1])
+    pipeline = pipeline.map(lambda *inputs: inputs[:-1])
+    pipeline = pipeline.batch(batch_size, drop_remainder=True)
+    return pipeline.prefetch(prefetch)
+
+
+def pipeline_generator(pipeline, session=None):
+    """Runs a pipeline of input_pipeline() and generates its batches as
+    data_generator() does, for Keras fit_generator().
+
+    session: The TensorFlow session to run the pipeline in. Defaults to the
+        Keras session.
+    """
+    session = session or K.get_session()
+    batch = pipeline.make_one_shot_iterator().get_next()
+    while True:
+        yield list(session.run(batch)), []
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1885,9 +2173,6 @@ class MaskRCNN():
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
-            # Anchors in normalized coordinates
-            input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
         # Build the shared convolutional layers.
         # Bottom-up Layers
@@ -1924,16 +2209,10 @@ class MaskRCNN():
         rpn_feature_maps = [P2, P3, P4, P5, P6]
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
-        # Anchors
-        if mode == "training":
-            anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
-            # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
-        else:
-            anchors = input_anchors
+        # Anchors in normalized coordinates, generated in the graph from
+        # the shapes of the feature maps, so they aren't fed with each batch
+        anchors = KL.Lambda(lambda x: pyramid_anchors_graph(x[1:], x[0], config),
+                            name="anchors")([input_image] + rpn_feature_maps)
 
         # RPN Model
         rpn = build_rpn_model(config.RPN_ANCHOR_STRIDE,
@@ -2043,18 +2322,29 @@ class MaskRCNN():
             detections = DetectionLayer(config, name="mrcnn_detection")(
                 [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta])
 
-            # Create masks for detections
-            detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
+            # Create masks for detections, or only for the detections of
+            # MASK_CLASSES. The masks are then in the order of those
+            # detections, see unmold_detections().
+            if config.MASK_CLASSES:
+                detection_boxes = KL.Lambda(
+                    lambda x: mask_class_boxes_graph(x, config.MASK_CLASSES),
+                    name="mrcnn_mask_boxes")(detections)
+            else:
+                detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
             mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
                                               train_bn=config.TRAIN_BN)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            model = KM.Model([input_image, input_image_meta],
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
+            # The same layers without the mask branch, for detect() with
+            # with_masks=False. Shares the weights of the full model.
+            self.box_model = KM.Model([input_image, input_image_meta],
+                                      detections, name='mask_rcnn_boxes')
 
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
@@ -2125,11 +2415,32 @@ class MaskRCNN():
         # Exclude some layers
         if exclude:
             layers = filter(lambda l: l.name not in exclude, layers)
+        layers = list(layers)
+
+        # The first convolution of RGB weights is adapted to the channels
+        # of the model, see adapt_input_channels()
+        conv1 = None
+        conv1_layers = [l for l in layers if l.name == "conv1"]
+        if by_name and conv1_layers and "conv1" in f:
+            g = f["conv1"]
+            weight_names = [n.decode("utf8") if hasattr(n, "decode") else n
+                            for n in g.attrs["weight_names"]]
+            weights = [np.asarray(g[n]) for n in weight_names]
+            if weights and weights[0].shape[2] != self.config.IMAGE_CHANNEL_COUNT:
+                conv1 = conv1_layers[0]
+                kernel, bias = adapt_input_channels(
+                    weights[0], self.config.IMAGE_CHANNEL_COUNT,
+                    bias=weights[1] if len(weights) > 1 else None,
+                    rgb_mean_pixel=self.config.RGB_MEAN_PIXEL, mean_pixel=self.config.MEAN_PIXEL)
+                conv1_weights = [kernel] + ([bias] if bias is not None else []) + weights[2:]
+                layers.remove(conv1)
 
         if by_name:
             saving.load_weights_from_hdf5_group_by_name(f, layers)
         else:
             saving.load_weights_from_hdf5_group(f, layers)
+        if conv1 is not None:
+            conv1.set_weights(conv1_weights)
         if hasattr(f, 'close'):
             f.close()
 
@@ -2274,7 +2585,8 @@ class MaskRCNN():
             "*epoch*", "{epoch:04d}")
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
-              augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
+              augmentation=None, custom_callbacks=None, no_augmentation_sources=None,
+              pipeline="generator"):
         """Train the model.
         train_dataset, val_dataset: Training and validation Dataset objects.
         learning_rate: The learning rate to train with
@@ -2306,8 +2618,12 @@ class MaskRCNN():
         no_augmentation_sources: Optional. List of sources to exclude for
             augmentation. A source is string that identifies a dataset and is
             defined in the Dataset class.
+        pipeline: How the training data is loaded:
+            generator: data_generator(), run by Keras worker processes
+            tf.data: input_pipeline(), run by TensorFlow threads
         """
         assert self.mode == "training", "Create model in training mode."
+        assert pipeline in ["generator", "tf.data"], "Unknown pipeline {}".format(pipeline)
 
         # Pre-defined layer regular expressions
         layer_regex = {
@@ -2324,12 +2640,20 @@ class MaskRCNN():
             layers = layer_regex[layers]
 
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        if pipeline == "tf.data":
+            train_generator = pipeline_generator(input_pipeline(
+                train_dataset, self.config, shuffle=True, augmentation=augmentation,
+                batch_size=self.config.BATCH_SIZE,
+                no_augmentation_sources=no_augmentation_sources))
+            val_generator = pipeline_generator(input_pipeline(
+                val_dataset, self.config, shuffle=True, batch_size=self.config.BATCH_SIZE))
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources)
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -2360,6 +2684,10 @@ class MaskRCNN():
             workers = 0
         else:
             workers = multiprocessing.cpu_count()
+        if pipeline == "tf.data":
+            # The pipeline loads the images in parallel itself, and its
+            # generator can't be shared
+            workers = 0
 
         self.keras_model.fit_generator(
             train_generator,
@@ -2371,7 +2699,7 @@ class MaskRCNN():
             validation_steps=self.config.VALIDATION_STEPS,
             max_queue_size=100,
             workers=workers,
-            use_multiprocessing=True,
+            use_multiprocessing=pipeline == "generator",
         )
         self.epoch = max(self.epoch, epochs)
 
@@ -2379,10 +2707,11 @@ class MaskRCNN():
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
         images: List of image matrices [height,width,depth]. Images can have
-            different sizes.
+            different sizes. They are converted to IMAGE_CHANNEL_COUNT
+            channels if needed, see utils.convert_image_channels().
 
         Returns 3 Numpy matrices:
-        molded_images: [N, h, w, 3]. Images resized and normalized.
+        molded_images: [N, h, w, channels]. Images resized and normalized.
         image_metas: [N, length of meta data]. Details about each image.
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
@@ -2391,6 +2720,7 @@ class MaskRCNN():
         image_metas = []
         windows = []
         for image in images:
+            image = utils.convert_image_channels(image, self.config.IMAGE_CHANNEL_COUNT)
             # Resize image
             # TODO: move resizing to mold_image()
             molded_image, window, scale, padding, crop = utils.resize_image(
@@ -2415,24 +2745,36 @@ class MaskRCNN():
         return molded_images, image_metas, windows
 
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, mask_format="dense"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width, num_classes], or None if the masks
+            were not predicted. The masks are then empty. With MASK_CLASSES,
+            the masks of the detections of those classes, in their order.
+            The masks of the other detections are empty.
         original_image_shape: [H, W, C] Original image shape before resizing
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        mask_format: "dense" for full size masks, "box" for a utils.BoxMasks
+                with the binary masks cropped to their boxes, "raw" for a
+                utils.BoxMasks that keeps the small float masks and resizes
+                them to their boxes only when they are used, or "rle" for
+                run-length encoded masks in a utils.RLEMasks.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks, or a
+                utils.BoxMasks or utils.RLEMasks, see mask_format
         """
+        assert mask_format in ["dense", "box", "raw", "rle"], \
+            "mask_format must be dense, box, raw or rle"
+
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
         zero_ix = np.where(detections[:, 4] == 0)[0]
@@ -2442,7 +2784,12 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        # Detections with a mask
+        mask_ix = np.arange(N)
+        if self.config.MASK_CLASSES:
+            mask_ix = np.where(np.isin(class_ids, self.config.MASK_CLASSES))[0]
+        masks = mrcnn_mask[np.arange(len(mask_ix)), :, :, class_ids[mask_ix]] \
+            if mrcnn_mask is not None else None
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
@@ -2465,30 +2812,78 @@ class MaskRCNN():
             boxes = np.delete(boxes, exclude_ix, axis=0)
             class_ids = np.delete(class_ids, exclude_ix, axis=0)
             scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
+            keep = np.isin(mask_ix, exclude_ix, invert=True)
+            if masks is not None:
+                masks = masks[keep]
+            mask_ix = mask_ix[keep] - np.searchsorted(exclude_ix, mask_ix[keep])
             N = class_ids.shape[0]
 
+        if masks is None:
+            # Boxes only. Empty masks, zero filled memory is allocated lazily.
+            if mask_format == "dense":
+                return boxes, class_ids, scores, np.zeros(
+                    tuple(original_image_shape[:2]) + (N,), dtype=np.bool)
+            masks = utils.BoxMasks(boxes, [np.zeros([y2 - y1, x2 - x1], dtype=np.bool)
+                                           for y1, x1, y2, x2 in boxes], original_image_shape)
+            if mask_format == "rle":
+                masks = utils.RLEMasks.from_box_masks(masks)
+            return boxes, class_ids, scores, masks
+
+        backend = self.config.MASK_PASTE_BACKEND
+        if len(mask_ix) < N:
+            # Paste only the masks of MASK_CLASSES, the others stay empty
+            if mask_format == "dense":
+                full_masks = np.zeros(tuple(original_image_shape[:2]) + (N,), dtype=np.bool)
+                if len(mask_ix):
+                    full_masks[:, :, mask_ix] = utils.unmold_masks(
+                        masks, boxes[mask_ix], original_image_shape, backend)
+                return boxes, class_ids, scores, full_masks
+            if mask_format == "raw":
+                raw_masks = np.zeros((N,) + masks.shape[1:], dtype=masks.dtype)
+                raw_masks[mask_ix] = masks
+                return boxes, class_ids, scores, utils.BoxMasks(
+                    boxes, raw_masks, original_image_shape, raw=True, backend=backend)
+            crops = [np.zeros([y2 - y1, x2 - x1], dtype=np.bool) for y1, x1, y2, x2 in boxes]
+            for mask, i in zip(masks, mask_ix):
+                crops[i] = utils.mask_to_box(mask, boxes[i], backend)
+            masks = utils.BoxMasks(boxes, crops, original_image_shape)
+            if mask_format == "rle":
+                masks = utils.RLEMasks.from_box_masks(masks)
+            return boxes, class_ids, scores, masks
+
+        if mask_format == "raw":
+            return boxes, class_ids, scores, utils.BoxMasks(
+                boxes, masks, original_image_shape, raw=True, backend=backend)
+        if mask_format in ["box", "rle"]:
+            masks = utils.BoxMasks(boxes, masks, original_image_shape, raw=True,
+                                   backend=backend)
+            # Resize the masks now, but only to the size of their boxes
+            for i in range(N):
+                masks.crop(i)
+            if mask_format == "rle":
+                masks = utils.RLEMasks.from_box_masks(masks)
+            return boxes, class_ids, scores, masks
+
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        full_masks = utils.unmold_masks(masks, boxes, original_image_shape, backend)
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, mask_format="dense", with_masks=True):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
+        mask_format: "dense", "box", "raw" or "rle". See unmold_detections().
+        with_masks: If False, skip the mask head and return empty masks,
+            for when only the boxes and classes are needed. The boxes,
+            classes and scores are the same as with masks.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or a utils.BoxMasks or
+            utils.RLEMasks that holds them, see mask_format
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2509,26 +2904,20 @@ class MaskRCNN():
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self.predict_detections(molded_images, image_metas,
+                                                         with_masks=with_masks)
         # Process detections
         results = []
         for i, image in enumerate(images):
             final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
+                self.unmold_detections(detections[i],
+                                       mrcnn_mask[i] if mrcnn_mask is not None else None,
                                        image.shape, molded_images[i].shape,
-                                       windows[i])
+                                       windows[i], mask_format=mask_format)
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
@@ -2537,19 +2926,68 @@ class MaskRCNN():
             })
         return results
 
-    def detect_molded(self, molded_images, image_metas, verbose=0):
+    def predict_detections(self, molded_images, image_metas, with_masks=True):
+        """Runs the model on a batch of molded images. The anchors are
+        generated in the graph, see pyramid_anchors_graph().
+
+        with_masks: If False, run the model without the mask branch.
+
+        Returns:
+        detections: [batch, N, (y1, x1, y2, x2, class_id, score)] in
+            normalized coordinates
+        mrcnn_mask: [batch, N, height, width, num_classes] mask probabilities,
+            or None if with_masks is False
+        """
+        if not with_masks:
+            detections = self.box_model.predict([molded_images, image_metas], verbose=0)
+            return detections, None
+        detections, _, _, mrcnn_mask, _, _, _ =\
+            self.keras_model.predict([molded_images, image_metas], verbose=0)
+        return detections, mrcnn_mask
+
+    def detect_batch(self, images, verbose=0, mask_format="dense", with_masks=True):
+        """Runs the detection pipeline on any number of images.
+
+        Unlike detect(), the number of images doesn't need to be equal to
+        BATCH_SIZE. The images are split into batches of BATCH_SIZE and
+        each batch is processed with a single predict call. The last batch
+        is padded with copies of its last image if it's incomplete, and the
+        results of the padding images are dropped.
+
+        images: List of images, potentially of different sizes.
+        mask_format: "dense", "box", "raw" or "rle". See unmold_detections().
+        with_masks: If False, skip the mask head, see detect().
+
+        Returns a list of dicts, one dict per image, in the order of the
+        given images. See detect() for the contents of the dicts.
+        """
+        batch_size = self.config.BATCH_SIZE
+        results = []
+        for i in range(0, len(images), batch_size):
+            batch = list(images[i:i + batch_size])
+            count = len(batch)
+            batch += [batch[-1]] * (batch_size - count)
+            results.extend(self.detect(batch, verbose=verbose, mask_format=mask_format,
+                                       with_masks=with_masks)[:count])
+        return results
+
+    def detect_molded(self, molded_images, image_metas, verbose=0, mask_format="dense",
+                      with_masks=True):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
         molded_images: List of images loaded using load_image_gt()
         image_metas: image meta data, also returned by load_image_gt()
+        mask_format: "dense", "box", "raw" or "rle". See unmold_detections().
+        with_masks: If False, skip the mask head, see detect().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or a utils.BoxMasks or
+            utils.RLEMasks, see mask_format
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
@@ -2566,27 +3004,21 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self.predict_detections(molded_images, image_metas,
+                                                         with_masks=with_masks)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
             window = [0, 0, image.shape[0], image.shape[1]]
             final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
+                self.unmold_detections(detections[i],
+                                       mrcnn_mask[i] if mrcnn_mask is not None else None,
                                        image.shape, molded_images[i].shape,
-                                       window)
+                                       window, mask_format=mask_format)
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
@@ -2596,19 +3028,15 @@ class MaskRCNN():
         return results
 
     def get_anchors(self, image_shape):
-        """Returns anchor pyramid for the given image size."""
-        backbone_shapes = compute_backbone_shapes(self.config, image_shape)
+        """Returns anchor pyramid for the given image size, in normalized
+        coordinates. The model generates the same anchors in its graph.
+        """
         # Cache anchors and reuse if image shape is the same
         if not hasattr(self, "_anchor_cache"):
             self._anchor_cache = {}
         if not tuple(image_shape) in self._anchor_cache:
-            # Generate Anchors
-            a = utils.generate_pyramid_anchors(
-                self.config.RPN_ANCHOR_SCALES,
-                self.config.RPN_ANCHOR_RATIOS,
-                backbone_shapes,
-                self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
+            # Generate Anchors, see pyramid_anchors()
+            a = pyramid_anchors(self.config, image_shape)
             # Keep a copy of the latest anchors in pixel coordinates because
             # it's used in inspect_model notebooks.
             # TODO: Remove this after the notebook are refactored to not use it
@@ -2697,13 +3125,7 @@ class MaskRCNN():
             molded_images, image_metas, _ = self.mold_inputs(images)
         else:
             molded_images = images
-        image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        model_in = [molded_images, image_metas]
 
         # Run inference
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
@@ -2742,7 +3164,9 @@ def compose_image_meta(image_id, original_image_shape, image_shape,
         list(image_shape) +           # size=3
         list(window) +                # size=4 (y1, x1, y2, x2) in image cooredinates
         [scale] +                     # size=1
-        list(active_class_ids)        # size=num_classes
+        list(active_class_ids),       # size=num_classes
+        # Float even when the scale is 1, so all the metas have one type
+        dtype=np.float64
     )
     return meta
 
@@ -2808,6 +3232,41 @@ def unmold_image(normalized_images, config):
     return (normalized_images + config.MEAN_PIXEL).astype(np.uint8)
 
 
+def adapt_input_channels(kernel, channels, bias=None, rgb_mean_pixel=None, mean_pixel=None):
+    """Adapts the kernel and bias of the first convolution of weights
+    trained on RGB images, e.g. COCO or ImageNet, to images with the given
+    number of channels.
+
+    A grayscale image is an RGB image with three equal channels, so the
+    kernel is summed over the channels. The RGB channels were molded with
+    their own means and the grayscale channel is molded with one mean,
+    so the bias is corrected by the sum of the kernel times the
+    difference of the means. The convolution then gives the same result
+    as that of the RGB image, except where it overlaps the zero padding
+    at the borders of the image.
+
+    kernel: [height, width, 3, filters]
+    channels: 1 for grayscale
+    bias: Optional. [filters] bias of the convolution
+    rgb_mean_pixel: The 3 means the weights were trained with, see
+        Config.RGB_MEAN_PIXEL. If None, the bias isn't corrected.
+    mean_pixel: [channels] The mean of the molded images, Config.MEAN_PIXEL
+
+    Returns the kernel, [height, width, channels, filters], and the bias
+    (None if not given).
+    """
+    if kernel.shape[2] == channels:
+        return kernel, bias
+    if channels == 1 and kernel.shape[2] == 3:
+        if bias is not None and rgb_mean_pixel is not None:
+            # sum_c K_c * (g - m_c) = (sum_c K_c) * (g - M) + sum_c K_c * (M - m_c)
+            difference = np.asarray(mean_pixel, dtype=np.float64)[0] - np.asarray(rgb_mean_pixel)
+            bias = bias + np.einsum("hwcf,c->f", kernel, difference).astype(bias.dtype)
+        return kernel.sum(axis=2, keepdims=True), bias
+    raise ValueError("Can't adapt a kernel for {} channels to {} channels".format(
+        kernel.shape[2], channels))
+
+
 ############################################################
 #  Miscellenous Graph Functions
 ############################################################
@@ -2834,6 +3293,49 @@ def batch_pack_graph(x, counts, num_rows):
     return tf.concat(outputs, axis=0)
 
 
+def pyramid_anchors_graph(feature_maps, images, config):
+    """Generates the anchor pyramid in the graph, the same anchors as
+    utils.generate_pyramid_anchors() normalized by utils.norm_boxes().
+    The feature map shapes are read from the feature maps, so any image
+    size works. Computed in float64 like the NumPy version.
+
+    feature_maps: List of the RPN feature maps [batch, height, width, depth],
+        one per BACKBONE_STRIDES.
+    images: [batch, height, width, channels] molded images
+
+    Returns: [batch, anchor_count, (y1, x1, y2, x2)] in normalized
+    coordinates, the same anchors for every image of the batch.
+    """
+    ratios = np.array(config.RPN_ANCHOR_RATIOS, dtype=np.float64)
+    anchors = []
+    for scale, feature_map, stride in zip(config.RPN_ANCHOR_SCALES, feature_maps,
+                                          config.BACKBONE_STRIDES):
+        heights = scale / np.sqrt(ratios)
+        widths = scale * np.sqrt(ratios)
+        shape = tf.shape(feature_map)
+        shifts_y = tf.cast(tf.range(0, shape[1], config.RPN_ANCHOR_STRIDE) * stride, tf.float64)
+        shifts_x = tf.cast(tf.range(0, shape[2], config.RPN_ANCHOR_STRIDE) * stride, tf.float64)
+        shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+        # [locations, 1] centers and [ratios] sizes give the anchors of
+        # each location in a row, as in utils.generate_anchors()
+        centers_y = tf.reshape(shifts_y, [-1, 1])
+        centers_x = tf.reshape(shifts_x, [-1, 1])
+        boxes = tf.stack([centers_y - 0.5 * heights, centers_x - 0.5 * widths,
+                          centers_y + 0.5 * heights, centers_x + 0.5 * widths], axis=2)
+        anchors.append(tf.reshape(boxes, [-1, 4]))
+    anchors = tf.concat(anchors, axis=0)
+
+    # Normalize coordinates
+    image_shape = tf.shape(images)
+    h = tf.cast(image_shape[1], tf.float64)
+    w = tf.cast(image_shape[2], tf.float64)
+    scale = tf.stack([h - 1, w - 1, h - 1, w - 1])
+    shift = tf.constant([0., 0., 1., 1.], dtype=tf.float64)
+    anchors = tf.cast(tf.divide(anchors - shift, scale), tf.float32)
+    # Same anchors for all the images in the batch
+    return tf.tile(tf.expand_dims(anchors, 0), [image_shape[0], 1, 1])
+
+
 def norm_boxes_graph(boxes, shape):
     """Converts boxes from pixel coordinates to normalized coordinates.
     boxes: [..., (y1, x1, y2, x2)] in pixel coordinates
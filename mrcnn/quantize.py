@@ -0,0 +1,199 @@
+"""
+Mask R-CNN
+Post-training quantization of the inference model for CPU inference with
+TensorFlow Lite.
+
+TensorFlow Lite has no kernels for the custom layers of Mask R-CNN
+(ProposalLayer, PyramidROIAlign and DetectionLayer), so the model is split
+in two stages. The backbone, the FPN and the RPN, which do almost all of
+the computation, are converted to a quantized TFLite model. The proposals,
+the heads and the detections are then run in TensorFlow by the Keras model,
+with the outputs of the TFLite model fed in place of its own feature maps.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from mrcnn import model as modellib
+from mrcnn.export import fold_batch_norms, metadata_path
+
+
+# Layers of the inference model whose outputs are computed by the TFLite
+# model: the feature maps P2 to P6 and the RPN class and bbox predictions.
+BACKBONE_LAYERS = ["fpn_p2", "fpn_p3", "fpn_p4", "fpn_p5", "fpn_p6", "rpn_class", "rpn_bbox"]
+
+# "int8": 8-bit weights and, with calibration images, 8-bit activations.
+# "float16": 16-bit float weights, half the size, about the accuracy of float32.
+QUANTIZATION_MODES = ["int8", "float16"]
+
+
+############################################################
+#  Conversion
+############################################################
+
+def backbone_tensors(keras_model):
+    """Returns the output tensors of BACKBONE_LAYERS in the Keras model."""
+    return [keras_model.get_layer(name).output for name in BACKBONE_LAYERS]
+
+
+def convert_backbone(model, tflite_path, quantization="int8", calibration_images=None):
+    """Converts the backbone, FPN and RPN of a MaskRCNN inference model to
+    a quantized TFLite model for QuantizedMaskRCNN.
+
+    The batch norm layers are folded into the convolutions first, see
+    fold_batch_norms(). This is done in place: the weights of the model
+    are changed, the outputs are not. Weights saved from the model
+    afterwards are the folded ones, which only match a model with frozen
+    batch norm layers (TRAIN_BN = False). The TFLite model runs one image
+    at a time, with the input shape of the molded images
+    (config.IMAGE_SHAPE).
+
+    model: MaskRCNN in inference mode with its weights loaded. Its batch
+        norm layers are folded in place.
+    tflite_path: Path of the TFLite model file (.tflite). The names of the
+        outputs and the settings are written next to it, see metadata_path().
+    quantization: "int8" or "float16"
+    calibration_images: Images (before molding) to calibrate the ranges of
+        the int8 activations on, typically a few dozen frames. Without
+        them, only the weights are quantized to int8.
+
+    Returns the metadata dict.
+    """
+    assert model.mode == "inference", "Convert a model in inference mode."
+    assert not model.config.TRAIN_BN, "Batch norm layers must be frozen (TRAIN_BN = False)."
+    assert quantization in QUANTIZATION_MODES, \
+        "Quantization must be one of {}".format(QUANTIZATION_MODES)
+    import keras.backend as K
+
+    folded = fold_batch_norms(model.keras_model)
+    input_tensor = model.keras_model.inputs[0]
+    outputs = backbone_tensors(model.keras_model)
+    output_names = [t.op.name for t in outputs]
+    input_shape = [1] + [int(d) for d in model.config.IMAGE_SHAPE]
+
+    # The converter needs a frozen graph with a fully defined input shape
+    session = K.get_session()
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), output_names)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        graph_path = os.path.join(temp_dir, "backbone.pb")
+        with tf.gfile.GFile(graph_path, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        converter = tf.lite.TFLiteConverter.from_frozen_graph(
+            graph_path, [input_tensor.op.name], output_names,
+            input_shapes={input_tensor.op.name: input_shape})
+    finally:
+        shutil.rmtree(temp_dir)
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif calibration_images is not None and len(calibration_images):
+        def representative_dataset():
+            for image in calibration_images:
+                molded_images, _, _ = model.mold_inputs([image])
+                yield [molded_images.astype(np.float32)]
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    else:
+        logging.warning("No calibration images, only the weights are quantized to int8")
+    tflite_model = converter.convert()
+
+    directory = os.path.dirname(tflite_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(tflite_path, "wb") as f:
+        f.write(tflite_model)
+
+    metadata = {
+        "input": input_tensor.op.name,
+        "input_shape": input_shape,
+        "outputs": output_names,
+        "layers": BACKBONE_LAYERS,
+        "quantization": quantization,
+        "calibration_images": 0 if calibration_images is None else len(calibration_images),
+        "num_classes": model.config.NUM_CLASSES,
+        "folded_batch_norms": folded,
+    }
+    with open(metadata_path(tflite_path), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+############################################################
+#  Quantized Predictor
+############################################################
+
+class QuantizedMaskRCNN(modellib.MaskRCNN):
+    """MaskRCNN that runs the backbone, FPN and RPN with a TFLite model
+    written by convert_backbone(), and the rest of the network in
+    TensorFlow. Build it and load the weights like MaskRCNN, then call
+    load_backbone(). Until then, it runs like MaskRCNN.
+    """
+
+    interpreter = None
+
+    def load_backbone(self, tflite_path):
+        """Loads the TFLite model to run the backbone with.
+        tflite_path: Path of a TFLite model written by convert_backbone()
+        """
+        assert self.mode == "inference", "Quantized backbones are for inference only."
+        with open(metadata_path(tflite_path)) as f:
+            self.backbone_metadata = json.load(f)
+        assert self.config.NUM_CLASSES == self.backbone_metadata["num_classes"], \
+            "The backbone was converted with {} classes, the config has {}".format(
+                self.backbone_metadata["num_classes"], self.config.NUM_CLASSES)
+        assert self.backbone_metadata["layers"] == BACKBONE_LAYERS
+
+        interpreter = tf.lite.Interpreter(model_path=tflite_path)
+        interpreter.allocate_tensors()
+        self.input_index = interpreter.get_input_details()[0]["index"]
+        indices = {d["name"]: d["index"] for d in interpreter.get_output_details()}
+        self.output_indices = [indices[name] for name in self.backbone_metadata["outputs"]]
+        self.interpreter = interpreter
+        # The TFLite outputs are fed in place of these tensors, so TensorFlow
+        # only runs the ops that come after them.
+        self.feed_tensors = backbone_tensors(self.keras_model)
+        outputs = self.keras_model.outputs
+        self.head_outputs = [outputs[0], outputs[3]]
+
+    def predict_backbone(self, molded_images):
+        """Runs the TFLite model on each of the molded images.
+
+        Returns a list with the batched outputs of BACKBONE_LAYERS.
+        """
+        input_shape = tuple(self.backbone_metadata["input_shape"][1:])
+        features = [[] for _ in self.output_indices]
+        for image in molded_images:
+            assert image.shape == input_shape, \
+                "The backbone was converted for images of shape {}, got {}".format(
+                    input_shape, image.shape)
+            self.interpreter.set_tensor(self.input_index,
+                                        image[np.newaxis].astype(np.float32))
+            self.interpreter.invoke()
+            for f, index in zip(features, self.output_indices):
+                f.append(self.interpreter.get_tensor(index))
+        return [np.concatenate(f) for f in features]
+
+    def predict_detections(self, molded_images, image_metas, with_masks=True):
+        if self.interpreter is None:
+            return super(QuantizedMaskRCNN, self).predict_detections(
+                molded_images, image_metas, with_masks)
+        import keras.backend as K
+
+        # The anchors are generated in the graph from the shape of the
+        # images, so the molded images are fed too
+        feed = dict(zip(self.feed_tensors, self.predict_backbone(molded_images)))
+        feed[self.keras_model.inputs[0]] = molded_images
+        feed[self.keras_model.inputs[1]] = image_metas
+        if not with_masks:
+            return K.get_session().run(self.head_outputs[0], feed_dict=feed), None
+        detections, mrcnn_mask = K.get_session().run(self.head_outputs, feed_dict=feed)
+        return detections, mrcnn_mask
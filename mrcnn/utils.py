@@ -15,8 +15,9 @@ import random
 import numpy as np
 import tensorflow as tf
 import scipy
-import skimage.color
 import skimage.io
+import skimage.draw
+import skimage.measure
 import skimage.transform
 import urllib.request
 import shutil
@@ -99,12 +100,16 @@ def compute_overlaps(boxes1, boxes2):
 
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
-    masks1, masks2: [Height, Width, instances]
+    masks1, masks2: [Height, Width, instances], or RLEMasks or BoxMasks.
+        If either set is not a dense array, the overlaps are computed on
+        the run-length encoded masks.
     """
     
     # If either set of masks is empty return empty result
     if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
         return np.zeros((masks1.shape[-1], masks2.shape[-1]))
+    if not isinstance(masks1, np.ndarray) or not isinstance(masks2, np.ndarray):
+        return to_rle_masks(masks1).iou(to_rle_masks(masks2))
     # flatten masks and compute their areas
     masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
     masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
@@ -206,13 +211,14 @@ def box_refinement_graph(box, gt_box):
     return result
 
 
-def box_refinement(box, gt_box):
+def box_refinement(box, gt_box, dtype=np.float32):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]. (y2, x2) is
     assumed to be outside the box.
+    dtype: Type the boxes are converted to for the computation
     """
-    box = box.astype(np.float32)
-    gt_box = gt_box.astype(np.float32)
+    box = box.astype(dtype)
+    gt_box = gt_box.astype(dtype)
 
     height = box[:, 2] - box[:, 0]
     width = box[:, 3] - box[:, 1]
@@ -352,18 +358,14 @@ class Dataset(object):
         """
         return self.image_info[image_id]["path"]
 
-    def load_image(self, image_id):
-        """Load the specified image and return a [H,W,3] Numpy array.
+    def load_image(self, image_id, channels=3):
+        """Load the specified image and return a [H,W,channels] Numpy array.
+
+        channels: 3 for RGB, 1 for grayscale. See convert_image_channels().
         """
         # Load image
         image = skimage.io.imread(self.image_info[image_id]['path'])
-        # If grayscale. Convert to RGB for consistency.
-        if image.ndim != 3:
-            image = skimage.color.gray2rgb(image)
-        # If has an alpha channel, remove it for consistency
-        if image.shape[-1] == 4:
-            image = image[..., :3]
-        return image
+        return convert_image_channels(image, channels)
 
     def load_mask(self, image_id):
         """Load instance masks for the given image.
@@ -384,6 +386,46 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_polygons(self, image_id):
+        """Load the outlines of the instances of the given image, for
+        datasets whose masks are polygons. With mini masks, load_image_gt()
+        then rasterizes them at the mini mask size, without the full size
+        masks. See polygons_to_mini_masks().
+
+        Returns None if the dataset has no polygons (the default), or:
+            polygons: List of (ys, xs) arrays of the vertices of each
+                instance, in pixels.
+            class_ids: a 1D array of class IDs of the instances.
+        """
+        return None
+
+
+def convert_image_channels(image, channels):
+    """Converts an image to RGB (channels = 3) or grayscale (channels = 1).
+
+    image: [height, width] grayscale image, or [height, width, channels]
+        image with 1, 3 or 4 (RGBA) channels. The alpha channel is removed.
+
+    Returns a [height, width, channels] image of the same dtype. Images
+    that already have the channels are returned as they are.
+    """
+    if image.ndim != 3:
+        image = image[..., np.newaxis]
+    if image.shape[-1] == 4:
+        image = image[..., :3]
+    if image.shape[-1] == channels:
+        return image
+    if channels == 3 and image.shape[-1] == 1:
+        return np.repeat(image, 3, axis=-1)
+    if channels == 1 and image.shape[-1] == 3:
+        # Luminance, with the weights of skimage.color.rgb2gray()
+        gray = np.dot(image, np.array([0.2125, 0.7154, 0.0721], np.float32))
+        if np.issubdtype(image.dtype, np.integer):
+            gray = np.round(gray)
+        return gray.astype(image.dtype)[..., np.newaxis]
+    raise ValueError("Can't convert an image with {} channels to {} channels".format(
+        image.shape[-1], channels))
+
 
 def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
     """Resizes an image keeping the aspect ratio unchanged.
@@ -534,6 +576,88 @@ def minimize_mask(bbox, mask, mini_shape):
     return mini_mask
 
 
+def clip_polygon(ys, xs, y1, x1, y2, x2):
+    """Clips a polygon to the box (y1, x1, y2, x2) with the
+    Sutherland-Hodgman algorithm.
+
+    Returns the (ys, xs) arrays of the vertices of the clipped polygon,
+    empty if the polygon is outside of the box.
+    """
+    points = list(zip(ys, xs))
+    # Each edge of the box: (axis, limit, keep the points above the limit)
+    for axis, limit, above in [(0, y1, True), (0, y2, False), (1, x1, True), (1, x2, False)]:
+        if not points:
+            break
+        inside = [(p[axis] >= limit) == above for p in points]
+        clipped = []
+        for i, p in enumerate(points):
+            q, q_inside = points[i - 1], inside[i - 1]
+            if inside[i] != q_inside:
+                # The edge from q to p crosses the limit
+                t = (limit - q[axis]) / (p[axis] - q[axis])
+                crossing = [q[0] + t * (p[0] - q[0]), q[1] + t * (p[1] - q[1])]
+                crossing[axis] = limit
+                clipped.append(tuple(crossing))
+            if inside[i]:
+                clipped.append(p)
+        points = clipped
+    if not points:
+        return np.zeros([0]), np.zeros([0])
+    ys, xs = np.array(points, dtype=np.float64).T
+    return ys, xs
+
+
+def polygons_to_mini_masks(polygons, scale, offset, image_shape, mini_shape, flip=False):
+    """Rasterizes polygons straight into mini masks. Gives about the same
+    boxes and masks as rasterizing them at the size of the image, and then
+    resize_mask(), extract_bboxes() and minimize_mask(), without the full
+    size masks.
+
+    polygons: List of (ys, xs) arrays of the vertices of each instance, in
+        pixels of the image before resizing.
+    scale: The scale factor used to resize the image, see resize_image()
+    offset: (dy, dx) added after scaling, the top and left padding, or
+        minus the top left corner of the crop.
+    image_shape: [height, width] of the resized image
+    mini_shape: (height, width) of the mini masks
+    flip: If True, the resized image was flipped left to right.
+
+    Returns:
+    bbox: [N, (y1, x1, y2, x2)] boxes in the resized image. All zeros for
+        the instances that are outside of it.
+    mini_masks: [mini height, mini width, N] bool masks in their boxes.
+    """
+    height, width = image_shape[:2]
+    mini_height, mini_width = mini_shape
+    bbox = np.zeros([len(polygons), 4], dtype=np.int32)
+    mini_masks = np.zeros(tuple(mini_shape) + (len(polygons),), dtype=bool)
+    for i, (ys, xs) in enumerate(polygons):
+        ys = np.asarray(ys, dtype=np.float64) * scale + offset[0]
+        xs = np.asarray(xs, dtype=np.float64) * scale + offset[1]
+        if flip:
+            xs = width - 1 - xs
+        # The part in the image, for the padding or the crop
+        ys, xs = clip_polygon(ys, xs, -0.5, -0.5, height - 0.5, width - 0.5)
+        if not len(ys):
+            continue
+        # The pixels whose centers are in the polygon
+        y1, x1 = max(int(np.ceil(ys.min())), 0), max(int(np.ceil(xs.min())), 0)
+        y2, x2 = min(int(np.floor(ys.max())) + 1, height), min(int(np.floor(xs.max())) + 1, width)
+        if y2 <= y1 or x2 <= x1:
+            continue
+        # Map the pixel centers of the box to those of the mini mask, as
+        # resize() does in minimize_mask()
+        mini_ys = (ys - y1 + 0.5) * mini_height / (y2 - y1) - 0.5
+        mini_xs = (xs - x1 + 0.5) * mini_width / (x2 - x1) - 0.5
+        rr, cc = skimage.draw.polygon(mini_ys, mini_xs, shape=mini_shape)
+        if not len(rr):
+            # Thinner than a pixel of the mini mask
+            rr, cc = skimage.draw.polygon_perimeter(mini_ys, mini_xs, shape=mini_shape, clip=True)
+        mini_masks[rr, cc, i] = True
+        bbox[i] = [y1, x1, y2, x2]
+    return bbox, mini_masks
+
+
 def expand_mask(bbox, mini_mask, image_shape):
     """Resizes mini masks back to image size. Reverses the change
     of minimize_mask().
@@ -557,25 +681,504 @@ def mold_mask(mask, config):
     pass
 
 
-def unmold_mask(mask, bbox, image_shape):
+# Backends of unmold_mask() and unmold_masks() to resize the masks
+# generated by the neural network to their boxes
+MASK_PASTE_BACKENDS = ["skimage", "opencv", "numpy"]
+
+
+def _bilinear_weights(in_size, out_size):
+    """Returns the [out_size, in_size] matrix of the weights of a bilinear
+    resize from in_size to out_size pixels, with pixel centers aligned and
+    zeros outside the input, as skimage resize() in 'constant' mode does.
+    """
+    coords = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    low = np.floor(coords).astype(np.int64)
+    frac = coords - low
+    # One extra column on each side for the zeros outside the input
+    weights = np.zeros([out_size, in_size + 2])
+    weights[np.arange(out_size), low + 1] = 1 - frac
+    weights[np.arange(out_size), low + 2] = frac
+    return weights[:, 1:-1]
+
+
+def mask_to_box(mask, bbox, backend="skimage", threshold=0.5):
+    """Resizes a mask generated by the neural network to the size of its
+    box and applies the threshold.
+    mask: [height, width] of type float. A small, typically 28x28 mask.
+    bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+    backend: "skimage" resizes with skimage like resize() does. "opencv"
+        and "numpy" are faster and give the same masks, except for pixels
+        with values very close to the threshold with "opencv", which
+        computes the interpolation with lower precision.
+
+    Returns a binary mask of shape [y2 - y1, x2 - x1].
+    """
+    y1, x1, y2, x2 = bbox
+    height, width = y2 - y1, x2 - x1
+    if backend == "skimage":
+        return resize(mask, (height, width)) >= threshold
+    # skimage clips the resized mask to the range of the input mask
+    low = np.min(mask)
+    if low >= threshold:
+        return np.ones([height, width], dtype=bool)
+    if backend == "opencv":
+        import cv2
+        padded = cv2.copyMakeBorder(np.float32(mask), 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        sy, sx = mask.shape[0] / height, mask.shape[1] / width
+        # Map the output pixel centers to the input, shifted by the padding
+        matrix = np.array([[sx, 0, 0.5 * sx + 0.5], [0, sy, 0.5 * sy + 0.5]])
+        resized = cv2.warpAffine(padded, matrix, (width, height),
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    elif backend == "numpy":
+        # Rounded to float32 like skimage does with the float32 masks
+        resized = np.float32(np.dot(np.dot(_bilinear_weights(mask.shape[0], height), mask),
+                                    _bilinear_weights(mask.shape[1], width).T))
+    else:
+        raise ValueError("Unknown mask paste backend {}".format(backend))
+    return resized >= threshold
+
+
+def unmold_mask(mask, bbox, image_shape, backend="skimage"):
     """Converts a mask generated by the neural network to a format similar
     to its original shape.
     mask: [height, width] of type float. A small, typically 28x28 mask.
     bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+    backend: Resize backend, see mask_to_box().
 
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = resize(mask, (y2 - y1, x2 - x1))
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
-
     # Put the mask in the right location.
     full_mask = np.zeros(image_shape[:2], dtype=np.bool)
-    full_mask[y1:y2, x1:x2] = mask
+    full_mask[y1:y2, x1:x2] = mask_to_box(mask, bbox, backend)
     return full_mask
 
 
+def unmold_masks(masks, boxes, image_shape, backend="skimage"):
+    """Converts the masks generated by the neural network for all the
+    instances of an image to full size masks, like unmold_mask() does for
+    one mask, but pasted into a single output array.
+    masks: [N, height, width] of type float.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    backend: Resize backend, see mask_to_box().
+
+    Returns a binary [height, width, N] array with the size of the
+    original image.
+    """
+    # Instances first, so that each mask is pasted into contiguous memory.
+    # The result is a [height, width, N] view of it.
+    full_masks = np.zeros((len(boxes),) + tuple(image_shape[:2]), dtype=np.bool)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        full_masks[i, y1:y2, x1:x2] = mask_to_box(masks[i], (y1, x1, y2, x2), backend)
+    return np.moveaxis(full_masks, 0, -1)
+
+
+def _instance_key(key):
+    """Interprets the index of an [H, W, N] masks array. Returns
+    ("one", i) for masks[:, :, i] or masks[..., i], ("many", ix) for the
+    same with a slice or an array ix, or (None, None) for other indices.
+    """
+    if not isinstance(key, tuple) or len(key) not in [2, 3]:
+        return None, None
+    if len(key) == 2 and key[0] is not Ellipsis:
+        return None, None
+    if len(key) == 3 and not all(isinstance(k, slice) and k == slice(None) for k in key[:2]):
+        return None, None
+    if isinstance(key[-1], (int, np.integer)):
+        return "one", key[-1]
+    if isinstance(key[-1], (slice, list, np.ndarray)):
+        return "many", key[-1]
+    return None, None
+
+
+class BoxMasks(object):
+    """Instance masks of the detections of one image, each one kept in its
+    bounding box instead of in a full size [height, width, N] array.
+
+    The masks are either binary crops of the size of their boxes, or the
+    small float masks of the neural network that are resized to their boxes
+    only when first used. Full size masks are materialized only on demand,
+    with dense() or by indexing the object like the dense array, so code
+    that expects r['masks'] to be an array keeps working.
+
+    boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
+    masks: List of N binary masks of shape [y2 - y1, x2 - x1], or
+        [N, height, width] float masks if raw is True
+    image_shape: [H, W, ...] Shape of the original image
+    raw: If True, masks are the small masks generated by the neural network
+        and are converted like unmold_mask() does.
+    backend: Resize backend of the raw masks, see mask_to_box().
+    """
+
+    def __init__(self, boxes, masks, image_shape, raw=False, threshold=0.5, backend="skimage"):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+        self.image_shape = tuple(image_shape[:2])
+        self.threshold = threshold
+        self.backend = backend
+        if raw:
+            self.raw_masks = masks
+            self._crops = [None] * self.boxes.shape[0]
+        else:
+            self.raw_masks = None
+            self._crops = list(masks)
+        assert len(self._crops) == self.boxes.shape[0], "One mask per box"
+
+    @property
+    def shape(self):
+        return self.image_shape + (self.boxes.shape[0],)
+
+    @property
+    def dtype(self):
+        return np.dtype(bool)
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    def crop(self, i):
+        """Returns the binary mask of instance i in its box,
+        [y2 - y1, x2 - x1].
+        """
+        if self._crops[i] is None:
+            self._crops[i] = mask_to_box(self.raw_masks[i], self.boxes[i],
+                                         self.backend, self.threshold)
+        return self._crops[i]
+
+    def dense(self, i=None):
+        """Returns the full size mask of instance i, [H, W], or of all the
+        instances, [H, W, N], if i is None.
+        """
+        if i is None:
+            masks = np.zeros(self.shape, dtype=bool)
+            for j in range(len(self)):
+                y1, x1, y2, x2 = self.boxes[j]
+                masks[y1:y2, x1:x2, j] = self.crop(j)
+            return masks
+        mask = np.zeros(self.image_shape, dtype=bool)
+        y1, x1, y2, x2 = self.boxes[i]
+        mask[y1:y2, x1:x2] = self.crop(i)
+        return mask
+
+    def __array__(self, dtype=None, copy=None):
+        masks = self.dense()
+        return masks if dtype is None else masks.astype(dtype)
+
+    def select(self, ix):
+        """Returns the masks at the given indices as a new BoxMasks."""
+        ix = np.arange(len(self))[ix]
+        return BoxMasks(self.boxes[ix], [self.crop(i) for i in ix], self.image_shape,
+                        threshold=self.threshold, backend=self.backend)
+
+    def __getitem__(self, key):
+        # masks[:, :, i] builds the full size mask of one instance only
+        kind, ix = _instance_key(key)
+        if kind == "one":
+            return self.dense(range(len(self))[ix])
+        if kind == "many":
+            return self.select(ix)
+        return self.dense()[key]
+
+    def area(self, i):
+        """Returns the number of pixels of the mask of instance i."""
+        return int(np.count_nonzero(self.crop(i)))
+
+    def centroid(self, i):
+        """Returns the (y, x) centroid of the mask of instance i relative to
+        the top left corner of its box, or None if the mask is empty.
+        """
+        ys, xs = np.nonzero(self.crop(i))
+        if not len(ys):
+            return None
+        return np.mean(ys), np.mean(xs)
+
+    def contour(self, i):
+        """Returns the longest outer contour of the mask of instance i as
+        [K, (y, x)] points relative to the top left corner of its box, or
+        None if the mask is empty.
+        """
+        # Pad to ensure proper contours for masks that touch the box edges
+        padded = np.pad(self.crop(i), 1, mode="constant")
+        contours = skimage.measure.find_contours(padded, 0.5)
+        if not contours:
+            return None
+        return max(contours, key=len) - 1
+
+
+############################################################
+#  Run-length Encoded Masks
+############################################################
+
+def rle_encode(mask):
+    """Run-length encodes a binary mask like the COCO API does: the lengths
+    of the alternating runs of 0s and 1s of the mask in column-major order,
+    starting with a run of 0s that may be empty.
+
+    mask: [height, width] binary mask
+
+    Returns a 1D uint32 array of run lengths.
+    """
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    if flat.size == 0:
+        return np.zeros([0], dtype=np.uint32)
+    changes = np.where(flat[1:] != flat[:-1])[0] + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.astype(np.uint32)
+
+
+def rle_decode(counts, shape):
+    """Decodes run lengths from rle_encode() to a [height, width]
+    binary mask of the given shape.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    flat = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
+    return flat.reshape(shape[:2], order="F")
+
+
+def rle_to_string(counts):
+    """Compresses run lengths to the string format of the COCO API, where
+    each run length is stored as the difference to the one two runs
+    before in groups of 5 bits.
+    """
+    chars = []
+    for i, x in enumerate(int(c) for c in counts):
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def rle_from_string(string):
+    """Decompresses run lengths from the string format of rle_to_string()."""
+    counts = []
+    p = 0
+    while p < len(string):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(string[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return np.array(counts, dtype=np.uint32)
+
+
+def _runs_intersection(runs1, runs2):
+    """Returns the number of pixels covered by both of two sets of runs."""
+    starts1, ends1 = runs1
+    starts2, ends2 = runs2
+    if not len(starts1) or not len(starts2):
+        return 0
+    # Sweep over the run boundaries, ends before starts at the same
+    # position, and count the lengths covered by two runs.
+    positions = np.concatenate([starts1, starts2, ends1, ends2])
+    deltas = np.repeat([1, -1], [len(starts1) + len(starts2), len(ends1) + len(ends2)])
+    order = np.lexsort((deltas, positions))
+    positions = positions[order]
+    depth = np.cumsum(deltas[order])
+    return int(np.sum(np.diff(positions)[depth[:-1] == 2]))
+
+
+class RLEMasks(object):
+    """Instance masks of one image stored as runs of pixels in column-major
+    order, as in the COCO run-length encoding.
+
+    Area, bounding boxes and IoU overlaps are computed on the runs, so a
+    mask costs a few bytes per row of the object instead of one byte per
+    pixel of the image. Like BoxMasks, the object can be indexed like the
+    dense [height, width, N] array, or converted with dense().
+
+    runs: List of N (starts, ends) pairs of int64 arrays with the sorted
+        start and end (exclusive) offsets of the runs of 1s of each mask in
+        the column-major flattened image.
+    image_shape: [H, W, ...] Shape of the image
+    """
+
+    def __init__(self, runs, image_shape):
+        self.runs = list(runs)
+        self.image_shape = tuple(image_shape[:2])
+        self._boxes = None
+
+    @classmethod
+    def from_counts(cls, counts, image_shape):
+        """Creates the masks from a list of N run lengths of rle_encode()."""
+        runs = []
+        for c in counts:
+            bounds = np.concatenate([[0], np.cumsum(np.asarray(c, dtype=np.int64))])
+            starts, ends = bounds[1:-1:2], bounds[2::2]
+            keep = ends > starts
+            runs.append((starts[keep], ends[keep]))
+        return cls(runs, image_shape)
+
+    @classmethod
+    def from_strings(cls, strings, image_shape):
+        """Creates the masks from a list of N strings of rle_to_string()."""
+        return cls.from_counts([rle_from_string(s) for s in strings], image_shape)
+
+    @classmethod
+    def from_dense(cls, masks):
+        """Encodes [height, width, N] binary masks."""
+        return cls.from_counts([rle_encode(masks[:, :, i]) for i in range(masks.shape[-1])],
+                               masks.shape)
+
+    @classmethod
+    def from_box_masks(cls, box_masks):
+        """Encodes a BoxMasks without building its full size masks."""
+        height = box_masks.image_shape[0]
+        runs = []
+        for i in range(len(box_masks)):
+            y1, x1, _, _ = box_masks.boxes[i]
+            # Runs start and end where the padded columns of the crop change
+            crop = np.pad(box_masks.crop(i).astype(np.int8), ((1, 1), (0, 0)), mode="constant")
+            cols, rows = np.nonzero(np.diff(crop, axis=0).T)
+            offsets = (cols + x1).astype(np.int64) * height + rows + y1
+            starts, ends = offsets[0::2], offsets[1::2]
+            # Merge the runs that continue at the top of the next column
+            joined = np.where(ends[:-1] == starts[1:])[0]
+            runs.append((np.delete(starts, joined + 1), np.delete(ends, joined)))
+        return cls(runs, box_masks.image_shape)
+
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.runs),)
+
+    @property
+    def dtype(self):
+        return np.dtype(bool)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def counts(self, i):
+        """Returns the run lengths of mask i in the format of rle_encode()."""
+        starts, ends = self.runs[i]
+        bounds = np.stack([starts, ends], axis=1).ravel()
+        size = self.image_shape[0] * self.image_shape[1]
+        counts = np.diff(np.concatenate([[0], bounds, [size]]))
+        # No empty run of 0s at the end, as in rle_encode()
+        if len(counts) > 1 and counts[-1] == 0:
+            counts = counts[:-1]
+        return counts.astype(np.uint32)
+
+    def to_strings(self):
+        """Returns the masks as a list of strings of rle_to_string()."""
+        return [rle_to_string(self.counts(i)) for i in range(len(self))]
+
+    def area(self, i=None):
+        """Returns the number of pixels of mask i, or an [N] array with the
+        areas of all the masks if i is None.
+        """
+        if i is None:
+            return np.array([self.area(j) for j in range(len(self))], dtype=np.int64)
+        starts, ends = self.runs[i]
+        return int(np.sum(ends - starts))
+
+    @property
+    def boxes(self):
+        """[N, (y1, x1, y2, x2)] bounding boxes of the masks, computed like
+        extract_bboxes() does."""
+        if self._boxes is None:
+            height = self.image_shape[0]
+            boxes = np.zeros([len(self), 4], dtype=np.int32)
+            for i, (starts, ends) in enumerate(self.runs):
+                if not len(starts):
+                    continue
+                first, last = starts // height, (ends - 1) // height
+                # Runs over several columns cover the full height
+                single = first == last
+                top = np.where(single, starts % height, 0)
+                bottom = np.where(single, (ends - 1) % height, height - 1)
+                boxes[i] = [top.min(), first.min(), bottom.max() + 1, last.max() + 1]
+            self._boxes = boxes
+        return self._boxes
+
+    def crop(self, i):
+        """Returns mask i cropped to its bounding box, see boxes."""
+        height = self.image_shape[0]
+        y1, x1, y2, x2 = self.boxes[i]
+        starts, ends = self.runs[i]
+        # Decode the columns of the box only
+        base = x1 * height
+        flat = np.zeros([(x2 - x1) * height], dtype=np.int8)
+        np.add.at(flat, starts - base, 1)
+        np.add.at(flat, ends[ends - base < flat.size] - base, -1)
+        flat = np.cumsum(flat) > 0
+        return flat.reshape([height, x2 - x1], order="F")[y1:y2]
+
+    def dense(self, i=None):
+        """Returns the full size mask i, [H, W], or all the masks,
+        [H, W, N], if i is None.
+        """
+        if i is None:
+            masks = np.zeros(self.shape, dtype=bool)
+            for j in range(len(self)):
+                masks[:, :, j] = self.dense(j)
+            return masks
+        mask = np.zeros(self.image_shape, dtype=bool)
+        y1, x1, y2, x2 = self.boxes[i]
+        mask[y1:y2, x1:x2] = self.crop(i)
+        return mask
+
+    def select(self, ix):
+        """Returns the masks at the given indices as a new RLEMasks."""
+        return RLEMasks([self.runs[i] for i in np.arange(len(self))[ix]], self.image_shape)
+
+    def __array__(self, dtype=None, copy=None):
+        masks = self.dense()
+        return masks if dtype is None else masks.astype(dtype)
+
+    def __getitem__(self, key):
+        kind, ix = _instance_key(key)
+        if kind == "one":
+            return self.dense(range(len(self))[ix])
+        if kind == "many":
+            return self.select(ix)
+        return self.dense()[key]
+
+    def iou(self, other):
+        """Computes the IoU overlaps with another RLEMasks of the same image
+        size. Returns [N, other N] overlaps.
+        """
+        assert self.image_shape == other.image_shape, "Masks of different image sizes"
+        overlaps = np.zeros([len(self), len(other)])
+        area1, area2 = self.area(), other.area()
+        boxes1, boxes2 = self.boxes, other.boxes
+        for i in range(len(self)):
+            for j in range(len(other)):
+                # Skip the pairs whose boxes don't overlap
+                if boxes1[i, 0] >= boxes2[j, 2] or boxes2[j, 0] >= boxes1[i, 2] or \
+                        boxes1[i, 1] >= boxes2[j, 3] or boxes2[j, 1] >= boxes1[i, 3]:
+                    continue
+                intersection = _runs_intersection(self.runs[i], other.runs[j])
+                overlaps[i, j] = intersection / (area1[i] + area2[j] - intersection)
+        return overlaps
+
+
+def to_rle_masks(masks):
+    """Converts [height, width, N] masks, a BoxMasks or an RLEMasks to an
+    RLEMasks."""
+    if isinstance(masks, RLEMasks):
+        return masks
+    if isinstance(masks, BoxMasks):
+        return RLEMasks.from_box_masks(masks)
+    return RLEMasks.from_dense(np.asarray(masks) > .5)
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -639,6 +1242,74 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class AnchorGridIndex(object):
+    """Spatial index of an anchor pyramid, to find the anchors that
+    intersect a box without computing the IoU of all of them.
+
+    The anchors of each shape (one per pyramid level and ratio) are on a
+    grid of positions. For each grid, the index keeps the extent of its rows
+    and columns, so the anchors that may intersect a box are those of the
+    rows and columns that overlap it. The others have an IoU of 0.
+    """
+
+    def __init__(self, anchors):
+        """
+        anchors: [anchor_count, (y1, x1, y2, x2)], as from
+            generate_pyramid_anchors()
+        """
+        self.anchors = np.asarray(anchors)
+        y1, x1, y2, x2 = np.split(self.anchors, 4, axis=1)
+        y1, x1, y2, x2 = y1[:, 0], x1[:, 0], y2[:, 0], x2[:, 0]
+        self.areas = (y2 - y1) * (x2 - x1)
+        # Rounded, as the sizes and centers computed from the corners vary
+        # a little with the position
+        sizes = np.round(np.stack([y2 - y1, x2 - x1], axis=1), 3)
+        _, shape_ix = np.unique(sizes, axis=0, return_inverse=True)
+        shape_ix = shape_ix.reshape([-1])
+        self.grids = []
+        for shape in range(shape_ix.max() + 1 if len(shape_ix) else 0):
+            ids = np.where(shape_ix == shape)[0]
+            _, row_ix = np.unique(np.round((y1[ids] + y2[ids]) / 2, 3), return_inverse=True)
+            _, col_ix = np.unique(np.round((x1[ids] + x2[ids]) / 2, 3), return_inverse=True)
+            row_ix, col_ix = row_ix.reshape([-1]), col_ix.reshape([-1])
+            grid = np.full([row_ix.max() + 1, col_ix.max() + 1], -1, dtype=np.int64)
+            grid[row_ix, col_ix] = ids
+            assert np.sum(grid >= 0) == len(ids), "Anchors of the same shape at the same position"
+            # Extent of the anchors of each row and column
+            row_y1 = np.full([grid.shape[0]], np.inf)
+            row_y2 = np.full([grid.shape[0]], -np.inf)
+            col_x1 = np.full([grid.shape[1]], np.inf)
+            col_x2 = np.full([grid.shape[1]], -np.inf)
+            np.minimum.at(row_y1, row_ix, y1[ids])
+            np.maximum.at(row_y2, row_ix, y2[ids])
+            np.minimum.at(col_x1, col_ix, x1[ids])
+            np.maximum.at(col_x2, col_ix, x2[ids])
+            self.grids.append((grid, row_y1, row_y2, col_x1, col_x2))
+
+    def candidates(self, box):
+        """Returns the IDs of the anchors that may intersect the box
+        (y1, x1, y2, x2). The other anchors don't.
+        """
+        ids = []
+        for grid, row_y1, row_y2, col_x1, col_x2 in self.grids:
+            rows = (row_y1 < box[2]) & (row_y2 > box[0])
+            cols = (col_x1 < box[3]) & (col_x2 > box[1])
+            ids.append(grid[np.ix_(rows, cols)].reshape([-1]))
+        ids = np.concatenate(ids) if ids else np.zeros([0], dtype=np.int64)
+        return ids[ids >= 0]
+
+    def overlaps(self, box):
+        """Computes the IoU of the box (y1, x1, y2, x2) with the anchors
+        near it, as compute_overlaps() does with all the anchors.
+
+        Returns the anchor IDs and their IoU. The IoU of the other anchors
+        is 0.
+        """
+        ids = self.candidates(box)
+        box_area = (box[2] - box[0]) * (box[3] - box[1])
+        return ids, compute_iou(box, self.anchors[ids], box_area, self.areas[ids])
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -657,6 +1328,7 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
                     pred_boxes, pred_class_ids, pred_scores, pred_masks,
                     iou_threshold=0.5, score_threshold=0.0):
     """Finds matches between prediction and ground truth instances.
+    The masks can be [height, width, N] arrays, RLEMasks or BoxMasks.
 
     Returns:
         gt_match: 1-D array. For each GT box it has the index of the matched
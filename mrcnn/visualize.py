@@ -15,10 +15,9 @@ import colorsys
 
 import numpy as np
 from skimage.measure import find_contours
-import matplotlib.pyplot as plt
-from matplotlib import patches,  lines
-from matplotlib.patches import Polygon
-import IPython.display
+# matplotlib and IPython are imported by the functions that draw with
+# them, so that the OpenCV drawing functions can be used without them,
+# e.g. on servers with no display
 
 # Root directory of the project
 ROOT_DIR = os.path.abspath("../")
@@ -44,6 +43,7 @@ def display_images(images, titles=None, cols=4, cmap=None, norm=None,
     norm: Optional. A Normalize instance to map values to colors.
     interpolation: Optional. Image interpolation to use for display.
     """
+    import matplotlib.pyplot as plt
     titles = titles if titles is not None else [""] * len(images)
     rows = len(images) // cols + 1
     plt.figure(figsize=(14, 14 * rows // cols))
@@ -99,6 +99,9 @@ def display_instances(image, boxes, masks, class_ids, class_names,
     colors: (optional) An array or colors to use with each object
     captions: (optional) A list of strings to use as captions for each object
     """
+    import matplotlib.pyplot as plt
+    from matplotlib import patches
+    from matplotlib.patches import Polygon
     # Number of instances
     N = boxes.shape[0]
     if not N:
@@ -169,23 +172,28 @@ def display_instances(image, boxes, masks, class_ids, class_names,
         plt.show()
 
 
-def display_instances_video(image, boxes, masks, class_ids, class_names, scores, colors):
+def draw_instances(image, boxes, masks, class_ids, class_names, scores, colors):
+    """Draws the masks, boxes and captions of the detections on an image
+    with OpenCV only, without matplotlib.
+
+    boxes: [num_instances, (y1, x1, y2, x2)] in image coordinates.
+        Instances with an empty box are skipped.
+    masks: [height, width, num_instances]
+    class_ids: [num_instances]
+    class_names: list of class names of the dataset
+    scores: (optional) confidence scores for each box
+    colors: One color per class name, the same color for all the instances
+        of a class
+
+    Returns the image and the list of drawn class names.
+    """
     # one color for the same class
     class_dict = {
         name: color for name, color in zip(class_names, colors)
     }
 
-    # Number of instances
-    N = boxes.shape[0]
-
-    if not N:
-        print("\n*** No instances to display *** \n")
-    else:
-        assert boxes.shape[0] == masks.shape[-1] == class_ids.shape[0]
-
     labels_list = []
-    # Bounding box
-    for i in range(N):
+    for i in range(boxes.shape[0]):
         if not np.any(boxes[i]):
             continue
 
@@ -209,6 +217,19 @@ def display_instances_video(image, boxes, masks, class_ids, class_names, scores,
 
     return image, labels_list
 
+
+def display_instances_video(image, boxes, masks, class_ids, class_names, scores, colors):
+    """Draws the detections on a video frame, see draw_instances()."""
+    # Number of instances
+    N = boxes.shape[0]
+
+    if not N:
+        print("\n*** No instances to display *** \n")
+    else:
+        assert boxes.shape[0] == masks.shape[-1] == class_ids.shape[0]
+
+    return draw_instances(image, boxes, masks, class_ids, class_names, scores, colors)
+
 def display_differences(image,
                         gt_box, gt_class_id, gt_mask,
                         pred_box, pred_class_id, pred_score, pred_mask,
@@ -252,6 +273,8 @@ def draw_rois(image, rois, refined_rois, mask, class_ids, class_names, limit=10)
     anchors: [n, (y1, x1, y2, x2)] list of anchors in image coordinates.
     proposals: [n, 4] the same anchors but refined to fit objects better.
     """
+    import matplotlib.pyplot as plt
+    from matplotlib import patches, lines
     masked_image = image.copy()
 
     # Pick random anchors in case there are too many.
@@ -351,6 +374,7 @@ def plot_precision_recall(AP, precisions, recalls):
     precisions: list of precision values
     recalls: list of recall values
     """
+    import matplotlib.pyplot as plt
     # Plot the Precision-Recall curve
     _, ax = plt.subplots(1)
     ax.set_title("Precision-Recall Curve. AP@50 = {:.3f}".format(AP))
@@ -369,6 +393,7 @@ def plot_overlaps(gt_class_ids, pred_class_ids, pred_scores,
     class_names: list of all class names in the dataset
     threshold: Float. The prediction probability required to predict a class
     """
+    import matplotlib.pyplot as plt
     gt_class_ids = gt_class_ids[gt_class_ids != 0]
     pred_class_ids = pred_class_ids[pred_class_ids != 0]
 
@@ -414,6 +439,9 @@ def draw_boxes(image, boxes=None, refined_boxes=None,
     title: An optional title to show over the image
     ax: (optional) Matplotlib axis to draw on.
     """
+    import matplotlib.pyplot as plt
+    from matplotlib import patches, lines
+    from matplotlib.patches import Polygon
     # Number of boxes
     assert boxes is not None or refined_boxes is not None
     N = boxes.shape[0] if boxes is not None else refined_boxes.shape[0]
@@ -504,6 +532,7 @@ def display_table(table):
     """Display values in a table format.
     table: an iterable of rows, and each row is an iterable of values.
     """
+    import IPython.display
     html = ""
     for row in table:
         row_html = ""
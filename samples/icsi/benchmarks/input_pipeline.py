@@ -0,0 +1,117 @@
+"""
+Mask R-CNN
+Benchmark of the training input pipelines of MaskRCNN.train().
+
+Loads training batches of the ICSI dataset with data_generator() in one
+process, with data_generator() run by Keras worker processes as
+train(pipeline="generator") does, and with the tf.data pipeline of
+train(pipeline="tf.data"). Checks that data_generator() and
+input_pipeline() give the same batches with the same seed, and prints the
+throughput of each.
+
+Usage:
+
+    python3 input_pipeline.py --dataset=/path/to/icsi/dataset
+    python3 input_pipeline.py --dataset=/path/to/icsi/dataset --subset=val --batches=100 --workers=8
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath("../../../")
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+from mrcnn import model as modellib
+from samples.icsi import icsi
+
+
+def keras_workers(generator, workers):
+    """Runs the generator in Keras worker processes, as fit_generator()
+    does with use_multiprocessing=True. The workers are stopped when the
+    returned generator is closed.
+    """
+    from keras.utils.data_utils import GeneratorEnqueuer
+    enqueuer = GeneratorEnqueuer(generator, use_multiprocessing=True)
+    enqueuer.start(workers=workers, max_queue_size=100)
+    try:
+        for batch in enqueuer.get():
+            yield batch
+    finally:
+        enqueuer.stop()
+
+
+def benchmark(dataset_dir, subset="train", batches=50, batch_size=2, workers=None):
+    workers = workers or multiprocessing.cpu_count()
+
+    class BenchmarkConfig(icsi.ICSIConfig):
+        IMAGES_PER_GPU = batch_size
+
+    config = BenchmarkConfig()
+    dataset = icsi.ICSIDataset()
+    dataset.load_icsi(dataset_dir, subset)
+    dataset.prepare()
+
+    # Same batches with the same seed
+    generator = modellib.data_generator(dataset, config, batch_size=batch_size, seed=0)
+    pipeline = modellib.pipeline_generator(modellib.input_pipeline(
+        dataset, config, batch_size=batch_size, num_parallel_calls=workers, seed=0))
+    identical = all(np.array_equal(a, b) for _ in range(3)
+                    for a, b in zip(next(generator)[0], next(pipeline)[0]))
+    print("{} images, batches of {}, {} workers, same batches: {}".format(
+        len(dataset.image_ids), batch_size, workers, identical))
+
+    runs = [
+        ("generator", lambda: modellib.data_generator(dataset, config, batch_size=batch_size)),
+        ("keras", lambda: keras_workers(
+            modellib.data_generator(dataset, config, batch_size=batch_size), workers)),
+        ("tf.data", lambda: modellib.pipeline_generator(modellib.input_pipeline(
+            dataset, config, batch_size=batch_size, num_parallel_calls=workers))),
+    ]
+    print("{:10} {:>12} {:>14} {:>14}".format("pipeline", "startup s", "batches / s", "images / s"))
+    for name, run in runs:
+        start = time.time()
+        batches_generator = run()
+        # The first batch, with the start of the workers
+        next(batches_generator)
+        startup = time.time() - start
+        start = time.time()
+        for _ in range(batches):
+            next(batches_generator)
+        elapsed = time.time() - start
+        # Stop the workers, so they don't slow down the next run
+        batches_generator.close()
+        print("{:10} {:12.2f} {:14.2f} {:14.2f}".format(
+            name, startup, batches / elapsed, batches * batch_size / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the training input pipelines.')
+    parser.add_argument('--dataset', required=True,
+                        metavar="/path/to/icsi/dataset/",
+                        help='Directory of the ICSI dataset')
+    parser.add_argument('--subset', required=False,
+                        default="train",
+                        metavar="train or val",
+                        help='Subset of the dataset to load (default=train)')
+    parser.add_argument('--batches', required=False,
+                        default=50, type=int,
+                        metavar="number of batches",
+                        help='Number of batches to load with each pipeline (default=50)')
+    parser.add_argument('--batch-size', required=False,
+                        default=2, type=int,
+                        metavar="number of images",
+                        help='Number of images per batch (default=2)')
+    parser.add_argument('--workers', required=False,
+                        default=None, type=int,
+                        metavar="number of workers",
+                        help='Number of worker processes and parallel calls (default=number of CPUs)')
+    args = parser.parse_args()
+    benchmark(args.dataset, args.subset, args.batches, args.batch_size, args.workers)
@@ -0,0 +1,95 @@
+"""
+Mask R-CNN
+Benchmark of the mask paste backends of utils.unmold_masks().
+
+Pastes the masks of synthetic detections into full size masks with each
+backend of utils.MASK_PASTE_BACKENDS, compares the masks with the ones of
+one unmold_mask() call per instance and np.stack(), as unmold_detections()
+used to do, and prints the time per image.
+
+Usage:
+
+    python3 mask_paste.py
+    python3 mask_paste.py --size=1024 --instances=100 --repeat=20
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath("../../../")
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+from mrcnn import utils
+
+
+def make_detections(size, instances, mask_shape=(28, 28), seed=0):
+    """Generates random boxes in a size x size image and smooth float masks
+    like the ones of the mask head, with a blob in the middle.
+
+    Returns masks [instances, height, width] and boxes [instances, 4].
+    """
+    rng = np.random.RandomState(seed)
+    y1 = rng.randint(0, size - 8, instances)
+    x1 = rng.randint(0, size - 8, instances)
+    y2 = np.minimum(y1 + rng.randint(4, size // 3, instances), size)
+    x2 = np.minimum(x1 + rng.randint(4, size // 3, instances), size)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+
+    ys, xs = np.meshgrid(np.linspace(-1, 1, mask_shape[0]), np.linspace(-1, 1, mask_shape[1]),
+                         indexing="ij")
+    radius = rng.uniform(0.3, 1.1, [instances, 1, 1])
+    noise = rng.uniform(-0.2, 0.2, [instances] + list(mask_shape))
+    masks = 1 / (1 + np.exp(8 * (np.sqrt(ys ** 2 + xs ** 2) - radius))) + noise
+    return np.clip(masks, 0, 1).astype(np.float32), boxes
+
+
+def benchmark(size=1024, instances=100, repeat=10):
+    masks, boxes = make_detections(size, instances)
+    image_shape = (size, size, 3)
+    print("{} instances in a {}x{} image, {} repeats".format(instances, size, size, repeat))
+    print("{:10} {:>12} {:>18} {:>12}".format("backend", "ms / image", "pixels different", "min IoU"))
+
+    def stacked():
+        return np.stack([utils.unmold_mask(masks[i], boxes[i], image_shape)
+                         for i in range(instances)], axis=-1)
+
+    reference = stacked()
+    runs = [("stacked", stacked)] + [
+        (backend, lambda backend=backend: utils.unmold_masks(masks, boxes, image_shape, backend))
+        for backend in utils.MASK_PASTE_BACKENDS]
+    for name, run in runs:
+        # Warm up, e.g. the OpenCV import
+        run()
+        start = time.time()
+        for _ in range(repeat):
+            full_masks = run()
+        elapsed = (time.time() - start) / repeat
+        different = np.sum(full_masks != reference)
+        overlaps = utils.compute_overlaps_masks(full_masks, reference)
+        min_iou = np.min(np.diag(overlaps)) if instances else 1.0
+        print("{:10} {:12.2f} {:18d} {:12.6f}".format(name, elapsed * 1000, different, min_iou))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the mask paste backends of unmold_masks().')
+    parser.add_argument('--size', required=False,
+                        default=1024, type=int,
+                        metavar="pixels",
+                        help='Width and height of the image (default=1024)')
+    parser.add_argument('--instances', required=False,
+                        default=100, type=int,
+                        metavar="number of instances",
+                        help='Number of detections per image (default=100)')
+    parser.add_argument('--repeat', required=False,
+                        default=10, type=int,
+                        metavar="number of repeats",
+                        help='Number of times to paste the masks with each backend (default=10)')
+    args = parser.parse_args()
+    benchmark(args.size, args.instances, args.repeat)
@@ -0,0 +1,169 @@
+"""
+Mask R-CNN
+Benchmark of the RPN target builder, model.build_rpn_targets().
+
+Builds the RPN targets of synthetic GT boxes with the anchor grid index,
+as data_generator() does, and with the dense IoU matrix of all the anchors
+and the loop over the positive anchors of the previous version. Checks that
+both give the same targets and prints the time per image.
+
+Usage:
+
+    python3 rpn_targets.py
+    python3 rpn_targets.py --size=1024 --instances=10 --repeat=20
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath("../../../")
+
+# Import Mask RCNN
+sys.path.append(ROOT_DIR)  # To find local version of the library
+from mrcnn import utils
+from mrcnn.config import Config
+from mrcnn import model as modellib
+
+
+class BenchmarkConfig(Config):
+    NAME = "benchmark"
+    NUM_CLASSES = 1 + 3
+    IMAGES_PER_GPU = 1
+
+
+def dense_rpn_targets(anchors, gt_class_ids, gt_boxes, config):
+    """build_rpn_targets() of the previous version: IoU of every anchor
+    with every GT box, and the deltas one positive anchor at a time.
+    """
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_class_ids = gt_class_ids[non_crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+        no_crowd_bool = (np.amax(crowd_overlaps, axis=1) < 0.001)
+    else:
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+
+    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:, 0]
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE - np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+
+    ids = np.where(rpn_match == 1)[0]
+    for ix, (i, a) in enumerate(zip(ids, anchors[ids])):
+        gt = gt_boxes[anchor_iou_argmax[i]]
+        gt_h = gt[2] - gt[0]
+        gt_w = gt[3] - gt[1]
+        gt_center_y = gt[0] + 0.5 * gt_h
+        gt_center_x = gt[1] + 0.5 * gt_w
+        a_h = a[2] - a[0]
+        a_w = a[3] - a[1]
+        a_center_y = a[0] + 0.5 * a_h
+        a_center_x = a[1] + 0.5 * a_w
+        rpn_bbox[ix] = [
+            (gt_center_y - a_center_y) / a_h,
+            (gt_center_x - a_center_x) / a_w,
+            np.log(gt_h / a_h),
+            np.log(gt_w / a_w),
+        ]
+        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
+    return rpn_match, rpn_bbox
+
+
+def make_gt_boxes(size, instances, seed=0):
+    """Generates GT boxes like the ones of the ICSI images: one large box,
+    the oocyte, a long one, the pipette, and small ones, the sperm.
+
+    Returns class IDs [instances] and boxes [instances, 4].
+    """
+    rng = np.random.RandomState(seed)
+    boxes = [[size // 4, size // 4, 3 * size // 4, 3 * size // 4],
+             [size // 2 - 20, 0, size // 2 + 20, size // 2]]
+    for _ in range(instances - 2):
+        y1, x1 = rng.randint(0, size - 32, 2)
+        h, w = rng.randint(4, 32, 2)
+        boxes.append([y1, x1, y1 + h, x1 + w])
+    class_ids = np.array([1, 2] + [3] * (instances - 2), dtype=np.int32)
+    return class_ids[:instances], np.array(boxes[:instances], dtype=np.int32)
+
+
+def benchmark(size=1024, instances=10, repeat=10):
+    config = BenchmarkConfig()
+    image_shape = (size, size, 3)
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                             config.RPN_ANCHOR_RATIOS,
+                                             modellib.compute_backbone_shapes(config, image_shape),
+                                             config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    gt_class_ids, gt_boxes = make_gt_boxes(size, instances)
+    print("{} anchors, {} GT boxes in a {}x{} image, {} repeats".format(
+        len(anchors), instances, size, size, repeat))
+
+    start = time.time()
+    anchor_index = utils.AnchorGridIndex(anchors)
+    print("Anchor index built in {:.1f} ms, once per data generator".format(
+        (time.time() - start) * 1000))
+
+    runs = [
+        ("dense", lambda: dense_rpn_targets(anchors, gt_class_ids, gt_boxes, config)),
+        ("indexed", lambda: modellib.build_rpn_targets(image_shape, anchors, gt_class_ids,
+                                                       gt_boxes, config, anchor_index)),
+    ]
+    print("{:10} {:>12} {:>16} {:>16}".format("version", "ms / image", "match different",
+                                               "max bbox diff"))
+    reference = None
+    for name, run in runs:
+        # Same subsampling of the anchors
+        np.random.seed(0)
+        rpn_match, rpn_bbox = run()
+        if reference is None:
+            reference = rpn_match, rpn_bbox
+        start = time.time()
+        for _ in range(repeat):
+            run()
+        elapsed = (time.time() - start) / repeat
+        different = np.sum(rpn_match != reference[0])
+        bbox_diff = np.max(np.abs(rpn_bbox - reference[1]))
+        print("{:10} {:12.2f} {:16d} {:16.2e}".format(name, elapsed * 1000, different, bbox_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the RPN target builder.')
+    parser.add_argument('--size', required=False,
+                        default=1024, type=int,
+                        metavar="pixels",
+                        help='Width and height of the image (default=1024)')
+    parser.add_argument('--instances', required=False,
+                        default=10, type=int,
+                        metavar="number of instances",
+                        help='Number of GT boxes per image, at least 2 (default=10)')
+    parser.add_argument('--repeat', required=False,
+                        default=10, type=int,
+                        metavar="number of repeats",
+                        help='Number of times to build the targets with each version (default=10)')
+    args = parser.parse_args()
+    benchmark(args.size, args.instances, args.repeat)
@@ -20,11 +20,92 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
     # Train a new model starting from ImageNet weights
     python3 icsi.py train --dataset=/path/to/icsi/dataset --weights=imagenet
 
+    # Resize the training images and build their targets once, and train
+    # from the cache without decoding the images at every step
+    python3 icsi.py prepare-cache --dataset=/path/to/icsi/dataset --cache=/path/to/cache/
+    python3 icsi.py train --dataset=/path/to/icsi/dataset --weights=coco --cache=/path/to/cache/
+
+    # Load the training images with a tf.data pipeline instead of Keras workers
+    python3 icsi.py train --dataset=/path/to/icsi/dataset --weights=coco --input-pipeline=tf.data
+
     # Apply color splash to an image
     python3 icsi.py splash --weights=/path/to/weights/file.h5 --image=<URL or path to file>
 
     # Apply color splash to video using the last weights you trained
     python3 icsi.py splash --weights=last --video=<URL or path to file>
+
+    # Same, with decoding, inference, analysis and encoding running as parallel stages
+    python3 icsi.py splash --weights=last --video=<URL or path to file> --pipeline
+
+    # Store the per-frame results in a given database and also write the
+    # bboxes.txt, params.txt and pole_oocytu.txt text files
+    python3 icsi.py splash --weights=last --video=<URL or path to file> --results=results.sqlite --text-output
+
+    # Run the model on micro-batches of 4 frames
+    python3 icsi.py splash --weights=last --video=<URL or path to file> --batch-size=4
+
+    # Run the model on every 8th frame, or earlier if the scene changes, and
+    # propagate the masks to the frames in between with optical flow
+    python3 icsi.py splash --weights=last --video=<URL or path to file> --keyframe-interval=8 --keyframe-threshold=6
+
+    # On a server with no display, only store the detections and stages,
+    # without writing an annotated video
+    python3 icsi.py splash --weights=last --video=<URL or path to file> --headless --no-video
+
+    # Process all videos of a directory (or listed in a text file, one path
+    # per line) with 2 worker processes that each load the model once
+    python3 icsi.py batch --weights=/path/to/weights/file.h5 --videos=/path/to/videos/ --output=/path/to/output/ --workers=2
+
+    # Split one video into 4 frame ranges, process them in parallel and
+    # stitch the results together, into a directory named after the video
+    # or into --output
+    python3 icsi.py splash --weights=last --video=<path to file> --chunks=4
+    python3 icsi.py splash --weights=last --video=<path to file> --chunks=4 --output=/path/to/output/
+
+    # Save a checkpoint every 1000 frames and, after a crash, continue from
+    # the last checkpoint
+    python3 icsi.py splash --weights=last --video=<path to file> --results=results.sqlite --checkpoint-every=1000
+    python3 icsi.py splash --weights=last --video=<path to file> --results=results.sqlite --checkpoint-every=1000 --resume
+
+    # Classify the stages of a processed video again from its stored
+    # features, e.g. after changing the stage rules
+    python3 icsi.py classify --results=results.sqlite
+
+    # Smooth the stages over time and print the stage timeline, after the
+    # run or while processing with a lag of 50 frames
+    python3 icsi.py classify --results=results.sqlite --smooth
+    python3 icsi.py splash --weights=last --video=<path to file> --smooth-lag=50
+
+    # Also store the masks of the detections, run-length encoded
+    python3 icsi.py splash --weights=last --video=<path to file> --results=results.sqlite --store-masks
+
+    # Export the model for micro-batches of 4 frames to a frozen graph, and
+    # run the frozen graph, which starts much faster
+    python3 icsi.py export --weights=last --graph=mask_rcnn_icsi.pb --batch-size=4
+    python3 icsi.py splash --weights=mask_rcnn_icsi.pb --video=<path to file> --batch-size=4
+
+    # Export a graph that only computes the masks used by the stages, for
+    # runs with --no-video
+    python3 icsi.py export --weights=last --graph=mask_rcnn_icsi_stages.pb --batch-size=4 --no-video
+
+    # Quantize the backbone to int8 for CPU inference, calibrated on frames
+    # of the training set, and compare the mAP and speed on the validation
+    # set; then run the quantized backbone with TFLite
+    python3 icsi.py quantize --weights=last --dataset=/path/to/icsi/dataset --quantization=int8 --tflite=backbone_int8.tflite
+    python3 icsi.py splash --weights=last --video=<path to file> --tflite=backbone_int8.tflite
+
+    # Train and run a model on single channel (grayscale) images. The first
+    # convolution of the COCO weights is summed over the RGB channels.
+    python3 icsi.py train --dataset=/path/to/icsi/dataset --weights=coco --grayscale
+    python3 icsi.py splash --weights=last --video=<path to file> --grayscale
+
+    # Run the model on 512x512 crops around the last detections, and on the
+    # whole frame every 25 frames or when the crop loses an object
+    python3 icsi.py splash --weights=last --video=<path to file> --roi-interval=25 --roi-dim=512
+
+    # Skip the mask head on frames without an oocyte, whose stage only
+    # depends on the boxes
+    python3 icsi.py splash --weights=last --video=<path to file> --masks-on-demand
 """
 
 """
@@ -34,10 +115,14 @@ To see the results of using a trained network on a validation set I used Jupyter
 import os
 import sys
 import json
+import time
+import queue
+import sqlite3
 import datetime
+import random
+import threading
 import numpy as np
 import skimage.draw
-from matplotlib import pyplot as plt
 
 # Root directory of the project
 ROOT_DIR = os.path.abspath("../../")
@@ -45,8 +130,7 @@ ROOT_DIR = os.path.abspath("../../")
 # Import Mask RCNN
 sys.path.append(ROOT_DIR)  # To find local version of the library
 from mrcnn.config import Config
-from mrcnn import model as modellib, utils
-from mrcnn import visualize
+from mrcnn import model as modellib, utils, visualize
 
 import cv2
 from math import sqrt, pi, fabs
@@ -58,6 +142,9 @@ COCO_WEIGHTS_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
 # through the command line argument --logs
 DEFAULT_LOGS_DIR = os.path.join(ROOT_DIR, "logs")
 
+# Class names of the detections, in the order of the class IDs
+CLASS_NAMES = ['BG', 'oocyte', 'polar body', 'spermatozoon', 'pipette']
+
 
 ############################################################
 #  Configurations
@@ -88,11 +175,203 @@ class ICSIConfig(Config):
     # PG: changed to 0.8
     DETECTION_MIN_CONFIDENCE = 0.9
 
+    # Paste the masks with the NumPy resize, same masks as with skimage
+    # but faster, see benchmarks/mask_paste.py
+    MASK_PASTE_BACKEND = "numpy"
+
+    # Share the anchors between the data generator workers and the
+    # batch processing workers
+    ANCHOR_CACHE_DIR = os.path.join(DEFAULT_LOGS_DIR, "anchors")
+
+    # Draw the VIA polygons straight into the mini masks, see
+    # ICSIDataset.load_polygons()
+    MINI_MASK_FROM_POLYGONS = True
+
 
 ############################################################
 #  Dataset
 ############################################################
 
+# Class IDs of the region names of the annotations: oocyte, polar body,
+# spermatozoon and pipette. Regions with other names get class 0.
+VIA_CLASS_IDS = {"komorka": 1, "cialko": 2, "plemnik": 3, "pipeta": 4}
+
+# Parsed annotations and image sizes of a subset, see load_via_index()
+VIA_INDEX_FILE = "via_region_index.npz"
+VIA_INDEX_VERSION = 1
+
+
+def read_image_size(path):
+    """Returns the (height, width) of an image read from the header of the
+    file, without decoding the pixels. Falls back to decoding the image if
+    PIL can't read it.
+    """
+    try:
+        from PIL import Image
+        with Image.open(path) as image:
+            width, height = image.size
+        return height, width
+    except (ImportError, IOError):
+        return skimage.io.imread(path).shape[:2]
+
+
+def parse_via_annotations(annotations_path):
+    """Parses the polygons of a VIA annotations file (versions 1.x and
+    2.x) and maps the region names to class IDs with VIA_CLASS_IDS.
+
+    Returns a list of dicts, one per annotated image, with the filename,
+    the polygons as dicts of float64 arrays all_points_x and all_points_y,
+    the region attributes and the class IDs.
+    """
+    # VGG Image Annotator (up to version 1.6) saves each image in the form:
+    # { 'filename': '28503151_5b5b7ec140_b.jpg',
+    #   'regions': {
+    #       '0': {
+    #           'region_attributes': {},
+    #           'shape_attributes': {
+    #               'all_points_x': [...],
+    #               'all_points_y': [...],
+    #               'name': 'polygon'}},
+    #       ... more regions ...
+    #   },
+    #   'size': 100202
+    # }
+    # We mostly care about the x and y coordinates of each region
+    # Note: In VIA 2.0, regions was changed from a dict to a list.
+    with open(annotations_path) as f:
+        annotations = list(json.load(f).values())  # don't need the dict keys
+
+    images = []
+    for a in annotations:
+        # The VIA tool saves images in the JSON even if they don't have any
+        # annotations. Skip unannotated images.
+        if not a['regions']:
+            continue
+        regions = a['regions'].values() if type(a['regions']) is dict else a['regions']
+        polygons = []
+        names = []
+        for r in regions:
+            shape = r['shape_attributes']
+            polygons.append({'name': shape.get('name', 'polygon'),
+                             'all_points_x': np.array(shape['all_points_x'], dtype=np.float64),
+                             'all_points_y': np.array(shape['all_points_y'], dtype=np.float64)})
+            names.append(r['region_attributes'])
+        class_ids = np.array([VIA_CLASS_IDS.get(n.get('name'), 0) for n in names], dtype=np.int32)
+        images.append({'filename': a['filename'], 'polygons': polygons, 'names': names,
+                       'class_ids': class_ids})
+    return images
+
+
+def load_via_index(dataset_dir, workers=8):
+    """Returns the parsed annotations of a dataset subset, as returned by
+    parse_via_annotations(), with the height and width of each image.
+
+    The image sizes are read from the file headers by a pool of threads.
+    Everything is saved to VIA_INDEX_FILE in dataset_dir and reused while
+    via_region_data.json is unchanged. The sizes of the images that didn't
+    change since are reused even when the annotations changed.
+
+    dataset_dir: Directory of the subset with via_region_data.json
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    annotations_path = os.path.join(dataset_dir, "via_region_data.json")
+    index_path = os.path.join(dataset_dir, VIA_INDEX_FILE)
+    stat = os.stat(annotations_path)
+    annotations_stamp = np.array([stat.st_mtime, stat.st_size], dtype=np.float64)
+
+    # Sizes of the images in the index, by file name: (mtime, height, width)
+    known = {}
+    up_to_date = False
+    if os.path.exists(index_path):
+        try:
+            # Read all of it before the file is closed
+            with np.load(index_path, allow_pickle=False) as index:
+                if int(index["version"]) == VIA_INDEX_VERSION:
+                    known = {name: (mtime, height, width) for name, mtime, height, width in zip(
+                        index["filenames"], index["mtimes"], index["heights"], index["widths"])}
+                    up_to_date = np.array_equal(index["annotations_stamp"], annotations_stamp)
+                    if up_to_date:
+                        images = index_images(index)
+        except (IOError, ValueError, KeyError):
+            known = {}
+            up_to_date = False
+
+    if not up_to_date:
+        images = parse_via_annotations(annotations_path)
+
+    paths = [os.path.join(dataset_dir, image['filename']) for image in images]
+    mtimes = np.array([os.stat(path).st_mtime for path in paths], dtype=np.float64)
+    changed = [i for i, image in enumerate(images)
+               if known.get(image['filename'], (None,))[0] != mtimes[i]]
+    with ThreadPoolExecutor(workers) as pool:
+        sizes = dict(zip(changed, pool.map(read_image_size, [paths[i] for i in changed])))
+    for i, image in enumerate(images):
+        if i in sizes:
+            image['height'], image['width'] = (int(d) for d in sizes[i])
+        else:
+            _, image['height'], image['width'] = (int(d) for d in known[image['filename']])
+
+    if changed or not up_to_date:
+        try:
+            save_via_index(index_path, images, mtimes, annotations_stamp)
+        except (IOError, OSError) as e:
+            print("Could not save the dataset index {}: {}".format(index_path, e))
+    return images
+
+
+def save_via_index(index_path, images, mtimes, annotations_stamp):
+    """Saves the images returned by load_via_index() to an index file.
+    The polygons of all the images are concatenated in one array per
+    coordinate.
+    """
+    polygons = [p for image in images for p in image['polygons']]
+    arrays = {
+        "version": np.array(VIA_INDEX_VERSION),
+        "annotations_stamp": annotations_stamp,
+        "filenames": np.array([image['filename'] for image in images], dtype=np.str_),
+        "mtimes": mtimes,
+        "heights": np.array([image['height'] for image in images], dtype=np.int32),
+        "widths": np.array([image['width'] for image in images], dtype=np.int32),
+        "region_counts": np.array([len(image['polygons']) for image in images], dtype=np.int32),
+        "class_ids": np.concatenate([image['class_ids'] for image in images] + [np.zeros(0, np.int32)]),
+        "attributes": np.array([json.dumps(n) for image in images for n in image['names']], dtype=np.str_),
+        "shape_names": np.array([p['name'] for p in polygons], dtype=np.str_),
+        "point_counts": np.array([len(p['all_points_x']) for p in polygons], dtype=np.int32),
+        "points_x": np.concatenate([p['all_points_x'] for p in polygons] + [np.zeros(0)]),
+        "points_y": np.concatenate([p['all_points_y'] for p in polygons] + [np.zeros(0)]),
+    }
+    # Write and rename, so a concurrent reader never sees a partial file
+    temp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, index_path)
+
+
+def index_images(index):
+    """Returns the annotations of an index file saved by save_via_index(),
+    as returned by parse_via_annotations().
+    """
+    # Each array access of an npz file reads it again
+    region_counts, point_counts = index["region_counts"], index["point_counts"]
+    region_ends, point_ends = np.cumsum(region_counts), np.cumsum(point_counts)
+    points_x, points_y = index["points_x"], index["points_y"]
+    class_ids, attributes, shape_names = index["class_ids"], index["attributes"], index["shape_names"]
+    images = []
+    for i, filename in enumerate(index["filenames"]):
+        first, last = region_ends[i] - region_counts[i], region_ends[i]
+        polygons = []
+        for r in range(first, last):
+            start, end = point_ends[r] - point_counts[r], point_ends[r]
+            polygons.append({'name': str(shape_names[r]),
+                             'all_points_x': points_x[start:end],
+                             'all_points_y': points_y[start:end]})
+        images.append({'filename': str(filename), 'polygons': polygons,
+                       'names': [json.loads(a) for a in attributes[first:last]],
+                       'class_ids': class_ids[first:last]})
+    return images
+
+
 class ICSIDataset(utils.Dataset):
 
     def load_icsi(self, dataset_dir, subset):
@@ -110,56 +389,19 @@ class ICSIDataset(utils.Dataset):
         assert subset in ["train", "val"]
         dataset_dir = os.path.join(dataset_dir, subset)
 
-        # Load annotations
-        # VGG Image Annotator (up to version 1.6) saves each image in the form:
-        # { 'filename': '28503151_5b5b7ec140_b.jpg',
-        #   'regions': {
-        #       '0': {
-        #           'region_attributes': {},
-        #           'shape_attributes': {
-        #               'all_points_x': [...],
-        #               'all_points_y': [...],
-        #               'name': 'polygon'}},
-        #       ... more regions ...
-        #   },
-        #   'size': 100202
-        # }
-        # We mostly care about the x and y coordinates of each region
-        # Note: In VIA 2.0, regions was changed from a dict to a list.
-        annotations = json.load(open(os.path.join(dataset_dir, "via_region_data.json")))
-        annotations = list(annotations.values())  # don't need the dict keys
-
-        # The VIA tool saves images in the JSON even if they don't have any
-        # annotations. Skip unannotated images.
-        annotations = [a for a in annotations if a['regions']]
-
-        # Add images
-        for a in annotations:
-            # Get the x, y coordinates of points of the polygons that make up
-            # the outline of each object instance. These are stores in the
-            # shape_attributes (see json format above)
-            # The if condition is needed to support VIA versions 1.x and 2.x.
-            if type(a['regions']) is dict:
-                polygons = [r['shape_attributes'] for r in a['regions'].values()]
-                names = [r['region_attributes'] for r in a['regions'].values()]
-            else:
-                polygons = [r['shape_attributes'] for r in a['regions']]
-                names = [r['region_attributes'] for r in a['regions']]
-
-            # load_mask() needs the image size to convert polygons to masks.
-            # Unfortunately, VIA doesn't include it in JSON, so we must read
-            # the image. This is only managable since the dataset is tiny.
-            image_path = os.path.join(dataset_dir, a['filename'])
-            image = skimage.io.imread(image_path)
-            height, width = image.shape[:2]
-
+        # Load the annotations and the image sizes, which load_mask() needs
+        # to convert polygons to masks. VIA doesn't include the sizes in the
+        # JSON. They are read from the image headers once and then from the
+        # index file, see load_via_index().
+        for a in load_via_index(dataset_dir):
             self.add_image(
                 "icsi",
                 image_id=a['filename'],  # use file name as a unique image id
-                path=image_path,
-                width=width, height=height,
-                polygons=polygons,
-                names=names)
+                path=os.path.join(dataset_dir, a['filename']),
+                width=a['width'], height=a['height'],
+                polygons=a['polygons'],
+                names=a['names'],
+                class_ids=a['class_ids'])
 
     def load_mask(self, image_id):
         """Generate instance masks for an image.
@@ -176,7 +418,6 @@ class ICSIDataset(utils.Dataset):
         # Convert polygons to a bitmap mask of shape
         # [height, width, instance_count]
         info = self.image_info[image_id]
-        class_names = info["names"]
         mask = np.zeros([info["height"], info["width"], len(info["polygons"])],
                         dtype=np.uint8)
 
@@ -184,24 +425,24 @@ class ICSIDataset(utils.Dataset):
             # Get indexes of pixels inside the polygon and set them to 1
             rr, cc = skimage.draw.polygon(p['all_points_y'], p['all_points_x'])
             mask[rr, cc, i] = 1
-        # PG Assign class_ids by reading class_names    
-        class_ids = np.zeros([len(info["polygons"])])
+        # PG Assign class_ids by reading class_names
         # In the ICSI dataset, pictures are labeled with name 'komorka', 'cialko', 'plemnik', 'pipeta' representing:
-        # oocyte, polar body, spermatozoon, pipette.
-        for i, p in enumerate(class_names):
-            # "name" is the attributes name decided when labeling, etc. 'region_attributes': {name:'komorka'}
-            if p['name'] == 'komorka':
-                class_ids[i] = 1
-            elif p['name'] == 'cialko':
-                class_ids[i] = 2
-            elif p['name'] == 'plemnik':
-                class_ids[i] = 3
-            elif p['name'] == 'pipeta':
-                class_ids[i] = 4
-        class_ids = class_ids.astype(int)
+        # oocyte, polar body, spermatozoon, pipette. They are mapped when
+        # the annotations are parsed, see VIA_CLASS_IDS.
+        class_ids = np.asarray(info["class_ids"]).astype(int)
         # Return mask, and array of class IDs of each instance.
         return mask.astype(np.bool), class_ids
 
+    def load_polygons(self, image_id):
+        """Return the polygons of the instances of an image, which
+        load_image_gt() rasterizes straight into mini masks.
+        """
+        info = self.image_info[image_id]
+        if info["source"] != "icsi":
+            return super(self.__class__, self).load_polygons(image_id)
+        polygons = [(p['all_points_y'], p['all_points_x']) for p in info["polygons"]]
+        return polygons, np.asarray(info["class_ids"]).astype(int)
+
     def image_reference(self, image_id):
         """Return the path of the image."""
         info = self.image_info[image_id]
@@ -211,6 +452,27 @@ class ICSIDataset(utils.Dataset):
             super(self.__class__, self).image_reference(image_id)
 
 
+def prepare_cache(dataset_dir, cache_dir, grayscale=False):
+    """Writes the preprocessed training and validation images and their
+    targets to the cache that training reads with --cache, see
+    mrcnn.gt_cache.
+    """
+    from mrcnn import gt_cache
+
+    class CacheConfig(ICSIConfig):
+        IMAGE_CHANNEL_COUNT = 1 if grayscale else 3
+
+    config = CacheConfig()
+    for subset in ["train", "val"]:
+        dataset = ICSIDataset()
+        dataset.load_icsi(dataset_dir, subset)
+        dataset.prepare()
+        start = time.time()
+        path = gt_cache.write_cache(dataset, config, cache_dir)
+        print("Cached the {} images of {} in {:.1f}s: {}".format(
+            dataset.num_images, subset, time.time() - start, path))
+
+
 def train(model, epochs, layers):
     """Train the model."""
     # Training dataset.
@@ -233,17 +495,22 @@ def train(model, epochs, layers):
                 learning_rate=config.LEARNING_RATE,
                 # PG: epochs can be reduced e.g. to 3
                 epochs=epochs,
-                layers=layersedit)
+                layers=layersedit,
+                pipeline=args.input_pipeline)
 
 
 # We don't need splash effect in our implementation because the photos are in grayscale. Code needs refactoring.
 def color_splash(image, mask):
     """Apply color splash effect.
-    image: RGB image [height, width, 3]
+    image: RGB image [height, width, 3], or grayscale image [height, width]
+        or [height, width, 1]
     mask: instance segmentation mask [height, width, instance count]
 
     Returns result image.
     """
+    if image.ndim == 2 or image.shape[-1] == 1:
+        # Grayscale frames have no color to splash, only expand them to RGB
+        return utils.convert_image_channels(image, 3)
     # Make a grayscale copy of the image. The grayscale copy still
     # has 3 RGB channels, though.
     gray = skimage.color.gray2rgb(skimage.color.rgb2gray(image)) * 255
@@ -257,29 +524,17 @@ def color_splash(image, mask):
     return splash
 
 
-def count_oocyte_area(masks, class_ids, stage, count):
-    mask_area = np.sum(masks[:, :, np.where(class_ids == 1)[0]])
-    print("Pole dla samego oocytu (class_id = 1): ", mask_area.astype(np.float32))
-    f = open("pole_oocytu.txt", "a+")
-    f.write("Frame: %d\n" % (count))
-    f.write("Pole oocytu, etap {} : %d\r\n".format(stage) % (mask_area.astype(np.float32)))
-    f.close()
-
-
-def count_bbox_coordinates(masks, class_ids, id, label):
+def count_bbox_coordinates(masks, class_ids, id):
     bbox_coordinates = utils.extract_bboxes(masks[:, :, np.where(class_ids == id)[0]])
     x1 = bbox_coordinates[0][1]
     x2 = bbox_coordinates[0][3]
     y1 = bbox_coordinates[0][0]
     y2 = bbox_coordinates[0][2]
-    f = open("bboxes.txt", "a+")
-    f.write("Bbox {}: {} \r\n".format(label, bbox_coordinates))
-    f.close()
     return x1, x2, y1, y2
 
 
 def count_mask_contours(masks, class_ids, id):
-    contours, _ = cv2.findContours(masks[:, :, np.where(class_ids == id)[0]].astype(np.uint8), cv2.RETR_TREE,
+    contours, _ = cv2.findContours(np.asarray(masks[:, :, np.where(class_ids == id)[0]]).astype(np.uint8), cv2.RETR_TREE,
                                    cv2.CHAIN_APPROX_NONE)
     cnt = contours[0]
     return cnt
@@ -290,20 +545,14 @@ def count_perimeter(cnt):
     return perimeter
 
 
-def count_centroid(cnt, class_name):
+def count_centroid(cnt):
     M = cv2.moments(cnt)
     if M['m00'] != 0:
         cx = int(M['m10'] / M['m00'])
         cy = int(M['m01'] / M['m00'])
-        f = open("params.txt", "a+")
-        f.write("Centroid {}: ({}, {})\r\n".format(class_name, cx, cy))
-        f.close()
     else:
         cx = 0
         cy = 0
-        f = open("params.txt", "a+")
-        f.write("Centroid {}: ({}, {})\r\n".format(class_name, cx, cy))
-        f.close()
     return cx, cy
 
 
@@ -312,219 +561,2386 @@ def count_area(cnt):
     return area
 
 
-def count_circularity_ratio(area, perimeter, count):
+def count_circularity_ratio(area, perimeter):
     if perimeter != 0:
         circratio = 2 * sqrt(pi * area) / perimeter
-        f = open("params.txt", "a+")
-        f.write("Frame: {}\n".format(count))
-        f.write("Circularity ratio oocyte: {}\n".format(circratio))
-        f.close()
         return circratio
 
 
-def save_stage_to_file(stage):
-    f = open("params.txt", "a+")
-    f.write("Stage: {}\r\n".format(stage))
-    f.close()
+############################################################
+#  Stage classification
+############################################################
+
+# Per-frame features used by the stage rules, see extract_features().
+# Counts are of the detections with non-empty boxes. The geometry is of the
+# first instance of a class and NaN if the class is missing. The oocyte and
+# polar body geometry is only computed if no class is detected twice.
+FEATURE_COLUMNS = [
+    "n_oocyte", "n_polar", "n_sperm", "n_pipette",
+    "oocyte_x1", "oocyte_x2", "oocyte_y1", "oocyte_y2",
+    "oocyte_cx", "oocyte_cy", "oocyte_area", "oocyte_perimeter", "oocyte_circularity",
+    "polar_cx", "polar_cy", "polar_location",
+    "sperm_x1", "sperm_x2", "sperm_y1", "sperm_y2",
+    "pipette_x1", "pipette_x2", "pipette_y1", "pipette_y2",
+]
+
+# Stages of the procedure, in the order in which they happen
+STAGES = [
+    "Sperm selection",
+    "Immobilization of the sperm",
+    "Sperm collection",
+    "Oocyte positioning",
+    "Inserting the pipette",
+    "Sperm injection",
+    "Flow of the cell organelles into the pipette",
+    "Removing the pipette",
+]
+
+
+def _classes(f):
+    """Number of different classes detected in each frame."""
+    return sum((f[name] > 0).astype(np.int32) for name in ["n_oocyte", "n_polar", "n_sperm", "n_pipette"])
+
+
+def _detections(f):
+    """Number of detections in each frame."""
+    return f["n_oocyte"] + f["n_polar"] + f["n_sperm"] + f["n_pipette"]
+
+
+def _sperm_in_pipette(f):
+    return (f["sperm_x1"] > f["pipette_x1"]) & (f["sperm_y1"] > f["pipette_y1"]) & \
+           (f["sperm_x2"] < f["pipette_x2"]) & (f["sperm_y2"] < f["pipette_y2"])
+
+
+# Stage rules as (branch, [(stage, rule), ...]) tuples. Branches and rules
+# are functions of a dict of feature columns that return boolean arrays.
+# A frame takes the first branch it matches and, within that branch, the
+# stage of the first rule it matches. A frame that matches a branch but
+# none of its rules has no stage, even if it would match a later branch.
+# Comparisons with missing (NaN) features are False.
+STAGE_RULES = [
+    (lambda f: (f["n_sperm"] > 0) & (_classes(f) == 1) & (_detections(f) > 1), [
+        ("Sperm selection", lambda f: np.ones(f["n_sperm"].shape, bool)),
+    ]),
+    (lambda f: (f["n_sperm"] > 0) & (f["n_pipette"] > 0) & (_classes(f) == 2), [
+        ("Sperm collection", _sperm_in_pipette),
+        ("Immobilization of the sperm", lambda f: np.ones(f["n_sperm"].shape, bool)),
+    ]),
+    (lambda f: (f["n_oocyte"] > 0) & (f["n_pipette"] > 0) & (f["n_sperm"] > 0) &
+               (_classes(f) == _detections(f)), [
+        ("Flow of the cell organelles into the pipette",
+         lambda f: (f["pipette_x1"] < f["oocyte_cx"]) & _sperm_in_pipette(f)),
+        ("Sperm injection",
+         lambda f: (f["sperm_x1"] < f["pipette_x1"]) & (f["pipette_x1"] < f["oocyte_x2"]) &
+                   (f["sperm_y1"] > f["oocyte_y1"])),
+        ("Removing the pipette",
+         lambda f: (f["sperm_x1"] > f["oocyte_x1"]) & (f["sperm_y1"] > f["oocyte_y1"]) &
+                   (f["sperm_x2"] < f["oocyte_x2"]) & (f["sperm_y2"] < f["oocyte_y2"]) &
+                   (f["pipette_x1"] > f["oocyte_x2"])),
+    ]),
+    (lambda f: (f["n_oocyte"] > 0) & (f["n_pipette"] > 0) & (_classes(f) == _detections(f)), [
+        ("Inserting the pipette",
+         lambda f: (f["pipette_x1"] <= f["oocyte_x2"]) & (f["oocyte_circularity"] < 0.85)),
+    ]),
+    (lambda f: (f["n_oocyte"] > 0) & (f["n_polar"] > 0) & (_classes(f) == 2) & (_detections(f) == 2), [
+        ("Oocyte positioning", lambda f: f["polar_location"] < 0.5),
+    ]),
+]
+
+
+def instance_geometry(mask, origin=(0, 0)):
+    """Computes the bounding box and outer contour of an instance mask.
+    The contour is searched in the box only, not in the whole frame.
+
+    mask: [height, width] binary mask, the whole frame or a part of it
+    origin: (y, x) position of the top left corner of mask in the frame,
+        for masks cropped to their boxes, see utils.BoxMasks.
+
+    Returns (x1, x2, y1, y2) with the box coordinates as returned by
+    count_bbox_coordinates(), and the first contour as returned by
+    count_mask_contours(), or None if the mask is empty.
+    """
+    rows = np.where(np.any(mask, axis=1))[0]
+    cols = np.where(np.any(mask, axis=0))[0]
+    if not len(rows):
+        return (0, 0, 0, 0), None
+    y1, y2 = rows[0], rows[-1] + 1
+    x1, x2 = cols[0], cols[-1] + 1
+    # Keep a 1 pixel margin around the mask, as in the full frame
+    top, left = max(y1 - 1, 0), max(x1 - 1, 0)
+    crop = mask[top:y2 + 1, left:x2 + 1].astype(np.uint8)
+    oy, ox = int(origin[0]), int(origin[1])
+    if oy or ox:
+        # A cropped mask that touches the edge of its box has no margin
+        # there, pad it unless the box touches the edge of the frame
+        pad_top, pad_left = int(top == 0 and oy > 0), int(left == 0 and ox > 0)
+        crop = np.pad(crop, ((pad_top, 1), (pad_left, 1)), mode="constant")
+        top, left = top - pad_top, left - pad_left
+    contours, _ = cv2.findContours(crop, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE,
+                                   offset=(int(left) + ox, int(top) + oy))
+    return (x1 + ox, x2 + ox, y1 + oy, y2 + oy), contours[0] if contours else None
+
+
+def extract_features(r):
+    """Extracts the stage features of one frame from its detections.
+    r: detection results of the frame as returned by MaskRCNN.detect()
+
+    Returns a float64 array of len(FEATURE_COLUMNS) values.
+    """
+    f = dict.fromkeys(FEATURE_COLUMNS, np.nan)
+    class_ids = r['class_ids']
+    # Count the detections the same way frame_labels() does
+    labeled = class_ids[np.any(r['rois'], axis=1)] if len(class_ids) else class_ids
+    for class_id, name in zip([1, 2, 3, 4], ["n_oocyte", "n_polar", "n_sperm", "n_pipette"]):
+        f[name] = np.sum(labeled == class_id)
+
+    def first_instance(class_id):
+        i = np.where(class_ids == class_id)[0][0]
+        box, cnt = (0, 0, 0, 0), None
+        if r.get('boxes_only'):
+            # Detected without masks, see FrameBatcher
+            pass
+        elif isinstance(r['masks'], (utils.BoxMasks, utils.RLEMasks)):
+            box, cnt = instance_geometry(r['masks'].crop(i), r['masks'].boxes[i][:2])
+        else:
+            box, cnt = instance_geometry(r['masks'][:, :, i])
+        if cnt is None and box == (0, 0, 0, 0):
+            # No mask, e.g. not in MASK_CLASSES, use the detected box
+            y1, x1, y2, x2 = r['rois'][i]
+            box = (x1, x2, y1, y2)
+        return box, cnt
+
+    if 1 in class_ids and len(set(class_ids)) == len(class_ids):
+        (f["oocyte_x1"], f["oocyte_x2"], f["oocyte_y1"], f["oocyte_y2"]), cnt = first_instance(1)
+        if cnt is not None:
+            f["oocyte_perimeter"] = count_perimeter(cnt)
+            f["oocyte_area"] = count_area(cnt)
+            circratio = count_circularity_ratio(f["oocyte_area"], f["oocyte_perimeter"])
+            f["oocyte_circularity"] = np.nan if circratio is None else circratio
+            f["oocyte_cx"], f["oocyte_cy"] = count_centroid(cnt)
+
+        if 2 in class_ids:
+            _, cnt_polar = first_instance(2)
+            if cnt_polar is not None:
+                f["polar_cx"], f["polar_cy"] = count_centroid(cnt_polar)
+                # d = sqrt((cxp - cxo) ** 2 + (cyp - cyo) ** 2)
+                dx = fabs(f["polar_cx"] - f["oocyte_cx"])
+                dy = f["polar_cy"] - f["oocyte_cy"]
+                if dy != 0:
+                    f["polar_location"] = fabs(dx / dy)
+
+    if 3 in class_ids:
+        (f["sperm_x1"], f["sperm_x2"], f["sperm_y1"], f["sperm_y2"]), _ = first_instance(3)
+
+    if 4 in class_ids:
+        (f["pipette_x1"], f["pipette_x2"], f["pipette_y1"], f["pipette_y2"]), _ = first_instance(4)
+
+    return np.array([f[name] for name in FEATURE_COLUMNS], dtype=np.float64)
+
+
+def classify_stages(features):
+    """Applies the stage rules to the features of many frames at once.
+    features: [frames, len(FEATURE_COLUMNS)] array, one row per frame as
+        returned by extract_features().
+
+    Returns an int32 array with the index of the stage in STAGES of each
+    frame, or -1 if no stage was detected.
+    """
+    features = np.asarray(features, dtype=np.float64).reshape([-1, len(FEATURE_COLUMNS)])
+    f = {name: features[:, i] for i, name in enumerate(FEATURE_COLUMNS)}
+    stages = np.full(features.shape[0], -1, dtype=np.int32)
+    undecided = np.ones(features.shape[0], dtype=bool)
+    for branch, rules in STAGE_RULES:
+        in_branch = undecided & branch(f)
+        for stage, rule in rules:
+            match = in_branch & (stages < 0) & rule(f)
+            stages[match] = STAGES.index(stage)
+        undecided &= ~in_branch
+    return stages
+
+
+def stage_names(stages):
+    """Returns the stage names of an array of stage indices, None for -1."""
+    return [STAGES[i] if i >= 0 else None for i in stages]
+
+
+def stage_transitions(stay=0.995, skip=0.05):
+    """Builds the transition model of the stage decoder. The procedure only
+    moves forward through STAGES: a frame either keeps the stage of the
+    previous frame or moves to a later stage, usually the next one.
+
+    stay: Probability to keep the stage from one frame to the next. About
+        1 - 1 / (average stage length in frames).
+    skip: Ratio of the probabilities to move 2 stages and 1 stage ahead,
+        and so on, for stages the classifier missed.
+
+    Returns a [stages, stages] array of log probabilities from row stage to
+    column stage.
+    """
+    n = len(STAGES)
+    transitions = np.zeros([n, n])
+    for i in range(n):
+        ahead = skip ** np.arange(n - i - 1)
+        if len(ahead):
+            transitions[i, i] = stay
+            transitions[i, i + 1:] = (1 - stay) * ahead / ahead.sum()
+        else:
+            transitions[i, i] = 1
+    with np.errstate(divide="ignore"):
+        return np.log(transitions)
+
+
+def stage_emissions(stages, accuracy=0.7):
+    """Converts classified stages into per-frame stage scores.
+    stages: stage indices as returned by classify_stages()
+    accuracy: Probability that a detected stage is the true stage. Frames
+        with no detected stage score all stages the same.
 
+    Returns a [frames, len(STAGES)] array of log probabilities.
+    """
+    stages = np.asarray(stages)
+    n = len(STAGES)
+    emissions = np.full([len(stages), n], (1 - accuracy) / (n - 1))
+    detected = np.where(stages >= 0)[0]
+    emissions[detected, stages[detected]] = accuracy
+    emissions[stages < 0] = 1. / n
+    return np.log(emissions)
+
+
+def viterbi(emissions, transitions, initial=None):
+    """Finds the most likely stage sequence of a video.
+    emissions: [frames, stages] log scores, see stage_emissions()
+    transitions: [stages, stages] log transition probabilities, see
+        stage_transitions()
+    initial: log probabilities of the stage of the first frame. Uniform if
+        None, a video may start in any stage.
+
+    Returns an int32 array with the stage index of each frame.
+    """
+    frames, n = emissions.shape
+    if not frames:
+        return np.zeros([0], dtype=np.int32)
+    if initial is None:
+        initial = np.full(n, -np.log(n))
+    states = np.arange(n)
+    backpointers = np.zeros([frames, n], dtype=np.int32)
+    delta = initial + emissions[0]
+    for t in range(1, frames):
+        scores = delta[:, np.newaxis] + transitions
+        backpointers[t] = np.argmax(scores, axis=0)
+        delta = scores[backpointers[t], states] + emissions[t]
+    path = np.zeros([frames], dtype=np.int32)
+    path[-1] = np.argmax(delta)
+    for t in range(frames - 1, 0, -1):
+        path[t - 1] = backpointers[t, path[t]]
+    return path
+
+
+class OnlineStageDecoder(object):
+    """Fixed-lag Viterbi decoder that smooths the stages while a video is
+    processed.
+
+    The stage of a frame is decided `lag` frames later, from the best path
+    through the frames seen so far, so memory and latency are bounded. The
+    decided stages never go back to an earlier stage. With a long enough lag
+    the result is the same as viterbi() over the whole video. Very short
+    lags let a single misclassified frame lock in a late stage; use at
+    least a few tens of frames.
+    """
 
-def detect_and_color_splash(model, image_path=None, video_path=None):
-    assert image_path or video_path
+    def __init__(self, lag=50, transitions=None, accuracy=0.7):
+        self.lag = lag
+        self.transitions = stage_transitions() if transitions is None else transitions
+        self.accuracy = accuracy
+        self.delta = None
+        # Frame indices and backpointers of the frames not decided yet
+        self.frames = []
+        self.backpointers = []
+        self.last_stage = 0
+
+    def _decide(self, stage):
+        self.last_stage = max(self.last_stage, stage)
+        return self.last_stage
+
+    def push(self, frame, stage):
+        """Adds the classified stage of the next frame.
+        frame: frame index
+        stage: stage index as returned by classify_stages(), -1 for none
+
+        Returns a list of (frame, stage index) tuples of the frames that
+        were decided, in frame order.
+        """
+        emission = stage_emissions([stage], self.accuracy)[0]
+        if self.delta is None:
+            self.delta = -np.log(len(STAGES)) + emission
+            backpointer = np.arange(len(STAGES), dtype=np.int32)
+        else:
+            scores = self.delta[:, np.newaxis] + self.transitions
+            backpointer = np.argmax(scores, axis=0).astype(np.int32)
+            self.delta = scores[backpointer, np.arange(len(STAGES))] + emission
+        self.frames.append(frame)
+        self.backpointers.append(backpointer)
+        if len(self.frames) <= self.lag:
+            return []
+        # Backtrack the best path to the oldest undecided frame
+        state = np.argmax(self.delta)
+        for backpointer in reversed(self.backpointers[1:]):
+            state = backpointer[state]
+        decided = (self.frames.pop(0), self._decide(int(state)))
+        self.backpointers.pop(0)
+        return [decided]
+
+    def flush(self):
+        """Decides the remaining frames at the end of the video. Returns
+        the same list of tuples as push().
+        """
+        if not self.frames:
+            return []
+        path = [int(np.argmax(self.delta))]
+        for backpointer in reversed(self.backpointers[1:]):
+            path.append(int(backpointer[path[-1]]))
+        decided = [(frame, self._decide(stage)) for frame, stage in zip(self.frames, reversed(path))]
+        self.frames = []
+        self.backpointers = []
+        return decided
+
+
+def run_length_encode(frames, stages):
+    """Merges consecutive frames with the same stage into runs.
+    frames: sorted frame indices
+    stages: stage index of each frame
+
+    Returns a list of (start_frame, end_frame, stage index) tuples,
+    end_frame inclusive.
+    """
+    frames = np.asarray(frames)
+    stages = np.asarray(stages)
+    if not len(frames):
+        return []
+    starts = np.concatenate([[0], np.where(stages[1:] != stages[:-1])[0] + 1])
+    ends = np.concatenate([starts[1:] - 1, [len(frames) - 1]])
+    return [(int(frames[s]), int(frames[e]), int(stages[s])) for s, e in zip(starts, ends)]
+
+
+class TimelineBuilder(object):
+    """Builds the run-length-encoded stage timeline from the decided stages
+    of an OnlineStageDecoder, one frame at a time.
+    """
+
+    def __init__(self):
+        self.run = None
+
+    def add(self, frame, stage):
+        """Adds the next frame. Returns the list of runs that were closed,
+        as (start_frame, end_frame, stage index) tuples.
+        """
+        if self.run is not None and self.run[2] == stage:
+            self.run[1] = frame
+            return []
+        closed = self.close()
+        self.run = [frame, frame, stage]
+        return closed
+
+    def close(self):
+        """Closes the open run. Returns it in a list, or an empty list."""
+        closed = [tuple(self.run)] if self.run is not None else []
+        self.run = None
+        return closed
+
+
+############################################################
+#  Results
+############################################################
+
+class ResultsSink(object):
+    """Collects the per-frame analysis results of a video and stores them
+    in an SQLite database.
+
+    Records are buffered in memory and written in blocks of `flush_every`
+    frames. The database has these tables:
+    detections: one row per detected instance with the columns listed in
+        DETECTION_COLUMNS. The geometry columns (centroid, area, perimeter,
+        circularity) are set for the instances used by the stage rules and
+        NULL for the others.
+    frames: one row per frame with the frame index and the detected stage
+        (NULL if no stage was detected).
+    features: one row per frame with the frame index and the stage features
+        of FEATURE_COLUMNS (NULL if missing), see extract_features().
+    timeline: the smoothed stages as runs of frames with the first and last
+        frame (inclusive) and the stage, see smooth_results(). Filled while
+        processing if an OnlineStageDecoder is given.
+    masks: the masks of the detections if store_masks is set, one row per
+        instance with the frame index, the index of the instance in the
+        frame, the image size and the run-length encoded mask as a COCO
+        string, see utils.RLEMasks and load_masks().
+
+    Usage in the video loop:
+        sink.begin_frame(count)
+        sink.add_detections(r)
+        sink.update(class_id, cx=..., cy=...)
+        sink.set_features(features)
+        sink.end_frame(stage)
+    """
+
+    DETECTION_COLUMNS = ["frame", "class_id", "class_name", "score", "y1", "x1", "y2", "x2",
+                         "cx", "cy", "area", "perimeter", "circularity"]
+
+    def __init__(self, path, class_names, flush_every=500, decoder=None, store_masks=False,
+                 resume=False):
+        """
+        decoder: Optional OnlineStageDecoder to smooth the stages with.
+        store_masks: If True, also store the run-length encoded masks.
+        resume: If True, keep the records of an existing database, to
+            continue a run after truncate(). Otherwise its tables are
+            replaced, so a new run doesn't add a second copy of the rows.
+        """
+        self.path = path
+        self.class_names = class_names
+        self.flush_every = flush_every
+        self.decoder = decoder
+        self.store_masks = store_masks
+        self.timeline = TimelineBuilder()
+        # The pipeline writes records from its analysis thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if not resume:
+            for table in ["detections", "frames", "features", "timeline", "masks"]:
+                self.connection.execute("DROP TABLE IF EXISTS {}".format(table))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS detections (frame INTEGER, class_id INTEGER, class_name TEXT, "
+            "score REAL, y1 INTEGER, x1 INTEGER, y2 INTEGER, x2 INTEGER, cx REAL, cy REAL, "
+            "area REAL, perimeter REAL, circularity REAL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS frames (frame INTEGER PRIMARY KEY, stage TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS features (frame INTEGER PRIMARY KEY, {})".format(
+                ", ".join("{} REAL".format(name) for name in FEATURE_COLUMNS)))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS timeline (start_frame INTEGER, end_frame INTEGER, stage TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS masks (frame INTEGER, instance INTEGER, "
+            "height INTEGER, width INTEGER, counts TEXT)")
+        self.connection.commit()
+        self.frame_rows = []
+        self.detection_rows = []
+        self.feature_rows = []
+        self.timeline_rows = []
+        self.mask_rows = []
+        self.current_frame = None
+        self.current_rows = []
+        self.current_masks = []
+        self.current_features = None
+        # A checkpoint may flush from another pipeline thread
+        self.lock = threading.Lock()
+
+    def begin_frame(self, count):
+        self.current_frame = count
+        self.current_rows = []
+        self.current_masks = []
+        self.current_features = None
+
+    def add_detections(self, r):
+        """Adds one record per detected instance of the current frame."""
+        for box, class_id, score in zip(r['rois'], r['class_ids'], r['scores']):
+            y1, x1, y2, x2 = [int(v) for v in box]
+            self.current_rows.append([self.current_frame, int(class_id), self.class_names[class_id],
+                                      float(score), y1, x1, y2, x2, None, None, None, None, None])
+        if self.store_masks and len(r['class_ids']):
+            masks = utils.to_rle_masks(r['masks'])
+            height, width = masks.image_shape
+            self.current_masks = [(self.current_frame, i, height, width, counts)
+                                  for i, counts in enumerate(masks.to_strings())]
+
+    def update(self, class_id, **fields):
+        """Sets geometry fields of the first instance of the given class in
+        the current frame. Field names are taken from DETECTION_COLUMNS."""
+        for row in self.current_rows:
+            if row[1] == class_id:
+                for name, value in fields.items():
+                    row[self.DETECTION_COLUMNS.index(name)] = None if value is None else float(value)
+                return
+
+    def set_features(self, features):
+        """Sets the stage features of the current frame, a row of
+        FEATURE_COLUMNS values."""
+        self.current_features = [None if np.isnan(v) else float(v) for v in features]
+
+    def end_frame(self, stage):
+        with self.lock:
+            self.detection_rows.extend(self.current_rows)
+            self.mask_rows.extend(self.current_masks)
+            self.frame_rows.append((self.current_frame, stage))
+            if self.current_features is not None:
+                self.feature_rows.append([self.current_frame] + self.current_features)
+        if self.decoder is not None:
+            stage_id = STAGES.index(stage) if stage else -1
+            for frame, smoothed in self.decoder.push(self.current_frame, stage_id):
+                self.add_runs(self.timeline.add(frame, smoothed))
+        self.current_rows = []
+        self.current_masks = []
+        if len(self.frame_rows) >= self.flush_every:
+            self.flush()
+
+    def add_runs(self, runs):
+        """Adds closed runs of the smoothed stage timeline."""
+        with self.lock:
+            self.timeline_rows.extend((start, end, STAGES[stage]) for start, end, stage in runs)
+
+    def flush(self):
+        """Writes the buffered records to the database."""
+        with self.lock:
+            if not self.frame_rows and not self.timeline_rows:
+                return
+            self.connection.executemany(
+                "INSERT INTO detections VALUES ({})".format(", ".join("?" * len(self.DETECTION_COLUMNS))),
+                self.detection_rows)
+            self.connection.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?)", self.frame_rows)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO features VALUES ({})".format(", ".join("?" * (len(FEATURE_COLUMNS) + 1))),
+                self.feature_rows)
+            self.connection.executemany("INSERT INTO timeline VALUES (?, ?, ?)", self.timeline_rows)
+            self.connection.executemany("INSERT INTO masks VALUES (?, ?, ?, ?, ?)", self.mask_rows)
+            self.connection.commit()
+            self.mask_rows = []
+            self.detection_rows = []
+            self.frame_rows = []
+            self.feature_rows = []
+            self.timeline_rows = []
+
+    def count(self, before=None):
+        """Returns the number of detection records in the database, only
+        of the frames before the given frame index if set.
+        """
+        with self.lock:
+            if before is None:
+                return self.connection.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM detections WHERE frame < ?", (before,)).fetchone()[0]
+
+    def truncate(self, frame):
+        """Deletes the records of the given frame and all later frames from
+        the database, e.g. the records written after the last checkpoint.
+        Returns the number of detection records left.
+        """
+        self.flush()
+        with self.lock:
+            for table in ["detections", "frames", "features", "masks"]:
+                self.connection.execute("DELETE FROM {} WHERE frame >= ?".format(table), (frame,))
+            # The smoothed timeline depends on the later frames too
+            self.connection.execute("DELETE FROM timeline")
+            self.connection.commit()
+        return self.count()
+
+    def close(self):
+        if self.decoder is not None:
+            # Decide the frames still within the decoder's lag
+            for frame, smoothed in self.decoder.flush():
+                self.add_runs(self.timeline.add(frame, smoothed))
+            self.add_runs(self.timeline.close())
+        self.flush()
+        self.connection.close()
+
+
+def load_results(path):
+    """Reads a results database written by ResultsSink.
+
+    Returns two dicts of Numpy arrays, one array per column:
+    detections: the columns of ResultsSink.DETECTION_COLUMNS, sorted by frame.
+        Missing geometry values are NaN.
+    frames: "frame" and "stage", sorted by frame. Frames without a stage
+        have an empty stage name.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute("SELECT * FROM detections ORDER BY frame, rowid").fetchall()
+        frame_rows = connection.execute("SELECT frame, stage FROM frames ORDER BY frame").fetchall()
+    finally:
+        connection.close()
+    columns = list(zip(*rows)) if rows else [[]] * len(ResultsSink.DETECTION_COLUMNS)
+    detections = {}
+    for name, values in zip(ResultsSink.DETECTION_COLUMNS, columns):
+        if name == "class_name":
+            detections[name] = np.array(values, dtype=str)
+        elif name in ["frame", "class_id", "y1", "x1", "y2", "x2"]:
+            detections[name] = np.array(values, dtype=np.int32)
+        else:
+            detections[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float32)
+    frames = {
+        "frame": np.array([f for f, _ in frame_rows], dtype=np.int32),
+        "stage": np.array([s or "" for _, s in frame_rows], dtype=str),
+    }
+    return detections, frames
+
+
+def load_masks(path, frame):
+    """Reads the masks of one frame stored by a ResultsSink with
+    store_masks set.
+
+    Returns a utils.RLEMasks with the masks in the order of the detections
+    of the frame, or None if the database has no masks.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute(
+            "SELECT height, width, counts FROM masks WHERE frame = ? ORDER BY instance", (frame,)).fetchall()
+        size = rows[0][:2] if rows else connection.execute("SELECT height, width FROM masks LIMIT 1").fetchone()
+    finally:
+        connection.close()
+    if size is None:
+        return None
+    return utils.RLEMasks.from_strings([counts for _, _, counts in rows], size)
+
+
+def load_features(path):
+    """Reads the stage features of a results database written by
+    ResultsSink.
+
+    Returns the frame indices and a [frames, len(FEATURE_COLUMNS)] array of
+    features with NaN for missing values, both sorted by frame.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute(
+            "SELECT frame, {} FROM features ORDER BY frame".format(", ".join(FEATURE_COLUMNS))).fetchall()
+    finally:
+        connection.close()
+    table = np.array(rows, dtype=np.float64).reshape([-1, len(FEATURE_COLUMNS) + 1])
+    return table[:, 0].astype(np.int32), table[:, 1:]
+
+
+def classify_results(path):
+    """Classifies the stages of all frames of a results database again from
+    the stored features, e.g. after the stage rules changed, and updates
+    the stages in the database. The detector is not run.
+
+    Returns the frame indices and the stage indices, see classify_stages().
+    """
+    frames, features = load_features(path)
+    stages = classify_stages(features)
+    connection = sqlite3.connect(path)
+    try:
+        connection.executemany("UPDATE frames SET stage = ? WHERE frame = ?",
+                               zip(stage_names(stages), frames.tolist()))
+        connection.commit()
+    finally:
+        connection.close()
+    return frames, stages
+
+
+def smooth_results(path, lag=None, transitions=None, accuracy=0.7):
+    """Smooths the stages of a results database over time and stores the
+    run-length-encoded timeline in its timeline table.
+
+    lag: None to decode the whole video with viterbi(), or the lag in frames
+        of an OnlineStageDecoder, to get the same timeline as when smoothing
+        while processing.
+    transitions, accuracy: see stage_transitions() and stage_emissions()
+
+    Returns the timeline as a list of (start_frame, end_frame, stage name)
+    tuples, end_frame inclusive.
+    """
+    transitions = stage_transitions() if transitions is None else transitions
+    _, frames = load_results(path)
+    stages = np.array([STAGES.index(stage) if stage else -1 for stage in frames["stage"]], dtype=np.int32)
+    if lag is None:
+        smoothed = viterbi(stage_emissions(stages, accuracy), transitions)
+    else:
+        decoder = OnlineStageDecoder(lag, transitions, accuracy)
+        decided = []
+        for frame, stage in zip(frames["frame"], stages):
+            decided.extend(decoder.push(frame, stage))
+        decided.extend(decoder.flush())
+        smoothed = np.array([stage for _, stage in decided], dtype=np.int32)
+    timeline = [(start, end, STAGES[stage]) for start, end, stage in run_length_encode(frames["frame"], smoothed)]
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS timeline (start_frame INTEGER, end_frame INTEGER, stage TEXT)")
+        connection.execute("DELETE FROM timeline")
+        connection.executemany("INSERT INTO timeline VALUES (?, ?, ?)", timeline)
+        connection.commit()
+    finally:
+        connection.close()
+    return timeline
+
+
+def load_timeline(path):
+    """Returns the smoothed stage timeline of a results database as a list
+    of (start_frame, end_frame, stage name) tuples.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT start_frame, end_frame, stage FROM timeline ORDER BY start_frame").fetchall()
+    finally:
+        connection.close()
+
+
+def print_timeline(timeline):
+    for start, end, stage in timeline:
+        print("{:6d} - {:6d}  {}".format(start, end, stage))
+
+
+def render_text_results(path, output_dir="."):
+    """Writes the results database in the text format of the earlier
+    versions of this script: bboxes.txt, params.txt and pole_oocytu.txt.
+    The smoothed stage timeline, if any, is written to timeline.txt.
+    """
+    detections, frames = load_results(path)
+    timeline = load_timeline(path)
+    if timeline:
+        with open(os.path.join(output_dir, "timeline.txt"), "w") as f:
+            for start, end, stage in timeline:
+                f.write("Frames {} - {}: {}\r\n".format(start, end, stage))
+    bboxes = open(os.path.join(output_dir, "bboxes.txt"), "w")
+    params = open(os.path.join(output_dir, "params.txt"), "w")
+    areas = open(os.path.join(output_dir, "pole_oocytu.txt"), "w")
+    try:
+        starts = np.searchsorted(detections["frame"], frames["frame"], side="left")
+        ends = np.searchsorted(detections["frame"], frames["frame"], side="right")
+        for count, stage, start, end in zip(frames["frame"], frames["stage"], starts, ends):
+            bboxes.write("Frame: %d\n" % (count))
+            ids = np.arange(start, end)
+            for class_id in np.unique(detections["class_id"][ids]):
+                class_ids = ids[detections["class_id"][ids] == class_id]
+                boxes = np.stack([detections[c][class_ids] for c in ["y1", "x1", "y2", "x2"]], axis=1)
+                bboxes.write("Bbox {}: {} \r\n".format(detections["class_name"][class_ids[0]], boxes))
+            for i in ids:
+                if np.isnan(detections["cx"][i]):
+                    continue
+                if not np.isnan(detections["circularity"][i]):
+                    params.write("Frame: {}\n".format(count))
+                    params.write("Circularity ratio oocyte: {}\n".format(detections["circularity"][i]))
+                params.write("Centroid {}: ({}, {})\r\n".format(
+                    detections["class_name"][i], int(detections["cx"][i]), int(detections["cy"][i])))
+                if detections["class_id"][i] == 1 and not np.isnan(detections["area"][i]):
+                    areas.write("Frame: %d\n" % (count))
+                    areas.write("Pole oocytu, etap {} : %d\r\n".format(stage) % (detections["area"][i]))
+            if stage:
+                params.write("Stage: {}\r\n".format(stage))
+    finally:
+        bboxes.close()
+        params.close()
+        areas.close()
+
+
+def frame_labels(r, class_names):
+    """Returns the class names of the detections of one frame, skipping
+    empty boxes the same way visualize.draw_instances() does.
+    """
+    return [class_names[class_id] for box, class_id in zip(r['rois'], r['class_ids'])
+            if np.any(box)]
+
+
+def define_frame_stage(r, sink=None):
+    """Applies the ICSI stage rules to the detections of one frame, see
+    extract_features() and classify_stages().
+
+    r: detection results of the frame as returned by MaskRCNN.detect()
+    sink: Optional ResultsSink to record the features and the geometry of
+        the oocyte and polar body in. The sink's current frame must be the
+        frame of r.
+
+    Returns the name of the detected stage or None.
+    """
+    features = extract_features(r)
+    if sink is not None:
+        f = dict(zip(FEATURE_COLUMNS, features))
+        if not np.isnan(f["oocyte_cx"]):
+            sink.update(1, cx=f["oocyte_cx"], cy=f["oocyte_cy"], area=f["oocyte_area"],
+                        perimeter=f["oocyte_perimeter"], circularity=f["oocyte_circularity"])
+        if not np.isnan(f["polar_cx"]):
+            sink.update(2, cx=f["polar_cx"], cy=f["polar_cy"])
+        sink.set_features(features)
+    return stage_names(classify_stages(features))[0]
+
+
+def analyze_frame(r, count, class_names, sink):
+    """Geometry and stage analysis of one video frame. The detections,
+    their geometry and the stage are recorded in the given ResultsSink.
+
+    Returns the detected stage name or None.
+    """
+    labels = frame_labels(r, class_names)
+    print(labels)
+
+    sink.begin_frame(count)
+    sink.add_detections(r)
+    stage = define_frame_stage(r, sink)
+    sink.end_frame(stage)
+    if stage:
+        print(stage)
+    return stage
+
+
+def render_frame(frame, r, stage, class_names, colors, headless=False):
+    """Draws the color splash, the detections and the stage name on a frame.
+
+    headless: If True, draw with OpenCV only and never import matplotlib.
+
+    Returns the annotated frame.
+    """
+    height, width = frame.shape[:2]
+    stage_color = (255, 0, 0)
+    font_size = 0.6
+
+    # Color splash
+    splash = color_splash(frame, r['masks'])
+    # RGB -> BGR to save image to video
+    # PG: splash = splash[..., ::-1]
+    if headless:
+        frame, _ = visualize.draw_instances(splash, r['rois'], r['masks'], r['class_ids'],
+                                            class_names, r['scores'], colors)
+    else:
+        frame, _ = visualize.display_instances_video(splash, r['rois'], r['masks'], r['class_ids'],
+                                                     class_names, r['scores'], colors)
+    if stage:
+        frame = cv2.putText(
+            frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size, stage_color, 2
+        )
+    return frame
+
+
+############################################################
+#  Video pipeline
+############################################################
+
+class FrameBatcher(object):
+    """Collects consecutive video frames into micro-batches and runs each
+    micro-batch through the model with a single batched predict call.
+
+    The batch size is the BATCH_SIZE of the model config, so set
+    IMAGES_PER_GPU to the number of frames to batch.
+
+    mask_format: Format of the masks of the detections, see
+        MaskRCNN.unmold_detections(). "box" avoids building full size masks
+        when the frames are only analyzed.
+    masks_on_demand: Run the mask head only on frames that need the
+        geometry of the oocyte, see needs_masks(). The other frames are
+        detected without masks, their detections have empty masks and
+        "boxes_only" set, and their features use the detection boxes. A
+        micro-batch runs with masks if the last frame before it needed
+        them; frames of a micro-batch without masks that turn out to need
+        them are run again with masks.
+    """
+
+    def __init__(self, model, mask_format="dense", masks_on_demand=False):
+        self.model = model
+        self.mask_format = mask_format
+        self.masks_on_demand = masks_on_demand
+        self.batch_size = model.config.BATCH_SIZE
+        self.pending = []
+        # Number of frames processed and number of frames the model ran on
+        self.frame_count = 0
+        self.detect_count = 0
+        # Number of frames detected without masks
+        self.boxes_only_count = 0
+        self.with_masks = True
+
+    def push(self, count, frame):
+        """Adds a frame to the current micro-batch.
+        count: frame index
+        frame: RGB image [height, width, 3]
+
+        Returns a list of (count, frame, r) tuples, in frame order, for the
+        frames whose detections are ready. Empty until the batch is full.
+        """
+        self.pending.append((count, frame))
+        if len(self.pending) < self.batch_size:
+            return []
+        return self.flush()
+
+    def flush(self):
+        """Runs detection on the pending frames, even if the micro-batch is
+        not full. Returns the same list of tuples as push().
+        """
+        if not self.pending:
+            return []
+        items, self.pending = self.pending, []
+        results = self.detect(self.model, [frame for _, frame in items])
+        self.frame_count += len(items)
+        self.detect_count += len(items)
+        return [(count, frame, r) for (count, frame), r in zip(items, results)]
+
+    def detect(self, model, frames):
+        """Runs the model on frames, with or without masks, see
+        masks_on_demand. Returns the list of detections.
+        """
+        if not self.masks_on_demand:
+            return model.detect_batch(frames, verbose=0, mask_format=self.mask_format)
+        results = model.detect_batch(frames, verbose=0, mask_format=self.mask_format,
+                                     with_masks=self.with_masks)
+        if not self.with_masks:
+            again = [i for i, r in enumerate(results) if needs_masks(r)]
+            if again:
+                redone = model.detect_batch([frames[i] for i in again], verbose=0,
+                                            mask_format=self.mask_format)
+                for i, r in zip(again, redone):
+                    results[i] = r
+            for i, r in enumerate(results):
+                if i not in again:
+                    r['boxes_only'] = True
+            self.boxes_only_count += len(frames) - len(again)
+        self.with_masks = needs_masks(results[-1])
+        return results
+
+
+def needs_masks(r):
+    """True if the stage features of a frame need masks: the area,
+    circularity and centroid of the oocyte, and the centroid of the polar
+    body, are only computed when an oocyte is detected.
+    """
+    return 1 in r['class_ids']
+
+
+class KeyframeBatcher(FrameBatcher):
+    """Runs the model on keyframes only and propagates the detections to
+    the frames in between with dense optical flow.
+
+    A frame is a keyframe if it's `interval` frames after the last keyframe,
+    or if the mean absolute difference between its downscaled grayscale copy
+    and the one of the last keyframe is above `diff_threshold` gray levels.
+    Keyframes are still batched, so a micro-batch holds BATCH_SIZE keyframes
+    and the frames that follow them.
+
+    interval: Keyframe period in frames. None to rely on diff_threshold only.
+    diff_threshold: Frame difference that forces a keyframe. None to disable.
+    flow_scale: Scale of the grayscale frames used for the frame difference
+        and the optical flow. Smaller is faster but less precise.
+    aligned: If True, every frame whose index is a multiple of `interval` is
+        a keyframe, also when a frame difference forced a keyframe shortly
+        before. The keyframes then don't depend on where in the video the
+        processing started, so a video processed in chunks that start at
+        multiples of `interval` gets the same results as in one run.
+    """
+
+    def __init__(self, model, interval=10, diff_threshold=None, flow_scale=0.5, aligned=False,
+                 mask_format="dense"):
+        assert interval or diff_threshold, "Set a keyframe interval or a difference threshold"
+        super(KeyframeBatcher, self).__init__(model, mask_format=mask_format)
+        self.interval = interval
+        self.diff_threshold = diff_threshold
+        self.flow_scale = flow_scale
+        self.aligned = aligned
+        self.last_key_count = None
+        self.last_key_gray = None
+        # Last emitted frame and its detections, the source of propagation
+        self.prev_gray = None
+        self.prev_result = None
+
+    def small_gray(self, frame):
+        """Returns the downscaled grayscale copy of a frame."""
+        if frame.shape[-1] == 1:
+            gray = np.ascontiguousarray(frame[..., 0])
+        else:
+            gray = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY)
+        if self.flow_scale != 1:
+            gray = cv2.resize(gray, None, fx=self.flow_scale, fy=self.flow_scale,
+                              interpolation=cv2.INTER_AREA)
+        return gray
+
+    def is_keyframe(self, count, gray):
+        if self.last_key_gray is None:
+            return True
+        if self.interval and self.aligned and count % self.interval == 0:
+            return True
+        if self.interval and count - self.last_key_count >= self.interval:
+            return True
+        if self.diff_threshold is not None:
+            return np.mean(cv2.absdiff(gray, self.last_key_gray)) > self.diff_threshold
+        return False
+
+    def push(self, count, frame):
+        gray = self.small_gray(frame)
+        key = self.is_keyframe(count, gray)
+        if key:
+            self.last_key_count = count
+            self.last_key_gray = gray
+        self.pending.append((count, frame, gray, key))
+        # Frames after the last emitted one only need propagation,
+        # and a full batch of keyframes can be run right away.
+        keyframes = sum(1 for item in self.pending if item[3])
+        if keyframes == 0 or keyframes >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self.pending:
+            return []
+        items, self.pending = self.pending, []
+        keyframes = [frame for _, frame, _, key in items if key]
+        detections = iter(self.model.detect_batch(keyframes, verbose=0, mask_format=self.mask_format)
+                          if keyframes else [])
+        ready = []
+        for count, frame, gray, key in items:
+            if key:
+                r = next(detections)
+            else:
+                r = propagate_detections(self.prev_result, self.prev_gray, gray, frame.shape)
+            self.prev_gray = gray
+            self.prev_result = r
+            ready.append((count, frame, r))
+        self.frame_count += len(items)
+        self.detect_count += len(keyframes)
+        return ready
+
+
+def propagate_detections(r, prev_gray, gray, image_shape):
+    """Moves the detections of the previous frame to the current frame.
+
+    The masks are warped with the dense optical flow between the two
+    frames and the boxes are recomputed from the warped masks. Class IDs
+    and scores are kept.
+
+    r: detections of the previous frame as returned by MaskRCNN.detect()
+    prev_gray, gray: downscaled grayscale copies of the previous and the
+        current frame, see KeyframeBatcher.small_gray()
+    image_shape: [height, width, ...] of the full resolution frame
+
+    Returns a dict in the same format as MaskRCNN.detect().
+    """
+    masks = r['masks']
+    if masks.shape[-1] == 0:
+        return dict(r)
+    height, width = image_shape[:2]
+    # Backward flow: for each pixel of the current frame, where it was in
+    # the previous one. Scaled to full resolution pixels.
+    flow = cv2.calcOpticalFlowFarneback(gray, prev_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+    flow[..., 0] *= width / gray.shape[1]
+    flow[..., 1] *= height / gray.shape[0]
+    grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32),
+                                 np.arange(height, dtype=np.float32))
+    map_x = grid_x + flow[..., 0]
+    map_y = grid_y + flow[..., 1]
+
+    warped = np.zeros(masks.shape, dtype=bool)
+    for i in range(masks.shape[-1]):
+        warped[:, :, i] = cv2.remap(masks[:, :, i].astype(np.uint8), map_x, map_y,
+                                    cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT) > 0
+    rois = utils.extract_bboxes(warped)
+    # Masks that vanished keep their box, moved by the mean flow inside it
+    for i in np.where(~np.any(rois, axis=1))[0]:
+        y1, x1, y2, x2 = r['rois'][i]
+        dx, dy = np.mean(flow[y1:y2, x1:x2].reshape(-1, 2), axis=0) if y2 > y1 and x2 > x1 else (0, 0)
+        shift = np.array([-dy, -dx, -dy, -dx])
+        rois[i] = np.clip(np.round(r['rois'][i] + shift), 0, [height, width, height, width])
+    return {
+        "rois": rois,
+        "class_ids": r['class_ids'],
+        "scores": r['scores'],
+        "masks": warped,
+    }
+
+
+def crop_model(model, image_dim=512):
+    """Returns a copy of the model that shares its network and weights but
+    resizes the images to image_dim x image_dim, for RoiBatcher. Any
+    multiple of 64 works, as the network itself has no fixed input size.
+    """
+    import copy
+
+    assert image_dim % 64 == 0, "image_dim must be a multiple of 64"
+    assert getattr(model, "interpreter", None) is None, \
+        "A quantized backbone only runs images of the size it was converted for"
+
+    class CropConfig(model.config.__class__):
+        IMAGE_RESIZE_MODE = "square"
+        IMAGE_MIN_DIM = image_dim
+        IMAGE_MAX_DIM = image_dim
+
+    cropped = copy.copy(model)
+    cropped.config = CropConfig()
+    return cropped
+
+
+def crop_around(rois, image_shape, margin=0.25):
+    """Returns the crop (y1, x1, y2, x2) that contains all the boxes, grown
+    by margin times its height and width on each side and clipped to the
+    image, or None if there are no boxes or the clipped crop is empty, e.g.
+    for a flat box on the edge of the image.
+    """
+    if not len(rois):
+        return None
+    y1, x1 = np.min(rois[:, :2], axis=0)
+    y2, x2 = np.max(rois[:, 2:], axis=0)
+    dy, dx = int(round((y2 - y1) * margin)), int(round((x2 - x1) * margin))
+    height, width = image_shape[:2]
+    y1, x1 = int(max(0, y1 - dy)), int(max(0, x1 - dx))
+    y2, x2 = int(min(height, y2 + dy)), int(min(width, x2 + dx))
+    if y2 <= y1 or x2 <= x1:
+        return None
+    return y1, x1, y2, x2
+
+
+def uncrop_detections(r, crop, image_shape):
+    """Moves detections made on a crop of a frame to frame coordinates.
+    Dense masks are padded to the frame size, masks in their boxes are
+    moved with their boxes.
+
+    crop: (y1, x1, y2, x2) of the crop in the frame
+    image_shape: [height, width, ...] of the frame
+
+    Returns a dict in the same format as MaskRCNN.detect().
+    """
+    y1, x1, y2, x2 = crop
+    offset = np.array([y1, x1, y1, x1])
+    masks = r['masks']
+    if isinstance(masks, np.ndarray):
+        full = np.zeros(tuple(image_shape[:2]) + masks.shape[2:], dtype=masks.dtype)
+        full[y1:y2, x1:x2] = masks
+    else:
+        full = utils.BoxMasks(masks.boxes + offset, [masks.crop(i) for i in range(len(masks))],
+                              image_shape)
+        if isinstance(masks, utils.RLEMasks):
+            full = utils.RLEMasks.from_box_masks(full)
+    return dict(r, rois=r['rois'] + offset, masks=full)
+
+
+class RoiBatcher(FrameBatcher):
+    """Runs the model on a crop of each frame around the detections of the
+    previous frames, with a smaller input size, and on the whole frame
+    only from time to time.
+
+    In the later stages everything happens around the oocyte and the
+    pipette, so the crop is much smaller than the frame. The crop is the
+    union of the boxes of the last detections, see crop_around(), and the
+    detections in it are moved back to frame coordinates. The frames of a
+    micro-batch share the crop of the last frame before the batch.
+
+    A whole frame is run first, then every `refresh_interval` frames, and
+    after a crop that lost objects or confidence: fewer detections than on
+    the last whole frame, or a mean score more than score_drop below it.
+
+    crop_model: The model to run the crops with, see crop_model().
+    margin: Margin around the detections, relative to their size.
+    """
+
+    def __init__(self, model, crop_model, refresh_interval=30, margin=0.25, score_drop=0.05,
+                 mask_format="dense", masks_on_demand=False):
+        super(RoiBatcher, self).__init__(model, mask_format=mask_format,
+                                         masks_on_demand=masks_on_demand)
+        self.crop_model = crop_model
+        self.refresh_interval = refresh_interval
+        self.margin = margin
+        self.score_drop = score_drop
+        # Crop of the next frames, None to run the whole frame
+        self.crop = None
+        self.pending_crop = None
+        self.last_full_count = None
+        # Number of detections and mean score of the last whole frame
+        self.full_detections = 0
+        self.full_score = 0.0
+        # Number of frames the model ran on a crop of
+        self.crop_count = 0
+
+    def next_crop(self, count):
+        if self.crop is None or count - self.last_full_count >= self.refresh_interval:
+            return None
+        return self.crop
+
+    def push(self, count, frame):
+        ready = []
+        crop = self.next_crop(count)
+        if self.pending and crop != self.pending_crop:
+            ready = self.flush()
+            crop = self.next_crop(count)
+        if crop is None:
+            self.last_full_count = count
+        self.pending_crop = crop
+        self.pending.append((count, frame))
+        if len(self.pending) >= self.batch_size:
+            ready += self.flush()
+        return ready
+
+    def flush(self):
+        if not self.pending:
+            return []
+        items, self.pending = self.pending, []
+        crop = self.pending_crop
+        if crop is None:
+            results = self.detect(self.model, [frame for _, frame in items])
+            self.full_detections = len(results[-1]['rois'])
+            self.full_score = np.mean(results[-1]['scores']) if self.full_detections else 0.0
+        else:
+            y1, x1, y2, x2 = crop
+            results = self.detect(self.crop_model, [frame[y1:y2, x1:x2] for _, frame in items])
+            results = [uncrop_detections(r, crop, frame.shape) for (_, frame), r in zip(items, results)]
+            self.crop_count += len(items)
+        self.frame_count += len(items)
+        self.detect_count += len(items)
+
+        # Crop of the next frames
+        r = results[-1]
+        lost = crop is not None and (len(r['rois']) < self.full_detections or
+                                     np.mean(r['scores']) < self.full_score - self.score_drop)
+        self.crop = None if lost else crop_around(r['rois'], items[-1][1].shape, self.margin)
+        return [(count, frame, r) for (count, frame), r in zip(items, results)]
+
+
+# Marks the end of the frame stream in the pipeline queues
+_PIPELINE_END = object()
 
-    class_names = ['BG', 'oocyte', 'polar body', 'spermatozoon', 'pipette']
+
+class StageCounter(object):
+    """Throughput counters of one stage of the video pipeline."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy_time = 0.0
+
+    def add(self, seconds, frames=1):
+        self.frames += frames
+        self.busy_time += seconds
+
+    def report(self, elapsed):
+        """Returns a one line summary of the stage throughput.
+        elapsed: wall-clock duration of the whole run in seconds.
+        """
+        busy_fps = self.frames / self.busy_time if self.busy_time else 0.
+        wall_fps = self.frames / elapsed if elapsed else 0.
+        return "{:10} {:6d} frames  busy {:8.2f}s  {:7.2f} fps busy  {:7.2f} fps wall".format(
+            self.name, self.frames, self.busy_time, busy_fps, wall_fps)
+
+
+def _pipeline_get(q, stop):
+    """Takes the next item from a pipeline queue. Returns _PIPELINE_END
+    if the pipeline was stopped while waiting."""
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return _PIPELINE_END
+
+
+def _pipeline_put(q, item, stop):
+    """Puts an item in a bounded pipeline queue. Blocks while the queue is
+    full, which gives backpressure on the upstream stages. Returns False
+    if the pipeline was stopped while waiting."""
+    while True:
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def _pipeline_thread(name, fn, in_queue, out_queue, counter, stop, errors):
+    """Starts a thread that applies fn to the items of in_queue in order and
+    forwards the results to out_queue. If in_queue is None, fn is a
+    generator function that produces the items of the stage.
+    """
+    def run():
+        try:
+            items = fn() if in_queue is None else None
+            while not stop.is_set():
+                if in_queue is None:
+                    start = time.time()
+                    try:
+                        result = next(items)
+                    except StopIteration:
+                        break
+                else:
+                    item = _pipeline_get(in_queue, stop)
+                    if item is _PIPELINE_END:
+                        break
+                    start = time.time()
+                    result = fn(item)
+                counter.add(time.time() - start)
+                if out_queue is not None and not _pipeline_put(out_queue, result, stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if out_queue is not None:
+                _pipeline_put(out_queue, _PIPELINE_END, stop)
+
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_video_pipeline(batcher, frames, vwriter, sink, class_names, colors, queue_size=8,
+                       headless=False, checkpointer=None):
+    """Processes a video with decode, inference, analysis and encoding
+    running as separate stages connected by bounded queues.
+
+    Decoding, analysis and encoding run in worker threads. Inference runs
+    in the calling thread because the Keras model is bound to its graph and
+    session, and processes micro-batches of frames with the given
+    FrameBatcher or KeyframeBatcher. Every stage handles the frames in order, so the output
+    has the same frame order as the input. When the model falls behind,
+    the bounded queues fill up and block the decoder.
+
+    frames: iterable of (count, RGB frame) tuples, see read_frames(). It's
+        consumed in the decode thread.
+
+    The analysis results are recorded in the given ResultsSink. If vwriter
+    is None, no annotated video is rendered and the encode stage is left
+    out. The last stage reports every completed frame to the given
+    Checkpointer.
+
+    Returns a list of StageCounter objects, one per stage.
+    """
+    stop = threading.Event()
+    errors = []
+    counters = [StageCounter(name) for name in ["decode", "inference", "analysis", "encode"]]
+    decode_counter, inference_counter, analysis_counter, encode_counter = counters
+    decoded = queue.Queue(maxsize=queue_size)
+    detected = queue.Queue(maxsize=queue_size)
+    analyzed = queue.Queue(maxsize=queue_size) if vwriter is not None else None
+
+    def decode():
+        return iter(frames)
+
+    def analyze(item):
+        count, frame, r = item
+        print("frame: ", count)
+        stage = analyze_frame(r, count, class_names, sink)
+        if vwriter is None and checkpointer is not None:
+            checkpointer.frame_done(count)
+        return count, frame, r, stage
+
+    def encode(item):
+        count, frame, r, stage = item
+        # Add image to video writer
+        vwriter.write(render_frame(frame, r, stage, class_names, colors, headless=headless))
+        if checkpointer is not None:
+            checkpointer.frame_done(count)
+
+    threads = [
+        _pipeline_thread("decode", decode, None, decoded, decode_counter, stop, errors),
+        _pipeline_thread("analysis", analyze, detected, analyzed, analysis_counter, stop, errors),
+    ]
+    if vwriter is not None:
+        threads.append(_pipeline_thread("encode", encode, analyzed, None, encode_counter, stop, errors))
+    else:
+        counters.remove(encode_counter)
+    try:
+        while not stop.is_set():
+            item = _pipeline_get(decoded, stop)
+            start = time.time()
+            if item is _PIPELINE_END:
+                ready = batcher.flush()
+            else:
+                ready = batcher.push(*item)
+            if ready:
+                inference_counter.add(time.time() - start, frames=len(ready))
+            for result in ready:
+                if not _pipeline_put(detected, result, stop):
+                    break
+            if item is _PIPELINE_END:
+                break
+        _pipeline_put(detected, _PIPELINE_END, stop)
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+    if errors:
+        raise errors[0]
+    return counters
+
+
+def stitch_videos(paths, output_path, fps, size):
+    """Concatenates the frames of the given videos into one MJPG video."""
+    vwriter = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    try:
+        for path in paths:
+            vcapture = cv2.VideoCapture(path)
+            while True:
+                success, frame = vcapture.read()
+                if not success:
+                    break
+                vwriter.write(frame)
+            vcapture.release()
+    finally:
+        vwriter.release()
+
+
+class SegmentedVideoWriter(object):
+    """Video writer that writes the video as a series of segment files.
+
+    An AVI file is only readable after its writer was released, so a video
+    that is still being written is lost when the process dies. rotate()
+    closes the current segment, which keeps the frames written so far, and
+    continues in a new one. finish() joins the segments into the output
+    file.
+    """
+
+    def __init__(self, file_name, fps, size, segments=None):
+        """
+        file_name: Path of the final video.
+        segments: Paths of already completed segments, e.g. from a
+            checkpoint. New segments are numbered after them.
+        """
+        self.file_name = file_name
+        self.fps = fps
+        self.size = size
+        self.segments = list(segments or [])
+        self.vwriter = None
+        self.frames = 0
+        self._open()
+
+    def _open(self):
+        root, ext = os.path.splitext(self.file_name)
+        self.path = "{}.part{:04d}{}".format(root, len(self.segments), ext)
+        self.vwriter = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'MJPG'),
+                                       self.fps, self.size)
+        self.frames = 0
+
+    def write(self, frame):
+        self.vwriter.write(frame)
+        self.frames += 1
+
+    def rotate(self):
+        """Closes the current segment and starts a new one. Returns the list
+        of completed segments.
+        """
+        self.release()
+        self._open()
+        return list(self.segments)
+
+    def release(self):
+        """Closes the current segment without joining the segments. Empty
+        segments are dropped.
+        """
+        if self.vwriter is None:
+            return
+        self.vwriter.release()
+        self.vwriter = None
+        if self.frames:
+            self.segments.append(self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def finish(self):
+        """Closes the current segment and joins all segments into the
+        output file.
+        """
+        self.release()
+        if len(self.segments) == 1:
+            os.replace(self.segments[0], self.file_name)
+        else:
+            stitch_videos(self.segments, self.file_name, self.fps, self.size)
+            for path in self.segments:
+                os.remove(path)
+        self.segments = []
+
+
+class Checkpointer(object):
+    """Periodically saves the progress of a video run to a JSON file, so
+    the run can be resumed after a crash, see process_video(resume=True).
+
+    A checkpoint is saved every `every` completed frames. It flushes the
+    ResultsSink, closes the current segment of the SegmentedVideoWriter and
+    records the index of the next frame to process, the number of
+    detection records in the sink and the completed video segments. Records
+    of later frames that are already in the sink are deleted on resume.
+    """
+
+    def __init__(self, path, every, sink, vwriter, state):
+        """
+        path: Path of the checkpoint file.
+        vwriter: SegmentedVideoWriter or None if no video is written.
+        state: dict with the settings of the run, saved with the progress.
+        """
+        self.path = path
+        self.every = every
+        self.sink = sink
+        self.vwriter = vwriter
+        self.state = state
+        self.completed = 0
+
+    def frame_done(self, count):
+        """Called after frame `count` and all frames before it are written
+        to the sink and the video.
+        """
+        self.state["next_frame"] = count + 1
+        self.completed += 1
+        if self.completed % self.every == 0:
+            self.save()
+
+    def save(self):
+        self.sink.flush()
+        # Records of frames after the checkpoint may already be flushed
+        self.state["sink_offset"] = self.sink.count(before=self.state["next_frame"])
+        if self.vwriter is not None:
+            self.state["segments"] = self.vwriter.rotate()
+        # Write to a temporary file first, so a crash while saving keeps
+        # the previous checkpoint
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+        print("Checkpoint at frame {}".format(self.state["next_frame"]))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_checkpoint(path):
+    """Returns the state saved by a Checkpointer or None if there is no
+    checkpoint file.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class VideoDecodeError(IOError):
+    """Raised when a video cannot be opened or no frame can be decoded."""
+    pass
+
+
+def seek_video(vcapture, frame):
+    """Moves a video capture to the given frame index.
+
+    Seeking with CAP_PROP_POS_FRAMES is fast but lands on the wrong frame for
+    some codecs and containers. If the capture doesn't report the requested
+    position after seeking, the video is rewound and decoded up to the frame
+    instead.
+    """
+    if frame <= 0:
+        return
+    vcapture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+    if int(vcapture.get(cv2.CAP_PROP_POS_FRAMES)) == frame:
+        return
+    vcapture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for _ in range(frame):
+        if not vcapture.grab():
+            break
+
+
+def read_frames(vcapture, start_frame=0, end_frame=None, channels=3):
+    """Generates the frames of a video capture.
+    start_frame: Index of the first frame to read.
+    end_frame: Index of the frame to stop at (exclusive). None to read to
+        the end of the video.
+    channels: 3 for RGB frames, 1 for grayscale frames of shape
+        [height, width, 1], for models with IMAGE_CHANNEL_COUNT = 1.
+
+    Yields (count, frame) tuples with the frame index in the video and the
+    frame as RGB or grayscale image.
+    """
+    seek_video(vcapture, start_frame)
+    count = start_frame
+    while end_frame is None or count < end_frame:
+        success, frame = vcapture.read()
+        if not success:
+            return
+        if channels == 1:
+            yield count, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)[..., np.newaxis]
+        else:
+            # OpenCV returns images as BGR, convert to RGB
+            yield count, frame[..., ::-1]
+        count += 1
+
+
+def process_video(model, video_path, output_dir=None, pipeline=False, queue_size=8,
+                  keyframe_interval=None, keyframe_threshold=None, keyframe_aligned=False,
+                  results_path=None, text_output=False, headless=False, write_video=True,
+                  start_frame=0, end_frame=None, colors=None, checkpoint_every=None, resume=False,
+                  smooth=False, smooth_lag=None, store_masks=False, roi_interval=None, roi_dim=512,
+                  roi_margin=0.25, masks_on_demand=False):
+    """Runs the model on a video and stores the per-frame detections,
+    geometry and stages in a ResultsSink.
+
+    output_dir: Directory for the annotated video, the results database and
+        the text results. If None, the outputs are written to the current
+        directory with timestamped file names.
+    results_path: Path of the results database. Defaults to a file in
+        output_dir.
+    headless: If True, never import matplotlib and never touch the OpenCV
+        HighGUI windowing functions, for servers with no display.
+    write_video: If False, skip rendering and encoding the annotated video
+        and only store the results, so the run is bound by inference.
+    start_frame, end_frame: Range of frames to process, end_frame exclusive.
+        The results keep the frame indices of the whole video.
+    keyframe_aligned: See KeyframeBatcher.
+    colors: Colors of the classes in the annotated video. Random if None.
+    checkpoint_every: Save a checkpoint every this many frames to
+        results_path + ".checkpoint.json", see Checkpointer. The annotated
+        video is then written in segments that are joined at the end.
+        Rounded up to a multiple of keyframe_interval.
+    resume: Continue the run of the checkpoint next to results_path after
+        its last completed frame. The frames and video segments completed
+        before the checkpoint are kept, later records are deleted from the
+        results. Starts from start_frame if there is no checkpoint.
+    smooth: Smooth the stages over the whole video after processing and
+        store the stage timeline, see smooth_results().
+    smooth_lag: Smooth the stages while processing with an
+        OnlineStageDecoder with this lag in frames and store the timeline.
+    store_masks: Also store the run-length encoded masks of the detections,
+        see load_masks().
+    roi_interval: If set, run the model on a crop around the detections of
+        the previous frames, with images of roi_dim x roi_dim, and on the
+        whole frame every roi_interval frames, see RoiBatcher.
+    roi_margin: Margin of the crop around the detections, see crop_around().
+    masks_on_demand: Run the mask head only on the frames whose stage needs
+        the geometry of the oocyte, see FrameBatcher. The other frames are
+        drawn without masks.
+
+    Raises VideoDecodeError if the video cannot be opened or has no frames
+    in the given range.
+
+    Returns a dict with the paths of the outputs and frame counts and timing
+    of the run.
+    """
+    class_names = CLASS_NAMES
+    start = time.time()
+
+    # Video capture
+    vcapture = cv2.VideoCapture(video_path)
+    if not vcapture.isOpened():
+        raise VideoDecodeError("Cannot open video {}".format(video_path))
+    width = int(vcapture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(vcapture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    print(width, height)
+    fps = vcapture.get(cv2.CAP_PROP_FPS)
+    print("FPS: ", fps)
+
+    # Output file names
+    now = datetime.datetime.now()
+    if output_dir is None:
+        output_dir = "."
+        video_name = "splash_{:%Y%m%dT%H%M%S}.avi".format(now)
+        results_name = "results_{:%Y%m%dT%H%M%S}.sqlite".format(now)
+    else:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        video_name = "splash.avi"
+        results_name = "results.sqlite"
+
+    results_path = results_path or os.path.join(output_dir, results_name)
+    file_name = os.path.join(output_dir, video_name) if write_video else None
+
+    # Checkpoint of an earlier run to resume
+    checkpoint_path = results_path + ".checkpoint.json"
+    state = load_checkpoint(checkpoint_path) if resume else None
+    if state is not None:
+        assert state["video"] == os.path.abspath(video_path), \
+            "Checkpoint {} is for video {}".format(checkpoint_path, state["video"])
+        start_frame = state["next_frame"]
+        end_frame = state["end_frame"]
+        file_name = state["output"]
+        print("Resuming from frame {}".format(start_frame))
+    elif resume:
+        print("No checkpoint at {}, starting from frame {}".format(checkpoint_path, start_frame))
+    if checkpoint_every and keyframe_interval:
+        checkpoint_every = -(-checkpoint_every // keyframe_interval) * keyframe_interval
+
+    # Define codec and create video writer. A resumed video continues
+    # after the segments of the checkpoint, also without new checkpoints.
+    if file_name and (checkpoint_every or state is not None):
+        vwriter = SegmentedVideoWriter(file_name, fps, (width, height),
+                                       segments=state["segments"] if state else None)
+    elif file_name:
+        vwriter = cv2.VideoWriter(file_name,
+                                  cv2.VideoWriter_fourcc(*'MJPG'),
+                                  fps, (width, height))
+    else:
+        vwriter = None
+    # Per-frame detections, geometry and stages
+    decoder = OnlineStageDecoder(smooth_lag) if smooth_lag else None
+    # The records of an earlier run are kept only to resume it
+    sink = ResultsSink(results_path, class_names, decoder=decoder, store_masks=store_masks,
+                       resume=state is not None)
+    if state is not None:
+        # Drop the records written after the checkpoint
+        offset = sink.truncate(start_frame)
+        if offset != state["sink_offset"]:
+            print("Warning: {} detection records before frame {}, the checkpoint has {}".format(
+                offset, start_frame, state["sink_offset"]))
+    if checkpoint_every:
+        checkpointer = Checkpointer(checkpoint_path, checkpoint_every, sink, vwriter, {
+            "video": os.path.abspath(video_path),
+            "output": file_name,
+            "results": results_path,
+            "end_frame": end_frame,
+            "next_frame": start_frame,
+            "sink_offset": sink.count(),
+            "segments": [],
+        })
+    else:
+        checkpointer = None
+
+    # PG:
+    if colors is None:
+        colors = visualize.random_colors(len(class_names))
+    # Detect objects in micro-batches of BATCH_SIZE frames, optionally
+    # on keyframes only. Without a video to draw, the masks are only
+    # analyzed and can stay in their boxes, or be encoded right away.
+    if write_video:
+        mask_format = "dense"
+    else:
+        mask_format = "rle" if store_masks else "box"
+    assert not (roi_interval and (keyframe_interval or keyframe_threshold is not None)), \
+        "Use either keyframes or crops"
+    assert not (masks_on_demand and (keyframe_interval or keyframe_threshold is not None)), \
+        "Keyframes need the masks to propagate them"
+    assert not (masks_on_demand and store_masks), "Masks on demand can't store the masks of all frames"
+    if roi_interval:
+        batcher = RoiBatcher(model, crop_model(model, roi_dim), refresh_interval=roi_interval,
+                             margin=roi_margin, mask_format=mask_format,
+                             masks_on_demand=masks_on_demand)
+    elif keyframe_interval or keyframe_threshold is not None:
+        batcher = KeyframeBatcher(model, interval=keyframe_interval,
+                                  diff_threshold=keyframe_threshold, aligned=keyframe_aligned,
+                                  mask_format=mask_format)
+    else:
+        batcher = FrameBatcher(model, mask_format=mask_format, masks_on_demand=masks_on_demand)
+    # Grayscale models get grayscale frames, which are only expanded to RGB
+    # to draw them
+    frames = read_frames(vcapture, start_frame, end_frame, channels=model.config.IMAGE_CHANNEL_COUNT)
+    try:
+        if pipeline:
+            pipeline_start = time.time()
+            counters = run_video_pipeline(batcher, frames, vwriter, sink, class_names, colors,
+                                          queue_size=queue_size, headless=headless,
+                                          checkpointer=checkpointer)
+            elapsed = time.time() - pipeline_start
+            print("Pipeline throughput ({:.2f}s):".format(elapsed))
+            for counter in counters:
+                print(counter.report(elapsed))
+        else:
+            if not headless:
+                from matplotlib import pyplot as plt
+
+            def write_ready(ready):
+                for frame_count, frame, r in ready:
+                    print("frame: ", frame_count)
+                    stage = analyze_frame(r, frame_count, class_names, sink)
+                    # Add image to video writer
+                    if vwriter is not None:
+                        vwriter.write(render_frame(frame, r, stage, class_names, colors,
+                                                   headless=headless))
+                    if checkpointer is not None:
+                        checkpointer.frame_done(frame_count)
+
+            for count, frame in frames:
+                # Next image
+                if not headless:
+                    plt.clf()
+                    plt.close()
+                write_ready(batcher.push(count, frame))
+                if not headless and cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            write_ready(batcher.flush())
+        # Completed, join the video segments and drop the checkpoint
+        if isinstance(vwriter, SegmentedVideoWriter):
+            vwriter.finish()
+        if checkpointer is not None:
+            checkpointer.remove()
+        elif state is not None and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    finally:
+        vcapture.release()
+        if vwriter is not None:
+            vwriter.release()
+        if not headless:
+            cv2.destroyAllWindows()
+        sink.close()
+
+    print("Model ran on {} of {} frames".format(batcher.detect_count, batcher.frame_count))
+    if roi_interval:
+        print("{} of them on crops".format(batcher.crop_count))
+    if masks_on_demand:
+        print("{} of them without masks".format(batcher.boxes_only_count))
+    if not batcher.frame_count and state is None:
+        raise VideoDecodeError("No frames decoded from video {}".format(video_path))
+    if smooth or (smooth_lag and state is not None):
+        # A resumed run has no decoder state of the frames before the
+        # checkpoint, so its timeline is decoded again from all frames
+        smooth_results(results_path, lag=None if smooth else smooth_lag)
+    if smooth or smooth_lag:
+        print("Stage timeline:")
+        print_timeline(load_timeline(results_path))
+    print("Results saved to ", results_path)
+    if text_output:
+        render_text_results(results_path, output_dir)
+    if file_name:
+        print("Saved to ", file_name)
+    return {
+        "video": video_path,
+        "output": file_name,
+        "results": results_path,
+        "frames": batcher.frame_count,
+        "detected_frames": batcher.detect_count,
+        "seconds": time.time() - start,
+    }
+
+
+def detect_and_color_splash(model, image_path=None, video_path=None, pipeline=False, queue_size=8,
+                            keyframe_interval=None, keyframe_threshold=None,
+                            results_path=None, text_output=False, headless=False, write_video=True,
+                            checkpoint_every=None, resume=False, smooth=False, smooth_lag=None,
+                            store_masks=False, roi_interval=None, roi_dim=512, masks_on_demand=False):
+    """Runs the model on an image or a video. See process_video() for the
+    video options.
+    """
+    assert image_path or video_path
 
     # Image or video?
     if image_path:
         # Run model detection and generate the color splash effect
-        print("Running on {}".format(args.image))
+        print("Running on {}".format(image_path))
         # Read image
-        image = skimage.io.imread(args.image)
+        image = skimage.io.imread(image_path)
         # Detect objects
-        r = model.detect([image], verbose=1)[0]
+        r = model.detect_batch([image], verbose=1)[0]
         # Color splash
         splash = color_splash(image, r['masks'])
         # Save output
         file_name = "splash_{:%Y%m%dT%H%M%S}.png".format(datetime.datetime.now())
         skimage.io.imsave(file_name, splash)
+        print("Saved to ", file_name)
     elif video_path:
-        import cv2
-        # Video capture
-        vcapture = cv2.VideoCapture(video_path)
-        width = int(vcapture.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(vcapture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        print(width, height)
-        fps = vcapture.get(cv2.CAP_PROP_FPS)
-        print("FPS: ", fps)
-
-        # Define codec and create video writer
-        file_name = "splash_{:%Y%m%dT%H%M%S}.avi".format(datetime.datetime.now())
-        vwriter = cv2.VideoWriter(file_name,
-                                  cv2.VideoWriter_fourcc(*'MJPG'),
-                                  fps, (width, height))
+        process_video(model, video_path, pipeline=pipeline, queue_size=queue_size,
+                      keyframe_interval=keyframe_interval, keyframe_threshold=keyframe_threshold,
+                      results_path=results_path, text_output=text_output,
+                      headless=headless, write_video=write_video,
+                      checkpoint_every=checkpoint_every, resume=resume,
+                      smooth=smooth, smooth_lag=smooth_lag, store_masks=store_masks,
+                      roi_interval=roi_interval, roi_dim=roi_dim, masks_on_demand=masks_on_demand)
 
-        count = 0
-        success = True
-        # PG:
-        colors = visualize.random_colors(len(class_names))
-        while success:
-            print("frame: ", count)
-            # Read next image
-            plt.clf()
-            plt.close()
-            success, frame = vcapture.read()
-
-            if success:
-                # OpenCV returns images as BGR, convert to RGB
-                frame = frame[..., ::-1]
-                # Detect objects
-                r = model.detect([frame], verbose=0)[0]
-                # Color splash
-                splash = color_splash(frame, r['masks'])
-                # RGB -> BGR to save image to video
-                # PG: splash = splash[..., ::-1]
-
-                frame, labels = visualize.display_instances_video(splash, r['rois'], r['masks'], r['class_ids'],
-                                                                  class_names, r['scores'], colors)
-
-                f = open("bboxes.txt", "a+")
-                f.write("Frame: %d\n" % (count))
-                f.close()
-
-                print(labels)
-                oocyte_counter = 0
-                for elem in labels:
-                    if elem == "oocyte":
-                        oocyte_counter += 1
-                #print(labels, oocyte_counter)
-
-                if 1 in r['class_ids'] and len(set(r['class_ids'])) == len(r['class_ids']):
-                    x1_oocyte, x2_oocyte, y1_oocyte, y2_oocyte = count_bbox_coordinates(r['masks'], r['class_ids'], 1,
-                                                                                        class_names[1])
-                    cnt = count_mask_contours(r['masks'], r['class_ids'], 1)
-                    perimeter = count_perimeter(cnt)
-                    area = count_area(cnt)
-                    circratio = count_circularity_ratio(area, perimeter, count)
-                    cxo, cyo = count_centroid(cnt, class_names[1])
-
-                    if 2 in r['class_ids']:
-                        x1_polar, x2_polar, y1_polar, y2_polar = count_bbox_coordinates(r['masks'], r['class_ids'], 2,
-                                                                                        class_names[2])
-                        cnt_polar = count_mask_contours(r['masks'], r['class_ids'], 2)
-                        cxp, cyp = count_centroid(cnt_polar, class_names[2])
-                        # d = sqrt((cxp - cxo) ** 2 + (cyp - cyo) ** 2)
-                        dx = fabs(cxp - cxo)
-                        dy = cyp - cyo
-                        if dy != 0:
-                            location = fabs(dx / dy)
-
-                if 3 in r['class_ids']:
-                    x1, x2, y1, y2 = count_bbox_coordinates(r['masks'], r['class_ids'], 3, class_names[3])
-
-                if 4 in r['class_ids']:
-                    x1_pipette, x2_pipette, y1_pipette, y2_pipette = count_bbox_coordinates(r['masks'], r['class_ids'],
-                                                                                            4, class_names[4])
-
-                stage_color = (255, 0, 0)
-                font_size = 0.6
-
-                if labels:
-                    if 'spermatozoon' in labels and len(set(labels)) == 1 and len(labels) > 1:
-                        stage = "Sperm selection"
-                        print(stage)
-                        frame = cv2.putText(
-                            frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size, stage_color,
-                            2
-                        )
-                        save_stage_to_file(stage)
-
-                    elif ('spermatozoon' in labels) and ('pipette' in labels) and len(set(labels)) == 2:
-                        if (x1 > x1_pipette) and (y1 > y1_pipette) and (x2 < x2_pipette) and (y2 < y2_pipette):
-                            stage = "Sperm collection"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-                        else:
-                            stage = "Immobilization of the sperm"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-
-                    elif ('oocyte' in labels) and ('pipette' in labels) and ('spermatozoon' in labels) and len(
-                            set(labels)) == len(labels):
-                        if x1_pipette < cxo and (x1 > x1_pipette) and (y1 > y1_pipette) and (x2 < x2_pipette) and (y2 < y2_pipette):
-                            stage = "Flow of the cell organelles into the pipette"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-                        elif x1 < x1_pipette < x2_oocyte and y1 > y1_oocyte:
-                            stage = "Sperm injection"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-                        elif (x1 > x1_oocyte) and (y1 > y1_oocyte) and (x2 < x2_oocyte) and (y2 < y2_oocyte) and (
-                                x1_pipette > x2_oocyte):
-                            stage = "Removing the pipette"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-
-                    elif ('oocyte' in labels) and ('pipette' in labels) and len(labels) == len(set(labels)):
-                        if x1_pipette <= x2_oocyte and circratio < 0.85:
-                            stage = "Inserting the pipette"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-
-                    elif ('oocyte' in labels) and ('polar body' in labels) and len(labels) == len(set(labels)) == 2:
-                        if location < 0.5:
-                            stage = "Oocyte positioning"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size, stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-
-                    elif ('oocyte' in labels) and ('pipette' in labels) and len(labels) == len(set(labels)):
-                        if x1_pipette <= x2_oocyte and circratio < 0.85:
-                            stage = "Inserting the pipette"
-                            print(stage)
-                            frame = cv2.putText(
-                                frame, stage, (width - 900, height - 650), cv2.FONT_HERSHEY_COMPLEX, font_size,
-                                stage_color, 2
-                            )
-                            save_stage_to_file(stage)
-
-                # Add image to video writer
-                vwriter.write(frame)
-                count += 1
 
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
-            else:
-                break
+############################################################
+#  Batch processing
+############################################################
 
-        vcapture.release()
-        vwriter.release()
-        cv2.destroyAllWindows()
-    print("Saved to ", file_name)
+VIDEO_EXTENSIONS = [".avi", ".mp4", ".mov", ".mkv", ".mpg", ".mpeg", ".wmv"]
+
+
+def list_videos(source):
+    """Lists the videos to process in a batch.
+    source: A directory, whose video files are listed in name order, or a
+        manifest text file with one video path per line. Empty lines and
+        lines starting with # are skipped. Relative paths in a manifest are
+        relative to the manifest's directory.
+
+    Returns a list of video paths.
+    """
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in sorted(os.listdir(source))
+                if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS]
+    base_dir = os.path.dirname(os.path.abspath(source))
+    videos = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            videos.append(os.path.join(base_dir, line))
+    return videos
+
+
+def inference_config(batch_size=1, grayscale=False, all_masks=False):
+    """Returns the ICSI config for running inference on micro-batches of
+    batch_size frames.
+    grayscale: Run a model trained on single channel frames, see --grayscale.
+    all_masks: Compute the masks of all the classes, not only of the
+        oocyte and the polar body, e.g. for the color splash.
+    """
+    class InferenceConfig(ICSIConfig):
+        # Batch size = GPU_COUNT * IMAGES_PER_GPU. Video frames are run
+        # through the model in micro-batches of --batch-size frames.
+        # PG zwiekszylam IMAGES_PER_GPU z 1 do 16
+        GPU_COUNT = 1
+        IMAGES_PER_GPU = batch_size
+        IMAGE_CHANNEL_COUNT = 1 if grayscale else 3
+        # The stage features only use the masks of the oocyte and the polar
+        # body, the spermatozoa and the pipette use their boxes
+        MASK_CLASSES = None if all_masks else [1, 2]
+
+    return InferenceConfig()
+
+
+def resolve_weights(model, weights):
+    """Returns the path of the weights file to load.
+    weights: Path to a .h5 file, or "coco", "last" or "imagenet".
+    """
+    if weights.lower() == "coco":
+        weights_path = COCO_WEIGHTS_PATH
+        # Download weights file
+        if not os.path.exists(weights_path):
+            utils.download_trained_weights(weights_path)
+    elif weights.lower() == "last":
+        # Find last trained weights
+        weights_path = model.find_last()
+    elif weights.lower() == "imagenet":
+        # Start from ImageNet trained weights
+        weights_path = model.get_imagenet_weights()
+    else:
+        weights_path = weights
+    return weights_path
+
+
+def load_inference_model(weights, logs=DEFAULT_LOGS_DIR, batch_size=1, tflite=None, grayscale=False,
+                         all_masks=False):
+    """Returns the model to run inference on micro-batches of batch_size
+    frames with.
+    weights: Path to a .h5 file, or "coco", "last" or "imagenet" to build
+        the Keras model and load the weights, or path to a frozen graph
+        (.pb) written by export_model() to run it without Keras.
+    tflite: Optional path to a quantized backbone written by
+        quantize_model(), to run the backbone on the CPU with TFLite.
+    grayscale: Build the model for single channel frames.
+    all_masks: Compute the masks of all the classes, for the annotated
+        video. A frozen graph computes the masks it was exported with, so
+        it must have been exported with all_masks too.
+    """
+    if weights.lower().endswith(".pb"):
+        from mrcnn.export import FrozenMaskRCNN, metadata_path
+        assert tflite is None, "A frozen graph can't run a quantized backbone"
+        with open(metadata_path(weights)) as f:
+            graph_all_masks = json.load(f).get("mask_classes") is None
+        if all_masks and not graph_all_masks:
+            raise ValueError("The graph {} computes only the masks of the oocyte and the polar body, "
+                             "export it without --no-video to write annotated videos".format(weights))
+        print("Loading frozen graph ", weights)
+        return FrozenMaskRCNN(weights, inference_config(batch_size, grayscale, graph_all_masks))
+    config = inference_config(batch_size, grayscale, all_masks)
+    if tflite:
+        from mrcnn.quantize import QuantizedMaskRCNN
+        model = QuantizedMaskRCNN(mode="inference", config=config, model_dir=logs)
+    else:
+        model = modellib.MaskRCNN(mode="inference", config=config, model_dir=logs)
+    weights_path = resolve_weights(model, weights)
+    print("Loading weights ", weights_path)
+    model.load_weights(weights_path, by_name=True)
+    if tflite:
+        print("Loading quantized backbone ", tflite)
+        model.load_backbone(tflite)
+    return model
+
+
+def export_model(weights, graph_path, batch_size=1, logs=DEFAULT_LOGS_DIR, grayscale=False,
+                 all_masks=True):
+    """Builds the inference model, loads its weights and exports it to a
+    frozen graph for load_inference_model(). The batch size is part of
+    the graph.
+    all_masks: Compute the masks of all the classes, as needed for the
+        annotated videos. If False, the graph only computes the masks of
+        the oocyte and the polar body and can only be run without a video.
+
+    Returns the metadata of the graph, see mrcnn.export.freeze_graph().
+    """
+    from mrcnn import export
+
+    start = time.time()
+    model = load_inference_model(weights, logs, batch_size, grayscale=grayscale, all_masks=all_masks)
+    print("Built the model and loaded the weights in {:.1f}s".format(time.time() - start))
+    metadata = export.freeze_graph(model, graph_path)
+    print("Folded {} batch norm layers".format(metadata["folded_batch_norms"]))
+    print("Frozen graph saved to ", graph_path)
+
+    start = time.time()
+    export.FrozenMaskRCNN(graph_path, inference_config(batch_size, grayscale, all_masks)).close()
+    print("Loaded the frozen graph in {:.1f}s".format(time.time() - start))
+    return metadata
+
+
+def evaluate_model(model, dataset, image_ids):
+    """Runs the model on images of a dataset and compares the detections
+    with the ground truth.
+
+    Returns the mAP at IoU 0.5 and the mean detection time per image in
+    seconds.
+    """
+    APs = []
+    seconds = 0.0
+    for image_id in image_ids:
+        image, image_meta, gt_class_id, gt_bbox, gt_mask = \
+            modellib.load_image_gt(dataset, model.config, image_id, use_mini_mask=False)
+        start = time.time()
+        r = model.detect([image], verbose=0)[0]
+        seconds += time.time() - start
+        AP, precisions, recalls, overlaps = utils.compute_ap(
+            gt_bbox, gt_class_id, gt_mask, r["rois"], r["class_ids"], r["scores"], r["masks"])
+        APs.append(AP)
+    return float(np.mean(APs)), seconds / len(image_ids)
+
+
+def quantize_model(weights, dataset_dir, tflite_path, quantization="int8", calibration_count=50,
+                   eval_count=None, logs=DEFAULT_LOGS_DIR, grayscale=False):
+    """Quantizes the backbone of the inference model for the CPU, see
+    mrcnn.quantize, and reports the change of accuracy and speed.
+
+    The int8 activations are calibrated on calibration_count random images
+    of the training set. The float and the quantized model are evaluated
+    on eval_count images of the validation set (all by default) with
+    evaluate_model(). The results are added to the metadata of the TFLite
+    model.
+
+    Returns the metadata dict.
+    """
+    from mrcnn import quantize
+    from mrcnn.quantize import QuantizedMaskRCNN
+
+    dataset_train = ICSIDataset()
+    dataset_train.load_icsi(dataset_dir, "train")
+    dataset_train.prepare()
+    dataset_val = ICSIDataset()
+    dataset_val.load_icsi(dataset_dir, "val")
+    dataset_val.prepare()
+    eval_ids = dataset_val.image_ids[:eval_count]
+
+    # The mAP compares the masks of all the classes
+    model = QuantizedMaskRCNN(mode="inference", config=inference_config(1, grayscale, all_masks=True),
+                              model_dir=logs)
+    weights_path = resolve_weights(model, weights)
+    print("Loading weights ", weights_path)
+    model.load_weights(weights_path, by_name=True)
+    # The first run builds the predict function, don't time it
+    model.detect([dataset_val.load_image(eval_ids[0], model.config.IMAGE_CHANNEL_COUNT)], verbose=0)
+    float_ap, float_seconds = evaluate_model(model, dataset_val, eval_ids)
+    print("Float model: mAP {:.4f}, {:.3f}s per image".format(float_ap, float_seconds))
+
+    calibration_ids = random.sample(list(dataset_train.image_ids),
+                                    min(calibration_count, dataset_train.num_images))
+    calibration_images = [dataset_train.load_image(image_id, model.config.IMAGE_CHANNEL_COUNT)
+                          for image_id in calibration_ids]
+    print("Converting the backbone to {} with {} calibration images".format(
+        quantization, len(calibration_images)))
+    metadata = quantize.convert_backbone(model, tflite_path, quantization, calibration_images)
+    model.load_backbone(tflite_path)
+    model.detect([dataset_val.load_image(eval_ids[0], model.config.IMAGE_CHANNEL_COUNT)], verbose=0)
+    quantized_ap, quantized_seconds = evaluate_model(model, dataset_val, eval_ids)
+    print("Quantized model: mAP {:.4f}, {:.3f}s per image".format(quantized_ap, quantized_seconds))
+    print("mAP change {:+.4f}, speedup {:.2f}x".format(
+        quantized_ap - float_ap, float_seconds / quantized_seconds))
+
+    metadata["evaluation"] = {
+        "images": len(eval_ids),
+        "float_map": float_ap,
+        "quantized_map": quantized_ap,
+        "float_seconds": float_seconds,
+        "quantized_seconds": quantized_seconds,
+    }
+    with open(quantize.metadata_path(tflite_path), "w") as f:
+        json.dump(metadata, f, indent=2)
+    print("Quantized backbone saved to ", tflite_path)
+    return metadata
+
+
+# Model of a batch worker process, see _batch_worker_init()
+_batch_model = None
+_batch_options = None
+
+
+def _batch_worker_init(weights, logs, batch_size, options, tflite=None, grayscale=False,
+                       all_masks=False):
+    """Builds the inference model of a batch worker process and loads its
+    weights, or loads the frozen graph. Runs once per worker, before the
+    worker's first video.
+    """
+    global _batch_model, _batch_options
+    import tensorflow as tf
+    import keras.backend as K
+    # Several workers may share a GPU
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.allow_growth = True
+    K.set_session(tf.Session(config=session_config))
+
+    print("Worker {} loading {}".format(os.getpid(), weights))
+    _batch_model = load_inference_model(weights, logs, batch_size, tflite, grayscale, all_masks)
+    _batch_options = options
+
+
+def _batch_worker_run(task):
+    """Processes one video, or one frame range of a video, of a batch in a
+    worker process. Videos that fail to decode are retried and skipped if
+    they still fail.
+
+    task: (video path, output directory, start frame, end frame) tuple
+
+    Returns the summary dict of the video with its status added.
+    """
+    video_path, output_dir, start_frame, end_frame = task
+    options = dict(_batch_options)
+    retries = options.pop("retries")
+    summary = {"video": video_path, "output_dir": output_dir, "worker": os.getpid(), "attempts": 0,
+               "start_frame": start_frame, "end_frame": end_frame}
+    for attempt in range(retries + 1):
+        summary["attempts"] = attempt + 1
+        # Start each attempt from a fresh results database
+        results_path = os.path.join(output_dir, "results.sqlite")
+        if os.path.exists(results_path):
+            os.remove(results_path)
+        try:
+            summary.update(process_video(_batch_model, video_path, output_dir=output_dir,
+                                         start_frame=start_frame, end_frame=end_frame,
+                                         headless=True, **options))
+            summary["status"] = "done"
+            return summary
+        except VideoDecodeError as e:
+            print("Decoding {} failed (attempt {} of {}): {}".format(
+                video_path, attempt + 1, retries + 1, e))
+            summary["status"] = "skipped"
+            summary["error"] = str(e)
+            if attempt < retries:
+                time.sleep(1)
+        except Exception as e:
+            summary["status"] = "failed"
+            summary["error"] = "{}: {}".format(type(e).__name__, e)
+            return summary
+    return summary
+
+
+def _run_worker_pool(tasks, weights, logs, workers, batch_size, options, tflite=None, grayscale=False):
+    """Runs _batch_worker_run() on the given tasks in a pool of worker
+    processes, each with its own model. See run_batch(). The models
+    compute the masks of all the classes if options has write_video on.
+
+    Returns the summary dicts of the tasks, in the order of tasks.
+    """
+    import multiprocessing
+
+    # Spawn fresh processes; a forked TensorFlow runtime is not usable
+    context = multiprocessing.get_context("spawn")
+    pool = context.Pool(workers, initializer=_batch_worker_init,
+                        initargs=(weights, logs, batch_size, options, tflite, grayscale,
+                                  options.get("write_video", True)))
+    try:
+        summaries = {}
+        for summary in pool.imap_unordered(_batch_worker_run, tasks):
+            summaries[summary["output_dir"]] = summary
+            print("[{}/{}] {} {}".format(len(summaries), len(tasks), summary["status"], summary["video"]))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return [summaries[task[1]] for task in tasks]
+
+
+BATCH_SUMMARY_COLUMNS = ["video", "status", "attempts", "frames", "detected_frames", "seconds",
+                         "fps", "output_dir", "output", "results", "worker", "error"]
+
+
+def run_batch(videos, weights, output_dir, workers=1, batch_size=1, retries=1,
+              logs=DEFAULT_LOGS_DIR, tflite=None, grayscale=False, **options):
+    """Processes a list of videos with a pool of worker processes. Each
+    worker builds the inference model and loads the weights once, then
+    processes videos until the list is done.
+
+    videos: list of video paths, see list_videos()
+    weights: Path to a .h5 file, or "coco", "last" or "imagenet", or to a
+        frozen graph (.pb), see load_inference_model().
+    output_dir: The outputs of each video are written to a subdirectory
+        named after the video. A summary of the batch is written to
+        summary.json and summary.csv.
+    workers: Number of worker processes.
+    batch_size: Number of frames per micro-batch in each worker.
+    retries: Number of times to retry a video that fails to decode before
+        skipping it.
+    tflite: Optional quantized backbone, see load_inference_model().
+    grayscale: Run a model for single channel frames.
+    options: Further keyword arguments of process_video(), e.g. pipeline
+        or write_video.
+
+    Returns a list of per-video summary dicts, in the order of videos.
+    """
+    import csv
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # One output directory per video, also for videos with the same name
+    # in different directories
+    tasks = []
+    names = set()
+    for video_path in videos:
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        unique_name, i = name, 1
+        while unique_name in names:
+            unique_name = "{}_{}".format(name, i)
+            i += 1
+        names.add(unique_name)
+        tasks.append((video_path, os.path.join(output_dir, unique_name), 0, None))
+
+    start = time.time()
+    summaries = _run_worker_pool(tasks, weights, logs, workers, batch_size, dict(options, retries=retries),
+                                 tflite, grayscale)
+    elapsed = time.time() - start
+
+    for summary in summaries:
+        if summary.get("seconds"):
+            summary["fps"] = summary["frames"] / summary["seconds"]
+    frames = sum(summary.get("frames", 0) for summary in summaries if summary["status"] == "done")
+    totals = {
+        "videos": len(summaries),
+        "done": sum(summary["status"] == "done" for summary in summaries),
+        "skipped": sum(summary["status"] == "skipped" for summary in summaries),
+        "failed": sum(summary["status"] == "failed" for summary in summaries),
+        "frames": frames,
+        "seconds": elapsed,
+        "fps": frames / elapsed if elapsed else 0.0,
+        "workers": workers,
+    }
+
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump({"totals": totals, "videos": summaries}, f, indent=2)
+    with open(os.path.join(output_dir, "summary.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=BATCH_SUMMARY_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    print("Processed {done} of {videos} videos ({skipped} skipped, {failed} failed)".format(**totals))
+    print("Throughput: {} frames in {:.2f}s, {:.2f} fps with {} workers".format(
+        frames, elapsed, totals["fps"], workers))
+    return summaries
+
+
+def chunk_ranges(frame_count, chunks, align=None):
+    """Splits the frames of a video into consecutive ranges of about the
+    same length.
+    frame_count: Number of frames of the video
+    chunks: Number of ranges
+    align: If set, the ranges start at multiples of this number of frames,
+        e.g. the keyframe interval.
+
+    Returns a list of (start_frame, end_frame) tuples, end_frame exclusive.
+    The end of the last range is None, so it's read to the end of the video
+    even if the frame count of the container is off.
+    """
+    starts = [frame_count * i // chunks for i in range(chunks)]
+    if align:
+        starts = [start - start % align for start in starts]
+    starts = sorted(set(starts))
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def merge_results(paths, output_path):
+    """Concatenates the tables of the given results databases, see
+    ResultsSink, into a new database. The frame indices are kept as they
+    are, so the databases of consecutive frame ranges of a video give the
+    results of the whole video.
+    """
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    connection = sqlite3.connect(output_path)
+    try:
+        for i, path in enumerate(paths):
+            connection.execute("ATTACH DATABASE ? AS chunk", (path,))
+            tables = connection.execute(
+                "SELECT name, sql FROM chunk.sqlite_master WHERE type = 'table'").fetchall()
+            for name, sql in tables:
+                if i == 0:
+                    connection.execute(sql)
+                connection.execute("INSERT INTO main.{0} SELECT * FROM chunk.{0}".format(name))
+            connection.commit()
+            connection.execute("DETACH DATABASE chunk")
+    finally:
+        connection.close()
+
+
+def run_chunked(video_path, weights, chunks, output_dir=None, workers=None, batch_size=1, retries=1,
+                logs=DEFAULT_LOGS_DIR, tflite=None, grayscale=False, results_path=None, text_output=False, write_video=True,
+                keyframe_interval=None, keyframe_threshold=None, smooth=False, smooth_lag=None,
+                **options):
+    """Processes one video in parallel. The video is split into `chunks`
+    consecutive frame ranges that are processed by a pool of worker
+    processes, see run_batch(). Each worker seeks to the start of its range
+    with CAP_PROP_POS_FRAMES. The annotated videos and the results of the
+    ranges are then stitched together in frame order.
+
+    With keyframe inference, the ranges start at multiples of the keyframe
+    interval and the keyframes are aligned to the interval (see
+    KeyframeBatcher), so the results are the same as when processing the
+    video in one run with aligned keyframes. With only a difference
+    threshold, the first frame of every range is an extra keyframe.
+
+    chunks: Number of frame ranges
+    output_dir: Directory for the stitched video (splash.avi), the results
+        database (results.sqlite) and, while the chunks are processed, the
+        outputs of the chunks. Defaults to a directory named after the
+        video, next to it.
+    workers: Number of worker processes. Defaults to chunks.
+    smooth, smooth_lag: Smooth the stages of the stitched results, see
+        process_video(). The chunks themselves are not smoothed.
+    options: Further keyword arguments of process_video(), e.g. pipeline.
+
+    Returns a dict with the paths of the outputs and frame counts and timing
+    of the run, like process_video().
+    """
+    import shutil
+    import tempfile
+
+    start = time.time()
+    vcapture = cv2.VideoCapture(video_path)
+    if not vcapture.isOpened():
+        raise VideoDecodeError("Cannot open video {}".format(video_path))
+    width = int(vcapture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(vcapture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = vcapture.get(cv2.CAP_PROP_FPS)
+    frame_count = int(vcapture.get(cv2.CAP_PROP_FRAME_COUNT))
+    if frame_count <= 0:
+        # The container doesn't know its length, count the frames
+        frame_count = 0
+        while vcapture.grab():
+            frame_count += 1
+    vcapture.release()
+
+    ranges = chunk_ranges(frame_count, chunks, align=keyframe_interval)
+    print("Splitting {} frames into {} chunks: {}".format(frame_count, len(ranges), ranges))
+    output_dir = output_dir or os.path.splitext(video_path)[0]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    chunk_dir = tempfile.mkdtemp(prefix="chunks_", dir=output_dir)
+    tasks = [(video_path, os.path.join(chunk_dir, "{:04d}".format(i)), start_frame, end_frame)
+             for i, (start_frame, end_frame) in enumerate(ranges)]
+    options = dict(options, retries=retries, write_video=write_video,
+                   keyframe_interval=keyframe_interval, keyframe_threshold=keyframe_threshold,
+                   keyframe_aligned=True, colors=visualize.random_colors(len(CLASS_NAMES)))
+    # Remove the chunks also when a chunk or the stitching fails
+    try:
+        summaries = _run_worker_pool(tasks, weights, logs, workers or len(tasks), batch_size, options,
+                                     tflite, grayscale)
+
+        for summary in summaries:
+            if summary["status"] != "done":
+                raise VideoDecodeError("Chunk {}-{} of {} {}: {}".format(
+                    summary["start_frame"], summary["end_frame"], video_path,
+                    summary["status"], summary.get("error")))
+            if summary["end_frame"] is not None and \
+                    summary["frames"] != summary["end_frame"] - summary["start_frame"]:
+                print("Warning: chunk {}-{} has {} frames".format(
+                    summary["start_frame"], summary["end_frame"], summary["frames"]))
+
+        # Stitch the chunks together in frame order
+        results_path = results_path or os.path.join(output_dir, "results.sqlite")
+        merge_results([summary["results"] for summary in summaries], results_path)
+        if smooth or smooth_lag:
+            print("Stage timeline:")
+            print_timeline(smooth_results(results_path, lag=None if smooth else smooth_lag))
+        print("Results saved to ", results_path)
+        if text_output:
+            render_text_results(results_path)
+        if write_video:
+            file_name = os.path.join(output_dir, "splash.avi")
+            stitch_videos([summary["output"] for summary in summaries], file_name, fps, (width, height))
+            print("Saved to ", file_name)
+        else:
+            file_name = None
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    frames = sum(summary["frames"] for summary in summaries)
+    elapsed = time.time() - start
+    print("Throughput: {} frames in {:.2f}s, {:.2f} fps with {} chunks".format(
+        frames, elapsed, frames / elapsed, len(tasks)))
+    return {
+        "video": video_path,
+        "output": file_name,
+        "results": results_path,
+        "frames": frames,
+        "detected_frames": sum(summary["detected_frames"] for summary in summaries),
+        "seconds": elapsed,
+    }
 
 
 ############################################################
@@ -539,13 +2955,13 @@ if __name__ == '__main__':
         description='Train Mask R-CNN to detect ICSI objects.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'splash'")
+                        help="'train', 'prepare-cache', 'splash', 'batch', 'classify', 'export' or 'quantize'")
     parser.add_argument('--dataset', required=False,
                         metavar="/path/to/icsi/dataset/",
                         help='Directory of the ICSI dataset')
-    parser.add_argument('--weights', required=True,
+    parser.add_argument('--weights', required=False,
                         metavar="/path/to/weights.h5",
-                        help="Path to weights .h5 file or 'coco'")
+                        help="Path to weights .h5 file or 'coco', or to a frozen graph .pb file for inference")
     parser.add_argument('--logs', required=False,
                         default=DEFAULT_LOGS_DIR,
                         metavar="/path/to/logs/",
@@ -568,16 +2984,133 @@ if __name__ == '__main__':
     parser.add_argument('--layers', required=False,
                         metavar="heads or all layers",
                         help='Train heads or all layers')
+    parser.add_argument('--cache', required=False,
+                        metavar="/path/to/cache/",
+                        help='Directory of the preprocessed training data, see prepare-cache')
+    parser.add_argument('--input-pipeline', required=False,
+                        default="generator", choices=["generator", "tf.data"],
+                        help='Training input pipeline: Keras generator workers or tf.data (default=generator)')
+    parser.add_argument('--batch-size', required=False,
+                        default=1, type=int,
+                        metavar="number of frames",
+                        help='Number of video frames to run through the model in one batch (default=1)')
+    parser.add_argument('--keyframe-interval', required=False,
+                        default=None, type=int,
+                        metavar="number of frames",
+                        help='Run the model every N frames and propagate the detections in between')
+    parser.add_argument('--keyframe-threshold', required=False,
+                        default=None, type=float,
+                        metavar="gray levels",
+                        help='Also run the model when the mean frame difference to the last keyframe exceeds this')
+    parser.add_argument('--results', required=False,
+                        metavar="/path/to/results.sqlite",
+                        help='Database to store the per-frame detections and stages in')
+    parser.add_argument('--text-output', required=False,
+                        action='store_true',
+                        help='Also write the results to bboxes.txt, params.txt and pole_oocytu.txt')
+    parser.add_argument('--pipeline', required=False,
+                        action='store_true',
+                        help='Run video decoding, inference, analysis and encoding as parallel stages')
+    parser.add_argument('--queue-size', required=False,
+                        default=8, type=int,
+                        metavar="number of frames",
+                        help='Capacity of the queues between the pipeline stages (default=8)')
+    parser.add_argument('--videos', required=False,
+                        metavar="/path/to/videos/ or /path/to/manifest.txt",
+                        help='Directory of videos, or a text file with one video path per line, to process in a batch')
+    parser.add_argument('--output', required=False,
+                        metavar="/path/to/output/",
+                        help='Directory for the per-video outputs and the summary of a batch (default=batch_output/), '
+                             'or for the outputs of --chunks (default=a directory named after the video, next to it)')
+    parser.add_argument('--workers', required=False,
+                        default=None, type=int,
+                        metavar="number of processes",
+                        help='Number of worker processes, each with its own model (default=1 for a batch, '
+                             'the number of chunks for --chunks)')
+    parser.add_argument('--chunks', required=False,
+                        default=1, type=int,
+                        metavar="number of chunks",
+                        help='Split the video into this many frame ranges and process them in parallel (default=1)')
+    parser.add_argument('--retries', required=False,
+                        default=1, type=int,
+                        metavar="number of retries",
+                        help='Number of times to retry a video that fails to decode before skipping it (default=1)')
+    parser.add_argument('--checkpoint-every', required=False,
+                        default=None, type=int,
+                        metavar="number of frames",
+                        help='Save a checkpoint next to the --results database every N frames')
+    parser.add_argument('--resume', required=False,
+                        action='store_true',
+                        help='Continue an interrupted run from the checkpoint of its --results database')
+    parser.add_argument('--smooth', required=False,
+                        action='store_true',
+                        help='Smooth the stages over time with a Viterbi decoder and store the stage timeline')
+    parser.add_argument('--smooth-lag', required=False,
+                        default=None, type=int,
+                        metavar="number of frames",
+                        help='Smooth the stages while processing, deciding each frame this many frames later')
+    parser.add_argument('--graph', required=False,
+                        default="mask_rcnn_icsi.pb",
+                        metavar="/path/to/graph.pb",
+                        help='Path of the frozen graph written by export (default=mask_rcnn_icsi.pb)')
+    parser.add_argument('--tflite', required=False,
+                        metavar="/path/to/backbone.tflite",
+                        help='Quantized backbone written by quantize, to run on the CPU with TFLite')
+    parser.add_argument('--quantization', required=False,
+                        default="int8", choices=["int8", "float16"],
+                        help='Quantization of the backbone for quantize (default=int8)')
+    parser.add_argument('--calibration-images', required=False,
+                        default=50, type=int,
+                        metavar="number of images",
+                        help='Number of training images to calibrate the int8 activations on (default=50)')
+    parser.add_argument('--grayscale', required=False,
+                        action='store_true',
+                        help='Train or run the model on single channel frames instead of RGB')
+    parser.add_argument('--roi-interval', required=False,
+                        default=None, type=int,
+                        metavar="number of frames",
+                        help='Run the model on a crop around the last detections, and on the whole frame every N frames')
+    parser.add_argument('--roi-dim', required=False,
+                        default=512, type=int,
+                        metavar="pixels",
+                        help='Size the crops are resized to for --roi-interval, a multiple of 64 (default=512)')
+    parser.add_argument('--masks-on-demand', required=False,
+                        action='store_true',
+                        help='Run the mask head only on frames with an oocyte, whose stage needs its geometry')
+    parser.add_argument('--store-masks', required=False,
+                        action='store_true',
+                        help='Also store the run-length encoded masks of the detections in the results database')
+    parser.add_argument('--headless', required=False,
+                        action='store_true',
+                        help='Run without matplotlib and OpenCV windows, e.g. on a server')
+    parser.add_argument('--no-video', required=False,
+                        action='store_true',
+                        help='Only store the results, do not write an annotated video. With export, '
+                             'only compute the masks of the oocyte and the polar body')
     args = parser.parse_args()
     print("###### args ######", args)
 
     # Validate arguments
+    assert args.weights or args.command in ["classify", "prepare-cache"], "Argument --weights is required"
     if args.command == "train":
         assert args.dataset or args.epochs or args.steps or args.layers or args.imgGPU, \
             "Arguments --dataset, --epochs, --steps, --layers and --imGPU are required for training"
     elif args.command == "splash":
         assert args.image or args.video, \
             "Provide --image or --video to apply color splash"
+        assert args.results or not args.resume, \
+            "Provide the --results database of the run to resume"
+        assert not (args.tflite and args.weights.lower().endswith(".pb")), \
+            "A frozen graph can't run a quantized backbone, use --weights with .h5 weights"
+    elif args.command == "prepare-cache":
+        assert args.dataset and args.cache, "Provide the --dataset and the --cache directory"
+    elif args.command == "batch":
+        assert args.videos, "Provide --videos to process a batch of videos"
+    elif args.command == "classify":
+        assert args.results, "Provide the --results database to classify"
+    elif args.command == "quantize":
+        assert args.dataset and args.tflite, \
+            "Provide the --dataset and the --tflite path to quantize the model"
 
     print("Weights: ", args.weights)
     print("Dataset: ", args.dataset)
@@ -587,6 +3120,89 @@ if __name__ == '__main__':
     print("Images per gpu: ", args.imGPU)
     print("Layers: ", args.layers)
 
+    # Classify the stages again from the stored features, without the model
+    if args.command == "classify":
+        start = time.time()
+        frames, stages = classify_results(args.results)
+        print("Classified {} frames in {:.3f}s".format(len(frames), time.time() - start))
+        for i, stage in enumerate(STAGES):
+            print("{:50} {:6d} frames".format(stage, np.sum(stages == i)))
+        print("{:50} {:6d} frames".format("Stage not detected", np.sum(stages < 0)))
+        if args.smooth or args.smooth_lag:
+            start = time.time()
+            timeline = smooth_results(args.results, lag=None if args.smooth else args.smooth_lag)
+            print("Smoothed in {:.3f}s, stage timeline:".format(time.time() - start))
+            print_timeline(timeline)
+        if args.text_output:
+            render_text_results(args.results)
+        sys.exit(0)
+
+    # Preprocess the training data once for all the epochs and runs
+    if args.command == "prepare-cache":
+        prepare_cache(args.dataset, args.cache, grayscale=args.grayscale)
+        sys.exit(0)
+
+    # Export the inference model with --batch-size to a frozen graph
+    if args.command == "export":
+        export_model(args.weights, args.graph, batch_size=args.batch_size, logs=args.logs,
+                     grayscale=args.grayscale, all_masks=not args.no_video)
+        sys.exit(0)
+
+    # Quantize the backbone, calibrated and evaluated on the dataset
+    if args.command == "quantize":
+        quantize_model(args.weights, args.dataset, args.tflite, quantization=args.quantization,
+                       calibration_count=args.calibration_images, logs=args.logs,
+                       grayscale=args.grayscale)
+        sys.exit(0)
+
+    # Batch processing builds and loads the model in each worker process
+    if args.command == "batch":
+        videos = list_videos(args.videos)
+        print("Videos: ", len(videos))
+        run_batch(videos, args.weights, args.output or "batch_output",
+                  workers=args.workers or 1,
+                  batch_size=args.batch_size,
+                  retries=args.retries,
+                  logs=args.logs,
+                  tflite=args.tflite,
+                  grayscale=args.grayscale,
+                  pipeline=args.pipeline,
+                  queue_size=args.queue_size,
+                  keyframe_interval=args.keyframe_interval,
+                  keyframe_threshold=args.keyframe_threshold,
+                  text_output=args.text_output,
+                  write_video=not args.no_video,
+                  store_masks=args.store_masks,
+                  roi_interval=args.roi_interval,
+                  roi_dim=args.roi_dim,
+                  masks_on_demand=args.masks_on_demand)
+        sys.exit(0)
+
+    # A video split into chunks is processed by worker processes too
+    if args.command == "splash" and args.video and args.chunks > 1:
+        run_chunked(args.video, args.weights, args.chunks,
+                    output_dir=args.output,
+                    workers=args.workers,
+                    batch_size=args.batch_size,
+                    retries=args.retries,
+                    logs=args.logs,
+                    tflite=args.tflite,
+                    grayscale=args.grayscale,
+                    results_path=args.results,
+                    text_output=args.text_output,
+                    write_video=not args.no_video,
+                    keyframe_interval=args.keyframe_interval,
+                    keyframe_threshold=args.keyframe_threshold,
+                    smooth=args.smooth,
+                    smooth_lag=args.smooth_lag,
+                    pipeline=args.pipeline,
+                    queue_size=args.queue_size,
+                    store_masks=args.store_masks,
+                    roi_interval=args.roi_interval,
+                    roi_dim=args.roi_dim,
+                    masks_on_demand=args.masks_on_demand)
+        sys.exit(0)
+
     # Configurations
     if args.command == "train":
         class InferenceConfig(ICSIConfig):
@@ -595,54 +3211,49 @@ if __name__ == '__main__':
             # PG zwiekszylam IMAGES_PER_GPU z 1 do 16
             STEPS_PER_EPOCH = int(args.steps)
             IMAGES_PER_GPU = int(args.imGPU)
+            IMAGE_CHANNEL_COUNT = 1 if args.grayscale else 3
+            GT_CACHE_DIR = args.cache
 
 
         config = InferenceConfig()
     else:
-        class InferenceConfig(ICSIConfig):
-            # Set batch size to 1 since we'll be running inference on
-            # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
-            # PG zwiekszylam IMAGES_PER_GPU z 1 do 16
-            GPU_COUNT = 1
-            IMAGES_PER_GPU = 1
-
-
-        config = InferenceConfig()
+        config = inference_config(args.batch_size, args.grayscale,
+                                  all_masks=args.command == "splash" and (bool(args.image) or not args.no_video))
     config.display()
 
     # Create model
     if args.command == "train":
         model = modellib.MaskRCNN(mode="training", config=config,
                                   model_dir=args.logs)
+    elif args.weights.lower().endswith(".pb"):
+        # A frozen graph runs without building the Keras model
+        model = load_inference_model(args.weights, batch_size=args.batch_size, grayscale=args.grayscale,
+                                     all_masks=config.MASK_CLASSES is None)
+    elif args.tflite:
+        from mrcnn.quantize import QuantizedMaskRCNN
+        model = QuantizedMaskRCNN(mode="inference", config=config,
+                                  model_dir=args.logs)
     else:
         model = modellib.MaskRCNN(mode="inference", config=config,
                                   model_dir=args.logs)
 
-    # Select weights file to load
-    if args.weights.lower() == "coco":
-        weights_path = COCO_WEIGHTS_PATH
-        # Download weights file
-        if not os.path.exists(weights_path):
-            utils.download_trained_weights(weights_path)
-    elif args.weights.lower() == "last":
-        # Find last trained weights
-        weights_path = model.find_last()
-    elif args.weights.lower() == "imagenet":
-        # Start from ImageNet trained weights
-        weights_path = model.get_imagenet_weights()
-    else:
-        weights_path = args.weights
-
-    # Load weights
-    print("Loading weights ", weights_path)
-    if args.weights.lower() == "coco":
-        # Exclude the last layers because they require a matching
-        # number of classes
-        model.load_weights(weights_path, by_name=True, exclude=[
-            "mrcnn_class_logits", "mrcnn_bbox_fc",
-            "mrcnn_bbox", "mrcnn_mask"])
-    else:
-        model.load_weights(weights_path, by_name=True)
+    # Select weights file to load. A frozen graph has its weights already.
+    if model.keras_model is not None:
+        weights_path = resolve_weights(model, args.weights)
+
+        # Load weights
+        print("Loading weights ", weights_path)
+        if args.weights.lower() == "coco":
+            # Exclude the last layers because they require a matching
+            # number of classes
+            model.load_weights(weights_path, by_name=True, exclude=[
+                "mrcnn_class_logits", "mrcnn_bbox_fc",
+                "mrcnn_bbox", "mrcnn_mask"])
+        else:
+            model.load_weights(weights_path, by_name=True)
+    if args.tflite and args.command == "splash":
+        print("Loading quantized backbone ", args.tflite)
+        model.load_backbone(args.tflite)
 
     # Train or evaluate
     if args.command == "train":
@@ -652,7 +3263,23 @@ if __name__ == '__main__':
         train(model, intepochs, args.layers)
     elif args.command == "splash":
         detect_and_color_splash(model, image_path=args.image,
-                                video_path=args.video)
+                                video_path=args.video,
+                                pipeline=args.pipeline,
+                                queue_size=args.queue_size,
+                                keyframe_interval=args.keyframe_interval,
+                                keyframe_threshold=args.keyframe_threshold,
+                                results_path=args.results,
+                                text_output=args.text_output,
+                                headless=args.headless,
+                                write_video=not args.no_video,
+                                checkpoint_every=args.checkpoint_every,
+                                resume=args.resume,
+                                smooth=args.smooth,
+                                smooth_lag=args.smooth_lag,
+                                store_masks=args.store_masks,
+                                roi_interval=args.roi_interval,
+                                roi_dim=args.roi_dim,
+                                masks_on_demand=args.masks_on_demand)
     else:
         print("'{}' is not recognized. "
-              "Use 'train' or 'splash'".format(args.command))
+              "Use 'train', 'splash', 'batch', 'classify', 'export' or 'quantize'".format(args.command))
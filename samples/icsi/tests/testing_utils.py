@@ -1,8 +1,6 @@
-from math import fabs
 from samples.icsi import icsi
-from mrcnn import model as modellib
-from mrcnn import visualize
-from matplotlib import pyplot as plt
+from mrcnn import model as modellib, utils
+import numpy as np
 import cv2
 
 
@@ -19,6 +17,40 @@ model = modellib.MaskRCNN(mode="inference", model_dir=logs, config=config)
 class_names = ['BG', 'oocyte', 'polar body', 'spermatozoon', 'pipette']
 
 
+class BoxConfig(icsi.Config):
+    NAME = "box"
+    NUM_CLASSES = 3
+    IMAGE_MIN_DIM = 64
+    IMAGE_MAX_DIM = 128
+
+
+class BoxDataset(utils.Dataset):
+    """Synthetic images of 80x100 pixels, each with a big and a small box,
+    for tests of the training data without the ICSI dataset.
+    """
+
+    def load_boxes(self, count, empty_ids=()):
+        """Adds count images. The images of empty_ids have no instances."""
+        self.empty_ids = set(empty_ids)
+        self.add_class("box", 1, "big")
+        self.add_class("box", 2, "small")
+        for i in range(count):
+            self.add_image("box", image_id=i, path=None)
+
+    def load_image(self, image_id, channels=3):
+        image = np.zeros([80, 100, channels], dtype=np.uint8)
+        image[10 + 10 * image_id:50, 20:70] = 200
+        return image
+
+    def load_mask(self, image_id):
+        if image_id in self.empty_ids:
+            return np.zeros([80, 100, 0], dtype=bool), np.zeros([0], dtype=np.int32)
+        mask = np.zeros([80, 100, 2], dtype=bool)
+        mask[10 + 10 * image_id:50, 20:70, 0] = True
+        mask[60:75, 5:30 + image_id, 1] = True
+        return mask, np.array([1, 2], dtype=np.int32)
+
+
 def run_detection(model, dataset, image_id):
     model.load_weights(weights, by_name=True)
     dataset.load_icsi("D:/MASK-RCNN/datasets/icsi", "val")
@@ -31,69 +63,10 @@ def run_detection(model, dataset, image_id):
 
 
 def define_stage(r, class_names, count):
-    oocyte_counter = 0
-    for elem in r:
-        if elem == "oocyte":
-            oocyte_counter += 1
-
-    if 1 in r['class_ids'] and len(set(r['class_ids'])) == len(r['class_ids']):
-        x1_oocyte, x2_oocyte, y1_oocyte, y2_oocyte = icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 1,
-                                                                                 class_names[1])
-        cnt = icsi.count_mask_contours(r['masks'], r['class_ids'], 1)
-        perimeter = icsi.count_perimeter(cnt)
-        area = icsi.count_area(cnt)
-        circratio = icsi.count_circularity_ratio(area, perimeter, count)
-        cxo, cyo = icsi.count_centroid(cnt, class_names[1])
-
-        if 2 in r['class_ids']:
-            x1_polar, x2_polar, y1_polar, y2_polar = icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 2,
-                                                                                 class_names[2])
-            cnt_polar = icsi.count_mask_contours(r['masks'], r['class_ids'], 2)
-            cxp, cyp = icsi.count_centroid(cnt_polar, class_names[2])
-            # d = sqrt((cxp - cxo) ** 2 + (cyp - cyo) ** 2)
-            dx = fabs(cxp - cxo)
-            dy = cyp - cyo
-            if dy != 0:
-                location = fabs(dx / dy)
-
-    if 3 in r['class_ids']:
-        x1, x2, y1, y2 = icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 3, class_names[3])
-
-    if 4 in r['class_ids']:
-        x1_pipette, x2_pipette, y1_pipette, y2_pipette = icsi.count_bbox_coordinates(r['masks'], r['class_ids'],
-                                                                                     4, class_names[4])
-
-    if r:
-        if 3 in r['class_ids'] and len(set(r['class_ids'])) == 1 and len(r['class_ids']) > 1:
-            return "Sperm selection"
-
-        elif (3 in r['class_ids']) and (4 in r['class_ids']) and len(set(r['class_ids'])) == 2:
-            if (x1 > x1_pipette) and (y1 > y1_pipette) and (x2 < x2_pipette) and (y2 < y2_pipette):
-                return "Sperm collection"
-            else:
-                return "Immobilization of the sperm"
-
-        elif (3 in r['class_ids']) and (1 in r['class_ids']) and (4 in r['class_ids']) and len(set(r['class_ids'])) == len(r['class_ids']):
-            if x1_pipette < cxo and (x1 > x1_pipette) and (y1 > y1_pipette) and (x2 < x2_pipette) and (y2 < y2_pipette):
-                return "Flow of the cell organelles into the pipette"
-
-            elif x1 < x1_pipette < x2_oocyte and y1 > y1_oocyte:
-                return "Sperm injection"
-
-            elif (x1 > x1_oocyte) and (y1 > y1_oocyte) and (x2 < x2_oocyte) and (y2 < y2_oocyte) and (x1_pipette > x2_oocyte):
-                return "Removing the pipette"
-
-        elif (2 in r['class_ids']) and len(set(r['class_ids'])) == len(r['class_ids']) == 2:
-            if 1 in r['class_ids']:
-                if location < 0.5:
-                    return "Oocyte positioning"
-        elif (4 in r['class_ids']) and (1 in r['class_ids']):
-            if oocyte_counter == 1 and x1_pipette <= x2_oocyte and circratio < 0.85:
-                return "Inserting the pipette"
-            else:
-                return "Stage not detected"
-        else:
-            return "Stage not detected"
+    stage = icsi.define_frame_stage(r)
+    if stage is None:
+        return "Stage not detected"
+    return stage
 
 
 def detect_and_color_splash(model, video_path, stage_name=None):
@@ -104,21 +77,15 @@ def detect_and_color_splash(model, video_path, stage_name=None):
         count = 0
         number_of_ok = 0
         success = True
-        colors = visualize.random_colors(len(class_names))
 
+        # Analysis only, no frames are drawn or displayed
         while success:
             print("frame: ", count)
-            plt.clf()
-            plt.close()
             success, frame = vcapture.read()
 
             if success:
                 frame = frame[..., ::-1]
                 r = model.detect([frame], verbose=0)[0]
-                splash = icsi.color_splash(frame, r['masks'])
-
-                frame, labels = visualize.display_instances_video(splash, r['rois'], r['masks'], r['class_ids'],
-                                                                  class_names, r['scores'], colors)
 
                 stage = define_stage(r, class_names, count)
                 print(stage)
@@ -128,14 +95,10 @@ def detect_and_color_splash(model, video_path, stage_name=None):
                         number_of_ok += 1
 
                 count += 1
-
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
             else:
                 break
 
         vcapture.release()
-        cv2.destroyAllWindows()
 
     if stage_name is not None:
         print("number of ok: ", number_of_ok)
@@ -1,7 +1,10 @@
+import os
 import unittest
 
+import numpy as np
+
 from samples.icsi import icsi
-from gui.gui_utils import train_Popen, detection_Popen
+from gui.gui_utils import train_Popen, detection_Popen, batch_Popen
 import testing_utils
 
 
@@ -23,21 +26,498 @@ class TestICSIUnit(unittest.TestCase):
         print("Perimeter: ", perimeter)
 
     def test_count_centroid(self):
-        self.assertIsNotNone(icsi.count_centroid(cnt, "testing"))
-        print("Centroid: ", icsi.count_centroid(cnt, "testing"))
+        self.assertIsNotNone(icsi.count_centroid(cnt))
+        print("Centroid: ", icsi.count_centroid(cnt))
 
     def test_count_area(self):
         self.assertIsNotNone(area)
         print("Area: ", area)
 
     def test_count_circularity_ratio(self):
-        self.assertIsNotNone(icsi.count_circularity_ratio(area, perimeter, "0-testing"))
-        print("Circrtio: ", icsi.count_circularity_ratio(area, perimeter, "0-testing"))
+        self.assertIsNotNone(icsi.count_circularity_ratio(area, perimeter))
+        print("Circrtio: ", icsi.count_circularity_ratio(area, perimeter))
 
     def test_count_bbox_coordinates(self):
-        self.assertIsNotNone(icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 2, "polar body"))
-        print("Bboxes: ", icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 2, "polar body"))
+        self.assertIsNotNone(icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 2))
+        print("Bboxes: ", icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 2))
+
+
+    def test_extract_features(self):
+        features = icsi.extract_features(r)
+        self.assertEqual(features.shape, (len(icsi.FEATURE_COLUMNS),))
+        oocyte_x1, oocyte_x2, oocyte_y1, oocyte_y2 = icsi.count_bbox_coordinates(r['masks'], r['class_ids'], 1)
+        self.assertEqual(features[icsi.FEATURE_COLUMNS.index("oocyte_x1")], oocyte_x1)
+        self.assertEqual(features[icsi.FEATURE_COLUMNS.index("oocyte_area")], area)
+
+    def test_box_masks(self):
+        crops = [r['masks'][y1:y2, x1:x2, i] for i, (y1, x1, y2, x2) in enumerate(r['rois'])]
+        masks = icsi.utils.BoxMasks(r['rois'], crops, r['masks'].shape)
+        self.assertEqual(masks.shape, r['masks'].shape)
+        self.assertTrue(np.array_equal(masks.dense(), r['masks']))
+        self.assertTrue(np.array_equal(masks[:, :, 0], r['masks'][:, :, 0]))
+        self.assertEqual(masks.area(0), np.sum(r['masks'][:, :, 0]))
+        box_r = dict(r, masks=masks)
+        self.assertTrue(np.array_equal(icsi.extract_features(box_r), icsi.extract_features(r), equal_nan=True))
+
+    def test_rle_masks(self):
+        masks = icsi.utils.RLEMasks.from_dense(r['masks'])
+        self.assertTrue(np.array_equal(masks.dense(), r['masks']))
+        self.assertTrue(np.array_equal(masks.boxes, icsi.utils.extract_bboxes(r['masks'])))
+        self.assertEqual(masks.area(0), np.sum(r['masks'][:, :, 0]))
+        strings = masks.to_strings()
+        self.assertTrue(np.array_equal(icsi.utils.RLEMasks.from_strings(strings, r['masks'].shape).dense(),
+                                       r['masks']))
+        overlaps = icsi.utils.compute_overlaps_masks(r['masks'], r['masks'])
+        self.assertTrue(np.allclose(icsi.utils.compute_overlaps_masks(masks, masks), overlaps))
+        self.assertTrue(np.array_equal(icsi.extract_features(dict(r, masks=masks)), icsi.extract_features(r),
+                                       equal_nan=True))
+
+    def test_mask_paste_backends(self):
+        masks = np.random.RandomState(0).rand(3, 28, 28).astype(np.float32)
+        boxes = np.array([[10, 20, 90, 60], [0, 0, 5, 3], [40, 40, 100, 100]])
+        expected = np.stack([icsi.utils.unmold_mask(m, b, (100, 100)) for m, b in zip(masks, boxes)], axis=-1)
+        for backend in icsi.utils.MASK_PASTE_BACKENDS:
+            pasted = icsi.utils.unmold_masks(masks, boxes, (100, 100), backend)
+            self.assertTrue(np.array_equal(pasted, expected), backend)
+
+    def test_fold_batch_norm_weights(self):
+        from mrcnn import export
+        rng = np.random.RandomState(0)
+        x = rng.rand(5, 3)
+        kernel, bias = rng.rand(1, 1, 3, 4), rng.rand(4)
+        gamma, beta, mean, variance = rng.rand(4), rng.rand(4), rng.rand(4), rng.rand(4) + 0.1
+        expected = gamma * (np.dot(x, kernel[0, 0]) + bias - mean) / np.sqrt(variance + 1e-3) + beta
+        kernel, bias = export.fold_batch_norm_weights(kernel, bias, gamma, beta, mean, variance, 1e-3)
+        self.assertTrue(np.allclose(np.dot(x, kernel[0, 0]) + bias, expected))
+        self.assertEqual(export.batch_norm_conv_name("bn2a_branch2a"), "res2a_branch2a")
+        self.assertEqual(export.batch_norm_conv_name("mrcnn_mask_bn1"), "mrcnn_mask_conv1")
+
+    def test_quantized_backbone(self):
+        import json
+        import tempfile
+        from unittest import mock
+        import keras.backend as K
+        from mrcnn import quantize
+
+        class SmallConfig(icsi.ICSIConfig):
+            BACKBONE = "resnet50"
+            GPU_COUNT = 1
+            IMAGES_PER_GPU = 1
+            IMAGE_MIN_DIM = 128
+            IMAGE_MAX_DIM = 128
+
+        config = SmallConfig()
+        model = quantize.QuantizedMaskRCNN(mode="inference", config=config, model_dir=testing_utils.logs)
+        # Raises if a layer of BACKBONE_LAYERS is missing
+        tensors = quantize.backbone_tensors(model.keras_model)
+        image_input = model.keras_model.inputs[0]
+
+        class Interpreter(object):
+            """Runs the backbone of the Keras model in place of the TFLite model."""
+
+            def __init__(self, model_path):
+                pass
+
+            def allocate_tensors(self):
+                pass
+
+            def get_input_details(self):
+                return [{"index": 0}]
+
+            def get_output_details(self):
+                # Not in the order of the metadata
+                return [{"name": t.op.name, "index": i} for i, t in reversed(list(enumerate(tensors)))]
+
+            def set_tensor(self, index, value):
+                self.image = value
+
+            def invoke(self):
+                self.outputs = K.get_session().run(tensors, feed_dict={image_input: self.image})
+
+            def get_tensor(self, index):
+                return self.outputs[index]
+
+        tflite_path = os.path.join(tempfile.mkdtemp(), "backbone.tflite")
+        with open(quantize.metadata_path(tflite_path), "w") as f:
+            json.dump({"input_shape": [1] + [int(d) for d in config.IMAGE_SHAPE],
+                       "outputs": [t.op.name for t in tensors],
+                       "layers": quantize.BACKBONE_LAYERS,
+                       "num_classes": config.NUM_CLASSES}, f)
+        image = np.random.RandomState(0).randint(0, 255, (100, 120, 3)).astype(np.uint8)
+        molded_images, image_metas, _ = model.mold_inputs([image])
+        expected = model.predict_detections(molded_images, image_metas)
+        with mock.patch.object(quantize.tf.lite, "Interpreter", Interpreter):
+            model.load_backbone(tflite_path)
+        # The outputs in the order of BACKBONE_LAYERS, fed in place of the
+        # Keras backbone
+        features = model.predict_backbone(molded_images)
+        for f, e in zip(features, K.get_session().run(tensors, feed_dict={image_input: molded_images})):
+            self.assertTrue(np.allclose(f, e))
+        for r, e in zip(model.predict_detections(molded_images, image_metas), expected):
+            self.assertTrue(np.allclose(r, e, atol=1e-5))
+
+    def test_grayscale_channels(self):
+        from mrcnn import utils, model as modellib
+        rng = np.random.RandomState(0)
+        gray = rng.randint(0, 255, (8, 9, 1)).astype(np.uint8)
+        rgb = utils.convert_image_channels(gray, 3)
+        self.assertEqual(rgb.shape, (8, 9, 3))
+        self.assertTrue(np.array_equal(utils.convert_image_channels(rgb, 1), gray))
+        self.assertTrue(np.array_equal(utils.convert_image_channels(gray[..., 0], 1), gray))
+        # The adapted weights give the same convolution of the molded
+        # grayscale image as the RGB weights of the molded RGB image
+
+        class GrayscaleConfig(icsi.Config):
+            IMAGE_CHANNEL_COUNT = 1
+
+        rgb_config, gray_config = icsi.Config(), GrayscaleConfig()
+        kernel, bias = rng.rand(7, 7, 3, 4) - 0.5, rng.rand(4)
+        expected = np.einsum("hwc,hwcf->f", modellib.mold_image(rgb[:7, :7], rgb_config), kernel) + bias
+        gray_kernel, gray_bias = modellib.adapt_input_channels(
+            kernel, 1, bias, gray_config.RGB_MEAN_PIXEL, gray_config.MEAN_PIXEL)
+        self.assertEqual(gray_kernel.shape, (7, 7, 1, 4))
+        result = np.einsum("hwc,hwcf->f", modellib.mold_image(gray[:7, :7], gray_config), gray_kernel) + gray_bias
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_uncrop_detections(self):
+        from mrcnn import utils
+        rois = np.array([[20, 30, 40, 60], [50, 35, 60, 45]])
+        self.assertEqual(icsi.crop_around(rois, (100, 120, 3), margin=0.25), (10, 22, 70, 68))
+        self.assertIsNone(icsi.crop_around(np.zeros([0, 4]), (100, 120, 3)))
+        # A flat box on the edge of the frame has no crop, the whole frame
+        # is run instead
+        self.assertIsNone(icsi.crop_around(np.array([[100, 50, 100, 60]]), (100, 120, 3)))
+        self.assertEqual(icsi.crop_around(np.array([[96, 100, 100, 120]]), (100, 120, 3)), (95, 95, 100, 120))
+        masks = np.zeros([20, 30, 1], dtype=bool)
+        masks[5:10, 10:20, 0] = True
+        r = {"rois": np.array([[5, 10, 10, 20]]), "class_ids": np.array([1]), "scores": np.array([0.9]),
+             "masks": masks}
+        dense = icsi.uncrop_detections(r, (40, 50, 60, 80), (100, 120, 3))
+        self.assertEqual(dense["rois"].tolist(), [[45, 60, 50, 70]])
+        self.assertEqual(dense["masks"].shape, (100, 120, 1))
+        self.assertTrue(dense["masks"][45:50, 60:70].all() and dense["masks"].sum() == 50)
+        r["masks"] = utils.to_rle_masks(masks)
+        rle = icsi.uncrop_detections(r, (40, 50, 60, 80), (100, 120, 3))
+        self.assertTrue(np.array_equal(rle["masks"].dense(), dense["masks"]))
+
+    def test_boxes_only_detections(self):
+        from types import SimpleNamespace
+        from mrcnn import model as modellib
+        model = SimpleNamespace(config=SimpleNamespace(MASK_PASTE_BACKEND="numpy", MASK_CLASSES=None))
+        detections = np.zeros([5, 6], dtype=np.float32)
+        detections[0] = [0.1, 0.1, 0.5, 0.5, 1, 0.9]
+        detections[1] = [0.2, 0.3, 0.6, 0.9, 3, 0.8]
+        for mask_format in ["dense", "box", "rle"]:
+            boxes, class_ids, scores, masks = modellib.MaskRCNN.unmold_detections(
+                model, detections, None, (100, 120, 3), (128, 128, 3), np.array([0, 0, 128, 128]),
+                mask_format=mask_format)
+            self.assertEqual(boxes.tolist(), [[10, 12, 50, 60], [20, 36, 60, 108]])
+            self.assertEqual(masks.shape, (100, 120, 2))
+            self.assertFalse(np.asarray(masks).any())
+        r = {"rois": boxes, "class_ids": class_ids, "scores": scores, "masks": masks, "boxes_only": True}
+        self.assertTrue(icsi.needs_masks(r))
+        features = icsi.extract_features(dict(r, rois=boxes[1:], class_ids=class_ids[1:]))
+        self.assertEqual(features[icsi.FEATURE_COLUMNS.index("sperm_x2")], 108)
 
+    def test_mask_classes_detections(self):
+        from types import SimpleNamespace
+        from mrcnn import model as modellib
+        model = SimpleNamespace(config=SimpleNamespace(MASK_PASTE_BACKEND="numpy", MASK_CLASSES=[1]))
+        detections = np.zeros([5, 6], dtype=np.float32)
+        detections[0] = [0.2, 0.3, 0.6, 0.9, 3, 0.9]
+        detections[1] = [0.1, 0.1, 0.5, 0.5, 1, 0.8]
+        # Only the mask of the oocyte is computed, first in the batch
+        mrcnn_mask = np.zeros([5, 28, 28, 5], dtype=np.float32)
+        mrcnn_mask[0, :, :, 1] = 1
+        for mask_format in ["dense", "box", "rle", "raw"]:
+            boxes, class_ids, scores, masks = modellib.MaskRCNN.unmold_detections(
+                model, detections, mrcnn_mask, (100, 120, 3), (128, 128, 3), np.array([0, 0, 128, 128]),
+                mask_format=mask_format)
+            dense = np.asarray(masks)
+            self.assertEqual(dense.shape, (100, 120, 2))
+            self.assertFalse(dense[..., 0].any())
+            self.assertEqual(dense[..., 1].sum(), 40 * 48)
+        r = {"rois": boxes, "class_ids": class_ids, "scores": scores, "masks": masks}
+        features = icsi.extract_features(r)
+        self.assertEqual(features[icsi.FEATURE_COLUMNS.index("sperm_x2")], 108)
+        self.assertEqual(features[icsi.FEATURE_COLUMNS.index("oocyte_x2")], 60)
+
+    def test_propagate_detections(self):
+        import cv2
+        rng = np.random.RandomState(0)
+        texture = cv2.GaussianBlur(rng.randint(0, 255, (140, 160)).astype(np.uint8), (0, 0), 3)
+        texture = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX)
+        # The content moves down by 8 pixels, the flow is computed at half
+        # the width and a quarter of the height
+        prev_gray = cv2.resize(texture[10:130], (80, 30), interpolation=cv2.INTER_AREA)
+        gray = cv2.resize(texture[2:122], (80, 30), interpolation=cv2.INTER_AREA)
+        masks = np.zeros([120, 160, 1], dtype=bool)
+        masks[40:80, 50:110] = True
+        r = {"rois": np.array([[40, 50, 80, 110]]), "class_ids": np.array([1]),
+             "scores": np.array([0.9]), "masks": masks}
+        propagated = icsi.propagate_detections(r, prev_gray, gray, (120, 160, 3))
+        self.assertTrue(np.allclose(propagated["rois"], [[48, 50, 88, 110]], atol=1))
+
+    def test_frozen_graph_mask_classes(self):
+        import json
+        import tempfile
+        from mrcnn import export
+        graph_path = os.path.join(tempfile.mkdtemp(), "mask_rcnn_icsi.pb")
+        with open(export.metadata_path(graph_path), "w") as f:
+            json.dump({"batch_size": 1, "num_classes": 5, "mask_classes": [1, 2]}, f)
+        # A graph without the masks of the sperm and the pipette can't
+        # write the annotated video
+        with self.assertRaises(ValueError):
+            icsi.load_inference_model(graph_path, all_masks=True)
+        self.assertIsNone(icsi.inference_config(all_masks=True).MASK_CLASSES)
+
+    def test_anchor_cache(self):
+        import tempfile
+        from types import SimpleNamespace
+        from mrcnn import model as modellib
+        config = SimpleNamespace(BACKBONE="resnet101", BACKBONE_STRIDES=[4, 8, 16, 32, 64],
+                                 RPN_ANCHOR_SCALES=(8, 16, 32, 64, 128), RPN_ANCHOR_RATIOS=[0.5, 1, 2],
+                                 RPN_ANCHOR_STRIDE=1, ANCHOR_CACHE_DIR=tempfile.mkdtemp())
+        backbone_shapes = modellib.compute_backbone_shapes(config, (256, 192, 3))
+        expected = icsi.utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                                                       backbone_shapes, config.BACKBONE_STRIDES, 1)
+        anchors = modellib.pyramid_anchors(config, (256, 192, 3))
+        self.assertTrue(np.array_equal(anchors, expected))
+        self.assertEqual(len(os.listdir(config.ANCHOR_CACHE_DIR)), 1)
+        # Another process loads the file instead of generating the anchors
+        modellib._anchor_cache.clear()
+        anchors = modellib.pyramid_anchors(config, (256, 192, 3))
+        self.assertIsInstance(anchors, np.memmap)
+        self.assertTrue(np.array_equal(anchors, expected))
+
+    def test_gt_cache(self):
+        import tempfile
+        from mrcnn import model as modellib, gt_cache
+
+        dataset = testing_utils.BoxDataset()
+        dataset.load_boxes(3)
+        dataset.prepare()
+        config = testing_utils.BoxConfig()
+        cache_dir = tempfile.mkdtemp()
+        gt_cache.write_cache(dataset, config, cache_dir, shard_size=2, full_masks=True, verbose=0)
+        cache = gt_cache.GTCache.open(cache_dir, config, dataset)
+        self.assertEqual(len(cache), 3)
+        for image_id in dataset.image_ids:
+            for use_mini_mask in [True, False]:
+                expected = modellib.load_image_gt(dataset, config, image_id, use_mini_mask=use_mini_mask)
+                cached = modellib.load_image_gt(dataset, config, image_id, use_mini_mask=use_mini_mask,
+                                                cache=cache)
+                for e, c in zip(expected, cached):
+                    self.assertTrue(np.array_equal(e, c))
+        # Another config has its own cache
+        config.IMAGE_MAX_DIM = 256
+        self.assertIsNone(gt_cache.GTCache.open(cache_dir, config, dataset))
+        # A rewritten image file changes the key
+        image_path = os.path.join(cache_dir, "image.png")
+        with open(image_path, "wb") as f:
+            f.write(b"image")
+        dataset.image_info[0]["path"] = image_path
+        key = gt_cache.cache_key(config, dataset)
+        with open(image_path, "wb") as f:
+            f.write(b"new image")
+        self.assertNotEqual(gt_cache.cache_key(config, dataset), key)
+
+    def test_via_index(self):
+        import json
+        import tempfile
+        import skimage.io
+        dataset_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(dataset_dir, "val"))
+        annotations = {}
+        for i, name in enumerate(["komorka", "plemnik"]):
+            filename = "{}.png".format(i)
+            skimage.io.imsave(os.path.join(dataset_dir, "val", filename), np.zeros([40 + i, 60, 3], np.uint8))
+            annotations[filename] = {"filename": filename, "regions": [{
+                "shape_attributes": {"name": "polygon", "all_points_x": [5, 30, 5], "all_points_y": [5, 5, 30]},
+                "region_attributes": {"name": name}}]}
+        with open(os.path.join(dataset_dir, "val", "via_region_data.json"), "w") as f:
+            json.dump(annotations, f)
+        datasets = []
+        for _ in range(2):
+            # The second time from the index file
+            dataset = icsi.ICSIDataset()
+            dataset.load_icsi(dataset_dir, "val")
+            dataset.prepare()
+            datasets.append(dataset)
+        self.assertTrue(os.path.exists(os.path.join(dataset_dir, "val", icsi.VIA_INDEX_FILE)))
+        for dataset in datasets:
+            self.assertEqual([(info["height"], info["width"]) for info in dataset.image_info], [(40, 60), (41, 60)])
+            mask, class_ids = dataset.load_mask(1)
+            self.assertEqual(class_ids.tolist(), [3])
+            self.assertEqual(mask.shape, (41, 60, 1))
+            self.assertTrue(np.array_equal(mask, datasets[0].load_mask(1)[0]))
+
+    def test_polygon_mini_masks(self):
+        import skimage.draw
+        from mrcnn import utils
+        # A rectangle, and a triangle that is partly out of the image
+        polygons = [(np.array([10., 10, 30, 30]), np.array([20., 60, 60, 20])),
+                    (np.array([40., 70, 70]), np.array([-20., -20, 10]))]
+        bbox, mini_masks = utils.polygons_to_mini_masks(polygons, 2, (4, 0), (160, 160), (28, 28))
+        self.assertEqual(mini_masks.shape, (28, 28, 2))
+        # As rasterized at the size of the image, resized and minimized
+        mask = np.zeros([80, 80, 2], dtype=bool)
+        for i, (ys, xs) in enumerate(polygons):
+            rr, cc = skimage.draw.polygon(ys, xs, (80, 80))
+            mask[rr, cc, i] = True
+        mask = utils.resize_mask(mask, 2, [(4, 76), (0, 0), (0, 0)])
+        expected = utils.extract_bboxes(mask)
+        self.assertTrue(np.all(np.abs(bbox - expected) <= 2))
+        self.assertTrue(mini_masks[:, :, 0].all())
+        minimized = utils.minimize_mask(expected, mask, (28, 28))
+        for i in range(2):
+            iou = (minimized[..., i] & mini_masks[..., i]).sum() / (minimized[..., i] | mini_masks[..., i]).sum()
+            self.assertGreater(iou, 0.8)
+        # Outside of the image
+        bbox, mini_masks = utils.polygons_to_mini_masks([polygons[1]], 1, (0, -100), (80, 80), (28, 28))
+        self.assertEqual(bbox.tolist(), [[0, 0, 0, 0]])
+        self.assertFalse(mini_masks.any())
+
+        # Both paths of load_image_gt() on the same annotation
+        from mrcnn import model as modellib
+
+        class PolygonDataset(utils.Dataset):
+            def load_image(self, image_id, channels=3):
+                return np.zeros([90, 120, channels], dtype=np.uint8)
+
+            def load_polygons(self, image_id):
+                return polygons, np.array([1, 1])
+
+            def load_mask(self, image_id):
+                mask = np.zeros([90, 120, len(polygons)], dtype=bool)
+                for i, (ys, xs) in enumerate(polygons):
+                    rr, cc = skimage.draw.polygon(ys, xs, (90, 120))
+                    mask[rr, cc, i] = True
+                return mask, np.array([1, 1], dtype=np.int32)
+
+        class PolygonConfig(icsi.Config):
+            NAME = "polygons"
+            NUM_CLASSES = 2
+            IMAGE_MIN_DIM = 128
+            IMAGE_MAX_DIM = 128
+
+        dataset = PolygonDataset()
+        dataset.add_class("polygons", 1, "shape")
+        dataset.add_image("polygons", image_id=0, path=None)
+        dataset.prepare()
+        config = PolygonConfig()
+        self.assertFalse(config.MINI_MASK_FROM_POLYGONS)
+        _, _, class_ids, bbox, mini_masks = modellib.load_image_gt(dataset, config, 0, use_mini_mask=True)
+        config.MINI_MASK_FROM_POLYGONS = True
+        _, _, polygon_class_ids, polygon_bbox, polygon_mini_masks = modellib.load_image_gt(
+            dataset, config, 0, use_mini_mask=True)
+        self.assertEqual(polygon_class_ids.tolist(), class_ids.tolist())
+        self.assertEqual(polygon_mini_masks.shape, mini_masks.shape)
+        self.assertTrue(np.all(np.abs(polygon_bbox - bbox) <= 1))
+        for i in range(len(class_ids)):
+            intersection = np.sum(mini_masks[..., i] & polygon_mini_masks[..., i])
+            union = np.sum(mini_masks[..., i] | polygon_mini_masks[..., i])
+            self.assertGreater(intersection / union, 0.8)
+
+    def test_rpn_targets(self):
+        from types import SimpleNamespace
+        from mrcnn import utils, model as modellib
+        anchors = utils.generate_pyramid_anchors((8, 16, 32), (0.5, 1, 2), [[32, 32], [16, 16], [8, 8]],
+                                                 [4, 8, 16], 1)
+        index = utils.AnchorGridIndex(anchors)
+        gt_boxes = np.array([[10, 20, 40, 44], [60, 60, 120, 128], [0, 0, 6, 5]], dtype=np.int32)
+        overlaps = utils.compute_overlaps(anchors, gt_boxes)
+        for i, box in enumerate(gt_boxes):
+            ids, iou = index.overlaps(box)
+            self.assertTrue(np.all(np.isin(np.where(overlaps[:, i] > 0)[0], ids)))
+            self.assertTrue(np.array_equal(iou, overlaps[ids, i]))
+        config = SimpleNamespace(RPN_TRAIN_ANCHORS_PER_IMAGE=64, RPN_BBOX_STD_DEV=np.array([0.1, 0.1, 0.2, 0.2]))
+        rpn_match, rpn_bbox = modellib.build_rpn_targets((128, 128, 3), anchors, np.array([1, 2, 3]),
+                                                         gt_boxes, config, index)
+        positives = np.where(rpn_match == 1)[0]
+        self.assertTrue(np.all(np.isin(np.argmax(overlaps, axis=0), positives)))
+        self.assertEqual(np.sum(rpn_match != 0), 64)
+        gt = gt_boxes[np.argmax(overlaps[positives], axis=1)]
+        self.assertTrue(np.allclose(rpn_bbox[:len(positives)],
+                                    utils.box_refinement(anchors[positives], gt) / config.RPN_BBOX_STD_DEV,
+                                    atol=1e-5))
+
+    def test_input_pipeline(self):
+        import tensorflow as tf
+        from mrcnn import model as modellib
+
+        # The image without instances is skipped
+        dataset = testing_utils.BoxDataset()
+        dataset.load_boxes(4, empty_ids=[1])
+        dataset.prepare()
+        config = testing_utils.BoxConfig()
+        generator = modellib.data_generator(dataset, config, batch_size=2, seed=1)
+        with tf.Graph().as_default(), tf.Session() as session:
+            pipeline = modellib.pipeline_generator(modellib.input_pipeline(
+                dataset, config, batch_size=2, num_parallel_calls=3, seed=1), session)
+            for _ in range(4):
+                expected, batch = next(generator)[0], next(pipeline)[0]
+                self.assertEqual(len(batch), len(expected))
+                for e, b in zip(expected, batch):
+                    self.assertEqual(e.dtype, b.dtype)
+                    self.assertTrue(np.array_equal(e, b))
+
+    def test_classify_stages(self):
+        def frame(**values):
+            features = np.full(len(icsi.FEATURE_COLUMNS), np.nan)
+            features[:4] = 0
+            for name, value in values.items():
+                features[icsi.FEATURE_COLUMNS.index(name)] = value
+            return features
+
+        sperm = dict(sperm_x1=50, sperm_x2=60, sperm_y1=50, sperm_y2=60)
+        pipette = dict(pipette_x1=40, pipette_x2=100, pipette_y1=40, pipette_y2=100)
+        oocyte = dict(oocyte_x1=0, oocyte_x2=200, oocyte_y1=0, oocyte_y2=200, oocyte_cx=100, oocyte_cy=100)
+        features = np.stack([
+            frame(n_sperm=2, **sperm),
+            frame(n_sperm=1, n_pipette=1, **dict(sperm, **pipette)),
+            frame(n_sperm=1, n_pipette=1, **dict(sperm, sperm_x1=10, **pipette)),
+            frame(n_oocyte=1, n_polar=1, polar_location=0.2),
+            frame(n_oocyte=1, n_pipette=1, oocyte_circularity=0.8, **dict(oocyte, **pipette)),
+            frame(n_oocyte=1, n_pipette=1, oocyte_circularity=0.9, **dict(oocyte, **pipette)),
+            frame(n_oocyte=1, n_polar=1),
+            frame(),
+        ])
+        self.assertEqual(icsi.stage_names(icsi.classify_stages(features)), [
+            "Sperm selection", "Sperm collection", "Immobilization of the sperm", "Oocyte positioning",
+            "Inserting the pipette", None, None, None])
+
+    def test_results_sink(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "results.sqlite")
+        r = {"rois": np.array([[1, 2, 3, 4]]), "class_ids": np.array([1]), "scores": np.array([0.9])}
+        for resume in [False, False, True]:
+            sink = icsi.ResultsSink(path, ["BG", "komorka"], resume=resume)
+            if resume:
+                self.assertEqual(sink.truncate(1), 1)
+            for frame in range(1 if resume else 0, 2):
+                sink.begin_frame(frame)
+                sink.add_detections(r)
+                sink.end_frame(None)
+            sink.close()
+            # A new run replaces the records, a resumed one continues them
+            detections, frames = icsi.load_results(path)
+            self.assertEqual(detections["frame"].tolist(), [0, 1])
+            self.assertEqual(frames["frame"].tolist(), [0, 1])
+
+    def test_smooth_stages(self):
+        stages = np.repeat([0, 1, 2], 30)
+        noisy = stages.copy()
+        noisy[[5, 40, 41, 70]] = [2, 0, -1, 1]
+        path = icsi.viterbi(icsi.stage_emissions(noisy), icsi.stage_transitions())
+        self.assertEqual(icsi.run_length_encode(np.arange(90), path), [(0, 29, 0), (30, 59, 1), (60, 89, 2)])
+
+        decoder = icsi.OnlineStageDecoder(lag=10)
+        decided = []
+        for frame, stage in enumerate(noisy):
+            decided.extend(decoder.push(frame, stage))
+        decided.extend(decoder.flush())
+        self.assertEqual([stage for _, stage in decided], path.tolist())
 
     def test_train_Popen(self):
         mydataset = "D:/MASK-RCNN/datasets/icsi"
@@ -53,6 +533,16 @@ class TestICSIUnit(unittest.TestCase):
         video = "D:/MASK-RCNN/datasets/videos/7_test.avi"
         self.assertEqual(detection_Popen(weights, video), 0)
 
+    def test_batch_Popen(self):
+        weights = "D:/MASK-RCNN/mask_rcnn_icsi_0022.h5"
+        videos = "D:/MASK-RCNN/datasets/videos"
+        output = "D:/MASK-RCNN/datasets/videos/batch_output"
+        self.assertEqual(batch_Popen(weights, videos, output, workers=2), 0)
+
+    def test_list_videos(self):
+        videos = icsi.list_videos("D:/MASK-RCNN/datasets/videos")
+        self.assertIn("7_test.avi", [os.path.basename(video) for video in videos])
+
 
 if __name__ == '__main__':
     unittest.main()